@@ -1,12 +1,18 @@
 # stdlib
+import os
+import socket
+import threading
 import time
 import ddtrace
 from json import loads
 
 # project
-from .encoding import get_encoder, JSONEncoder
+from .encoding import get_encoder, JSONEncoder, MsgpackStringTableEncoder
 from .compat import httplib, PYTHON_VERSION, PYTHON_INTERPRETER, get_connection_response
+from .internal.health import HealthMetrics
 from .internal.logger import get_logger
+from .internal.retry import RetryPolicy
+from .internal.uds import UDSHTTPConnection
 from .payload import Payload
 from .utils.deprecation import deprecated
 
@@ -14,21 +20,90 @@ from .utils.deprecation import deprecated
 log = get_logger(__name__)
 
 TRACE_COUNT_HEADER = 'X-Datadog-Trace-Count'
+CONTENT_ENCODING_HEADER = 'Content-Encoding'
 
-_VERSIONS = {'v0.4': {'traces': '/v0.4/traces',
+# Close kept-alive connections that have been idle for longer than this many
+# seconds. DEV: the trace agent closes idle connections after its 5s read
+# timeout, so we stay below that to avoid writing on a half-closed socket.
+DEFAULT_CONNECTION_IDLE_TIMEOUT = 4
+
+# Errors raised when reusing a connection that the agent has already closed
+_STALE_CONNECTION_ERRORS = (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error)
+# Errors raised when a payload can't be sent, the traces of the payload are recorded as failed
+_REQUEST_ERRORS = (httplib.HTTPException, OSError, IOError)
+
+# Maximum number of buffers written by a single ``sendmsg()`` call
+# DEV: IOV_MAX is 1024 on Linux and macOS
+_IOV_MAX = 1024
+
+# Maximum number of spooled payloads sent again after each successful request
+# DEV: the backlog is drained over several flushes so that a flush is never
+# delayed by the whole spool
+_SPOOL_REPLAY_LIMIT = 10
+
+_VERSIONS = {'v0.5': {'traces': '/v0.5/traces',
+                      'services': '/v0.5/services',
+                      'compatibility_mode': False,
+                      'string_table': True,
+                      'fallback': 'v0.4'},
+             'v0.4': {'traces': '/v0.4/traces',
                       'services': '/v0.4/services',
                       'compatibility_mode': False,
+                      'string_table': False,
                       'fallback': 'v0.3'},
              'v0.3': {'traces': '/v0.3/traces',
                       'services': '/v0.3/services',
                       'compatibility_mode': False,
+                      'string_table': False,
                       'fallback': 'v0.2'},
              'v0.2': {'traces': '/v0.2/traces',
                       'services': '/v0.2/services',
                       'compatibility_mode': True,
+                      'string_table': False,
                       'fallback': None}}
 
 
+def _data_size(data):
+    """Return the size of the body of a request, either a buffer or a list of buffers"""
+    if isinstance(data, list):
+        return sum(len(chunk) for chunk in data)
+    return len(data)
+
+
+def _sendall(sock, chunks):
+    """
+    Send all the given buffers on the socket, with vectored writes if the
+    platform supports them, so that they are never joined in a single buffer.
+    """
+    sendmsg = getattr(sock, 'sendmsg', None)
+    if sendmsg is None:
+        for chunk in chunks:
+            sock.sendall(chunk)
+        return
+
+    chunks = [memoryview(chunk) for chunk in chunks if len(chunk)]
+    # index of the first buffer not completely sent
+    first = 0
+    while first < len(chunks):
+        sent = sendmsg(chunks[first:first + _IOV_MAX])
+        while sent:
+            size = len(chunks[first])
+            if sent < size:
+                # DEV: slicing a memoryview doesn't copy the remaining data
+                chunks[first] = chunks[first][sent:]
+                break
+            sent -= size
+            first += 1
+
+
+def _last_response(responses):
+    """Return the last of the responses of the payloads sent, raising the first error if any"""
+    for response in responses:
+        if isinstance(response, Exception):
+            raise response
+    return responses[-1] if responses else None
+
+
 class Response(object):
     """
     Custom API Response object to represent a response from calling the API.
@@ -99,15 +174,55 @@ class Response(object):
 class API(object):
     """
     Send data to the trace agent using the HTTP protocol and JSON format
+
+    When ``uds_path`` is set, the HTTP requests are sent over the given Unix
+    Domain Socket instead of a TCP connection to ``hostname:port``.
+
+    When ``compression_level`` is set, payloads are gzip compressed with that
+    zlib level (1 to 9) before being sent.
+
+    A single keep-alive connection is shared by all the requests sent to the
+    agent. It is re-opened when it has been idle for more than
+    ``connection_idle_timeout`` seconds, after an error, or after a fork.
+
+    Payloads failing with a network error or a 5xx response are retried as
+    defined by the ``retry_policy``. When all the attempts failed, they are
+    stored in the ``spool`` (a ``ddtrace.internal.spool.Spool``), if any, and
+    sent again, a few at a time, after the next successful requests.
+
+    The API version is chosen from ``priority_sampling`` unless ``version`` is
+    given, e.g. ``'v0.5'`` to send the strings of each payload once in a string
+    table. Agents not supporting it are detected from their response and the
+    API is downgraded to the previous version.
+
+    The traces and bytes sent, the traces that failed to be sent, and the time
+    spent encoding and sending them are recorded in the ``metrics``.
     """
-    def __init__(self, hostname, port, headers=None, encoder=None, priority_sampling=False):
+    def __init__(self, hostname, port, uds_path=None, headers=None, encoder=None, priority_sampling=False,
+                 connection_idle_timeout=DEFAULT_CONNECTION_IDLE_TIMEOUT,
+                 max_payload_size=Payload.DEFAULT_MAX_PAYLOAD_SIZE, compression_level=None,
+                 retry_policy=None, spool=None, metrics=None, version=None):
         self.hostname = hostname
         self.port = port
+        self.uds_path = uds_path
+        self.connection_idle_timeout = connection_idle_timeout
+        self.max_payload_size = max_payload_size
+        self.compression_level = compression_level
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.spool = spool
+        self.metrics = metrics or HealthMetrics()
 
         self._headers = headers or {}
         self._version = None
 
-        if priority_sampling:
+        self._conn = None
+        self._conn_pid = None
+        self._conn_last_used = 0
+        self._conn_lock = threading.Lock()
+
+        if version:
+            self._set_version(version, encoder=encoder)
+        elif priority_sampling:
             self._set_version('v0.4', encoder=encoder)
         else:
             self._set_version('v0.3', encoder=encoder)
@@ -131,6 +246,8 @@ class API(object):
         self._compatibility_mode = _VERSIONS[version]['compatibility_mode']
         if self._compatibility_mode:
             self._encoder = JSONEncoder()
+        elif _VERSIONS[version]['string_table']:
+            self._encoder = MsgpackStringTableEncoder()
         else:
             self._encoder = encoder or get_encoder()
         # overwrite the Content-type with the one chosen in the Encoder
@@ -145,44 +262,301 @@ class API(object):
         """
         self._set_version(self._fallback)
 
-    def send_traces(self, traces):
+    @property
+    def encoder(self):
+        """The ``Encoder`` currently used to encode the traces sent to the agent"""
+        return self._encoder
+
+    def send_traces(self, traces, encoded=False):
+        """
+        Send the given traces to the agent. Traces are split in several payloads
+        so that none of them is much larger than ``max_payload_size``.
+
+        :param traces: A list of traces, each trace being a list of spans
+        :param bool encoded: If True, the traces are already encoded with ``API.encoder``
+        :returns: The ``Response`` of the last payload sent, ``None`` if there is no trace
+        :raises: The error raised while sending the first payload that failed, if any
+        """
+        return _last_response(self._send_payloads(traces, encoded=encoded))
+
+    def send_encoded_traces(self, traces):
+        """
+        Send the given traces, already encoded with ``API.encoder``, to the agent,
+        like ``send_traces(traces, encoded=True)``.
+
+        :param traces: A list of encoded traces
+        :returns: The ``Response`` of the last payload sent, ``None`` if there is no trace
+        :raises: The error raised while sending the first payload that failed, if any
+        """
+        return self.send_traces(traces, encoded=True)
+
+    def _send_payloads(self, traces, encoded=False):
+        """
+        Send the given traces in as many payloads as needed, recording the
+        traces of each payload as sent or failed in the health metrics.
+
+        :param traces: A list of traces, or of encoded traces when ``encoded`` is set
+        :returns: The list of ``Response`` received for each payload sent, or the
+            exception raised while sending it
+        :rtype: list
+        """
         if not traces:
-            return
+            return []
 
         start = time.time()
-        payload = Payload(encoder=self._encoder)
-        for trace in traces:
-            payload.add_trace(trace)
+        responses = []
+        payload = Payload(encoder=self._encoder, max_payload_size=self.max_payload_size)
+        add_trace = payload.add_encoded_trace if encoded else payload.add_trace
+        # index of the first trace of the current payload
+        first = 0
+        for i, trace in enumerate(traces, 1):
+            if encoded:
+                add_trace(trace)
+            else:
+                encode_start = time.time()
+                add_trace(trace)
+                self.metrics.timing('encode.time', time.time() - encode_start)
+            if payload.empty or (not payload.full and i < len(traces)):
+                continue
+
+            response = self._flush(payload)
+
+            # the API endpoint is not available so we should downgrade the connection and re-try the call
+            if self._should_downgrade(response):
+                log.debug('calling endpoint "%s" but received %s; downgrading API', self._traces, response.status)
+                content_type = self._encoder.content_type
+                self._downgrade()
+                if encoded and self._encoder.content_type != content_type:
+                    # DEV: the traces were encoded for the previous API version, we can't send them anymore
+                    log.error('dropping %d traces encoded as %s after an API downgrade',
+                              len(traces) - first, content_type)
+                    self.metrics.increment('traces.failed', len(traces) - first)
+                    return responses + [response]
+                # DEV: the encoder may have changed, so the traces not sent yet must be encoded again
+                return responses + self._send_payloads(traces[first:], encoded)
+
+            responses.append(response)
+            payload = Payload(encoder=self._encoder, max_payload_size=self.max_payload_size)
+            add_trace = payload.add_encoded_trace if encoded else payload.add_trace
+            first = i
+
+        log.debug("reported %d traces in %d payloads in %.5fs", len(traces), len(responses), time.time() - start)
+        return responses
+
+    def _flush(self, payload):
+        data, headers = self._payload_data(payload)
+
+        send_start = time.time()
+        response = self._put_with_retries(self._traces, data, payload.length, headers)
+        if self._should_downgrade(response):
+            # DEV: the traces are sent again with the previous API version, and recorded then
+            return response
+        self._record_response(response, payload, data, time.time() - send_start)
+
+        if self.spool is not None:
+            if self._should_retry(response):
+                log.debug('spooling %d traces after %d failed attempts', payload.length,
+                          self.retry_policy.max_attempts)
+                headers.update({
+                    'Content-Type': self._encoder.content_type,
+                    TRACE_COUNT_HEADER: str(payload.length),
+                })
+                self.spool.put(self._traces, b''.join(data) if isinstance(data, list) else data, headers)
+            elif response.status < 400:
+                # the agent is reachable again
+                self._replay_spool()
+
+        return response
 
-        response = self._put(self._traces, payload.get_payload(), payload.length)
+    def _payload_data(self, payload):
+        """Return the data to send for the given payload, and the headers it requires"""
+        headers = {}
+        if self.compression_level:
+            data = payload.get_compressed_payload(self.compression_level)
+            headers[CONTENT_ENCODING_HEADER] = 'gzip'
+        else:
+            # DEV: the encoded traces are sent as they are, without being joined in a single buffer
+            data = payload.get_payload_chunks()
+        return data, headers
+
+    def _record_response(self, response, payload, data, duration):
+        """Record the health metrics of a payload sent in ``duration`` seconds"""
+        self.metrics.timing('send.time', duration)
+        if isinstance(response, Exception) or response.status >= 400:
+            self.metrics.increment('traces.failed', payload.length)
+        else:
+            self.metrics.increment('traces.sent', payload.length)
+            self.metrics.increment('bytes.sent', _data_size(data))
 
-        # the API endpoint is not available so we should downgrade the connection and re-try the call
-        if response.status in [404, 415] and self._fallback:
-            log.debug('calling endpoint "%s" but received %s; downgrading API', self._traces, response.status)
-            self._downgrade()
-            return self.send_traces(traces)
+    def _put_with_retries(self, endpoint, data, count=0, headers=None):
+        """
+        Send the request, retrying on network errors and server errors.
 
-        log.debug("reported %d traces in %.5fs", len(traces), time.time() - start)
-        return response
+        :returns: The last ``Response`` received, or the exception raised by the last attempt
+        """
+        attempt = 0
+        while True:
+            try:
+                # DEV: subclasses of ``API`` may override ``_put()`` without the ``headers`` argument
+                if headers:
+                    response = self._put(endpoint, data, count, headers=headers)
+                else:
+                    response = self._put(endpoint, data, count)
+            except _REQUEST_ERRORS as err:
+                response = err
+            attempt += 1
+
+            if not self._should_retry(response) or not self.retry_policy.should_retry(attempt):
+                return response
+
+            wait = self.retry_policy.wait_time(attempt - 1)
+            log.debug('failed to send payload to the agent (%s), retrying in %.3fs', response, wait)
+            time.sleep(wait)
+
+    @staticmethod
+    def _should_retry(response):
+        return isinstance(response, Exception) or response.status >= 500
+
+    def _should_downgrade(self, response):
+        return isinstance(response, Response) and response.status in (404, 415) and self._fallback is not None
+
+    def _replay_spool(self):
+        """Send again the oldest spooled payloads, until one fails"""
+        claimed = self.spool.claim(_SPOOL_REPLAY_LIMIT)
+        for i, path in enumerate(claimed):
+            spooled = self.spool.read(path)
+            if spooled is None:
+                continue
+
+            endpoint, data, headers = spooled
+            try:
+                response = self._put(endpoint, data, headers=headers)
+            except _REQUEST_ERRORS as err:
+                log.debug('cannot replay spooled payload %s: %s', path, err)
+                response = None
+            else:
+                if self._should_retry(response):
+                    log.debug('cannot replay spooled payload %s: HTTP error status %s', path, response.status)
+                    response = None
+
+            if response is None:
+                for unsent in claimed[i:]:
+                    self.spool.release(unsent)
+                return
+
+            # DEV: a 4xx response would fail again, so the payload is removed as well
+            log.debug('replayed spooled payload %s: HTTP status %s', path, response.status)
+            self.spool.remove(path)
+
+    def __str__(self):
+        if self.uds_path:
+            return 'unix://{}'.format(self.uds_path)
+        return '{}:{}'.format(self.hostname, self.port)
 
     @deprecated(message='Sending services to the API is no longer necessary', version='1.0.0')
     def send_services(self, *args, **kwargs):
         return
 
-    def _put(self, endpoint, data, count=0):
-        conn = httplib.HTTPConnection(self.hostname, self.port)
-        try:
-            headers = self._headers
+    def close(self):
+        """Close the connection to the agent, if any. The next request will open a new one."""
+        with self._conn_lock:
+            self._close_connection()
+
+    def _new_connection(self):
+        if self.uds_path:
+            return UDSHTTPConnection(self.uds_path, self.hostname, self.port)
+        return httplib.HTTPConnection(self.hostname, self.port)
+
+    def _close_connection(self):
+        """
+        Close the current connection.
+
+        Non-safe if not used with a lock.
+        """
+        conn = self._conn
+        self._conn = None
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                log.debug('error while closing connection to the agent', exc_info=True)
+
+    def _get_connection(self):
+        """
+        Return the kept-alive connection, creating a new one if needed. The
+        second value of the returned tuple tells if the connection was reused.
+
+        Non-safe if not used with a lock.
+        """
+        if self._conn is not None and time.time() - self._conn_last_used > self.connection_idle_timeout:
+            self._close_connection()
+
+        if self._conn is not None:
+            return self._conn, True
+
+        self._conn = self._new_connection()
+        self._conn_pid = os.getpid()
+        return self._conn, False
+
+    def _check_fork(self):
+        if self._conn_pid is not None and self._conn_pid != os.getpid():
+            # the connection and its lock were inherited from our parent process,
+            # possibly while in use: never touch the parent socket, just forget about it
+            self._conn = None
+            self._conn_pid = None
+            self._conn_lock = threading.Lock()
+
+    def _request_headers(self, count=0, extra_headers=None):
+        """Return the headers of a request sending ``count`` traces"""
+        headers = self._headers
+        if count or extra_headers:
+            headers = dict(self._headers)
             if count:
-                headers = dict(self._headers)
                 headers[TRACE_COUNT_HEADER] = str(count)
-
+            if extra_headers:
+                headers.update(extra_headers)
+        return headers
+
+    def _put(self, endpoint, data, count=0, headers=None):
+        self._check_fork()
+
+        headers = self._request_headers(count, headers)
+        with self._conn_lock:
+            conn, reused = self._get_connection()
+            try:
+                try:
+                    response, will_close = self._request(conn, endpoint, data, headers)
+                except _STALE_CONNECTION_ERRORS:
+                    if not reused:
+                        raise
+                    # the agent closed the kept-alive connection, retry once on a new one
+                    log.debug('connection to the agent was closed, reconnecting')
+                    self._close_connection()
+                    conn, _ = self._get_connection()
+                    response, will_close = self._request(conn, endpoint, data, headers)
+            except Exception:
+                self._close_connection()
+                raise
+
+            if will_close:
+                self._close_connection()
+            else:
+                self._conn_last_used = time.time()
+            return response
+
+    def _request(self, conn, endpoint, data, headers):
+        if isinstance(data, list):
+            conn.putrequest('PUT', endpoint)
+            for name, value in headers.items():
+                conn.putheader(name, value)
+            conn.putheader('Content-Length', str(_data_size(data)))
+            conn.endheaders()
+            _sendall(conn.sock, data)
+        else:
             conn.request("PUT", endpoint, data, headers)
 
-            # Parse the HTTPResponse into an API.Response
-            # DEV: This will call `resp.read()` which must happen before the `conn.close()` below,
-            #      if we call `.close()` then all future `.read()` calls will return `b''`
-            resp = get_connection_response(conn)
-            return Response.from_http_response(resp)
-        finally:
-            conn.close()
+        # Parse the HTTPResponse into an API.Response
+        # DEV: This will call `resp.read()` which must happen before the connection is re-used
+        #      or closed, if we call `.close()` then all future `.read()` calls will return `b''`
+        resp = get_connection_response(conn)
+        return Response.from_http_response(resp), resp.will_close
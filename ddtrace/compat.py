@@ -1,6 +1,7 @@
 import platform
 import sys
 import textwrap
+import time
 
 from ddtrace.vendor import six
 
@@ -36,6 +37,7 @@ Queue = six.moves.queue.Queue
 iteritems = six.iteritems
 reraise = six.reraise
 reload_module = six.moves.reload_module
+get_ident = six.moves._thread.get_ident
 
 stringify = six.text_type
 string_type = six.string_types[0]
@@ -43,6 +45,28 @@ msgpack_type = six.binary_type
 # DEV: `six` doesn't have `float` in `integer_types`
 numeric_types = six.integer_types + (float, )
 
+if hasattr(time, 'time_ns'):
+    time_ns = time.time_ns
+    monotonic_ns = time.monotonic_ns
+else:
+    # DEV: Python 2 has no monotonic clock, durations are measured with the wall clock
+    _monotonic = getattr(time, 'monotonic', time.time)
+
+    def time_ns():
+        """Return the current time since the epoch in nanoseconds, as an int"""
+        return int(time.time() * 1e9)
+
+    def monotonic_ns():
+        """Return the value of a monotonic clock in nanoseconds, as an int"""
+        return int(_monotonic() * 1e9)
+
+# DEV: the `contextvars` backport for Python 3.6 is not integrated with `asyncio`,
+#      tasks would not get their own copy of the context variables
+if PYTHON_VERSION_INFO[0:2] >= (3, 7):
+    import contextvars
+else:
+    contextvars = None
+
 
 if PYTHON_VERSION_INFO[0:2] >= (3, 4):
     from asyncio import iscoroutinefunction
@@ -3,5 +3,6 @@ SAMPLE_RATE_METRIC_KEY = '_sample_rate'
 SAMPLING_PRIORITY_KEY = '_sampling_priority_v1'
 ANALYTICS_SAMPLE_RATE_KEY = '_dd1.sr.eausr'
 ORIGIN_KEY = '_dd.origin'
+DROPPED_SPANS_KEY = '_dd.dropped_spans'
 
 NUMERIC_TAGS = (ANALYTICS_SAMPLE_RATE_KEY, )
@@ -1,11 +1,30 @@
 import threading
+import time
 
-from .constants import SAMPLING_PRIORITY_KEY, ORIGIN_KEY
+from .compat import get_ident
+from .constants import DROPPED_SPANS_KEY, SAMPLING_PRIORITY_KEY, ORIGIN_KEY
 from .internal.logger import get_logger
 from .utils.formats import asbool, get_env
 
 log = get_logger(__name__)
 
+# DEV: the fixed part of the estimated size of a span, tags excluded
+_SPAN_OVERHEAD = 128
+
+
+def _estimate_size(span):
+    """
+    Return a rough estimate of the size of a span, in bytes, once encoded
+    """
+    size = _SPAN_OVERHEAD + len(span.name or '') + len(span.resource or '')
+    if span._meta:
+        for key, value in span._meta.items():
+            size += len(key) + len(value)
+    if span._metrics:
+        for key in span._metrics:
+            size += len(key) + 9
+    return size
+
 
 class Context(object):
     """
@@ -24,6 +43,9 @@ class Context(object):
     """
     _partial_flush_enabled = asbool(get_env('tracer', 'partial_flush_enabled', 'false'))
     _partial_flush_min_spans = int(get_env('tracer', 'partial_flush_min_spans', 500))
+    # DEV: the spans started once a limit is reached are not recorded, 0 disables the limit
+    _max_spans = int(get_env('tracer', 'max_spans_per_trace', 0))
+    _max_trace_bytes = int(get_env('tracer', 'max_trace_bytes', 0))
 
     def __init__(self, trace_id=None, span_id=None, sampled=True, sampling_priority=None, _dd_origin=None):
         """
@@ -33,10 +55,18 @@ class Context(object):
         :param int span_id: span_id of parent span
         """
         self._trace = []
+        # finished spans waiting for a partial flush
+        self._flush_buffer = []
         self._finished_spans = 0
         self._current_span = None
         self._lock = threading.Lock()
 
+        # spans recorded and dropped for the current trace
+        self._span_count = 0
+        self._trace_bytes = 0
+        self._dropped_spans = 0
+        self._dropped = None
+
         self._parent_trace_id = trace_id
         self._parent_span_id = span_id
         self._sampled = sampled
@@ -92,7 +122,13 @@ class Context(object):
         """
         Return the root span of the context or None if it does not exist.
         """
-        return self._trace[0] if len(self._trace) > 0 else None
+        if self._trace:
+            return self._trace[0]
+        # DEV: the spans of unsampled traces aren't recorded, find the root from the active span
+        span = self._current_span
+        while span is not None and span._parent is not None:
+            span = span._parent
+        return span
 
     def get_current_span(self):
         """
@@ -123,10 +159,74 @@ class Context(object):
         Add a span to the context trace list, keeping it as the last active span.
         """
         with self._lock:
-            self._set_current_span(span)
+            self._add_span(span)
+
+    def _add_span(self, span):
+        """
+        Internal method that adds a span to the trace list. Non-safe if not
+        used with a lock.
+        """
+        if self._max_spans or self._max_trace_bytes:
+            if (self._max_spans and self._span_count >= self._max_spans or
+                    self._max_trace_bytes and self._trace_bytes >= self._max_trace_bytes):
+                self._drop_span(span)
+                return
+            self._span_count += 1
+
+        self._set_current_span(span)
+
+        self._trace.append(span)
+        span._context = self
+
+    def _drop_span(self, span):
+        """
+        Internal method that keeps a span out of the trace, counting it on
+        the root span. Non-safe if not used with a lock.
+        """
+        # DEV: the span is still attached to the context so that it can be finished
+        #      and used as a parent, but it is never part of the trace
+        span._context = self
+        if self._dropped is None:
+            self._dropped = set()
+        self._dropped.add(span)
+        self._dropped_spans += 1
+        if self._trace:
+            self._trace[0].set_metric(DROPPED_SPANS_KEY, self._dropped_spans)
+
+    def add_noop_span(self, span):
+        """
+        Keep a ``NoopSpan`` as the last active span, without adding it to the trace.
+        """
+        with self._lock:
+            self._add_noop_span(span)
 
-            self._trace.append(span)
-            span._context = self
+    def _add_noop_span(self, span):
+        """
+        Internal method that activates an unsampled span. Non-safe if not used
+        with a lock.
+        """
+        self._set_current_span(span)
+        span._context = self
+
+    def close_noop_span(self, span):
+        """
+        Mark a ``NoopSpan`` as finished, its parent becomes the active span.
+        """
+        with self._lock:
+            self._close_noop_span(span)
+
+    def _close_noop_span(self, span):
+        """
+        Internal method that deactivates an unsampled span. Non-safe if not
+        used with a lock.
+        """
+        self._set_current_span(span._parent)
+        if span._parent is None and not self._trace and not self._flush_buffer:
+            # the unsampled trace is over, reset the context like ``_get()``
+            self._parent_trace_id = None
+            self._parent_span_id = None
+            self._sampling_priority = None
+            self._sampled = True
 
     def close_span(self, span):
         """
@@ -134,23 +234,50 @@ class Context(object):
         cycles inside _trace list.
         """
         with self._lock:
-            self._finished_spans += 1
-            self._set_current_span(span._parent)
-
-            # notify if the trace is not closed properly; this check is executed only
-            # if the tracer debug_logging is enabled and when the root span is closed
-            # for an unfinished trace. This logging is meant to be used for debugging
-            # reasons, and it doesn't mean that the trace is wrongly generated.
-            # In asynchronous environments, it's legit to close the root span before
-            # some children. On the other hand, asynchronous web frameworks still expect
-            # to close the root span after all the children.
-            tracer = getattr(span, '_tracer', None)
-            if tracer and tracer.debug_logging and span._parent is None and not self._is_finished():
-                opened_spans = len(self._trace) - self._finished_spans
-                log.debug('Root span "%s" closed, but the trace has %d unfinished spans:', span.name, opened_spans)
-                spans = [x for x in self._trace if not x._finished]
-                for wrong_span in spans:
-                    log.debug('\n%s', wrong_span.pprint())
+            self._close_span(span)
+
+    def _close_span(self, span):
+        """
+        Internal method that marks a span as finished. Non-safe if not used
+        with a lock.
+        """
+        if self._dropped and span in self._dropped:
+            self._dropped.discard(span)
+            return
+
+        self._finished_spans += 1
+        self._set_current_span(span._parent)
+        if self._max_trace_bytes:
+            self._trace_bytes += _estimate_size(span)
+
+        if self._partial_flush_enabled:
+            # DEV: finished spans are moved to the flush buffer as they close, so that
+            #      partial flushes don't need to split the trace list
+            trace = self._trace
+            if trace and trace[-1] is span:
+                trace.pop()
+            elif span in trace:
+                trace.remove(span)
+            if span._parent is None:
+                # keep the root span first once the trace is finished
+                self._flush_buffer.insert(0, span)
+            else:
+                self._flush_buffer.append(span)
+
+        # notify if the trace is not closed properly; this check is executed only
+        # if the tracer debug_logging is enabled and when the root span is closed
+        # for an unfinished trace. This logging is meant to be used for debugging
+        # reasons, and it doesn't mean that the trace is wrongly generated.
+        # In asynchronous environments, it's legit to close the root span before
+        # some children. On the other hand, asynchronous web frameworks still expect
+        # to close the root span after all the children.
+        tracer = getattr(span, '_tracer', None)
+        if tracer and tracer.debug_logging and span._parent is None and not self._is_finished():
+            opened_spans = len(self._trace) - self._finished_spans
+            log.debug('Root span "%s" closed, but the trace has %d unfinished spans:', span.name, opened_spans)
+            spans = [x for x in self._trace if not x._finished]
+            for wrong_span in spans:
+                log.debug('\n%s', wrong_span.pprint())
 
     def is_finished(self):
         """
@@ -177,65 +304,193 @@ class Context(object):
         This operation is thread-safe.
         """
         with self._lock:
-            if self._is_finished():
-                # get the trace
-                trace = self._trace
-                sampled = self._sampled
-                sampling_priority = self._sampling_priority
-                # attach the sampling priority to the context root span
-                if sampled and sampling_priority is not None and trace:
-                    trace[0].set_metric(SAMPLING_PRIORITY_KEY, sampling_priority)
-                origin = self._dd_origin
-                # attach the origin to the root span tag
-                if sampled and origin is not None and trace:
-                    trace[0].set_tag(ORIGIN_KEY, origin)
-
-                # clean the current state
-                self._trace = []
-                self._finished_spans = 0
-                self._parent_trace_id = None
-                self._parent_span_id = None
-                self._sampling_priority = None
-                self._sampled = True
-                return trace, sampled
-
-            elif self._partial_flush_enabled and self._finished_spans >= self._partial_flush_min_spans:
-                # partial flush when enabled and we have more than the minimal required spans
-                trace = self._trace
-                sampled = self._sampled
-                sampling_priority = self._sampling_priority
-                # attach the sampling priority to the context root span
-                if sampled and sampling_priority is not None and trace:
-                    trace[0].set_metric(SAMPLING_PRIORITY_KEY, sampling_priority)
-                origin = self._dd_origin
-                # attach the origin to the root span tag
-                if sampled and origin is not None and trace:
-                    trace[0].set_tag(ORIGIN_KEY, origin)
-
-                # Any open spans will remain as `self._trace`
-                # Any finished spans will get returned to be flushed
-                opened_spans = []
-                closed_spans = []
-                for span in trace:
-                    if span._finished:
-                        closed_spans.append(span)
-                    else:
-                        opened_spans.append(span)
-
-                # Update trace spans and stats
-                self._trace = opened_spans
-                self._finished_spans = 0
-
-                return closed_spans, sampled
-            else:
-                return None, None
+            return self._get()
+
+    def _get(self):
+        """
+        Internal method that returns the finished trace and resets the
+        ``Context``. Non-safe if not used with a lock.
+        """
+        if self._is_finished():
+            # get the trace
+            trace = self._trace
+            if self._flush_buffer:
+                trace = self._flush_buffer + trace
+                self._flush_buffer = []
+            sampled = self._sampled
+            sampling_priority = self._sampling_priority
+            # attach the sampling priority to the context root span
+            if sampled and sampling_priority is not None and trace:
+                trace[0].set_metric(SAMPLING_PRIORITY_KEY, sampling_priority)
+            origin = self._dd_origin
+            # attach the origin to the root span tag
+            if sampled and origin is not None and trace:
+                trace[0].set_tag(ORIGIN_KEY, origin)
+
+            # clean the current state
+            self._trace = []
+            self._finished_spans = 0
+            if self._max_spans or self._max_trace_bytes:
+                self._span_count = 0
+                self._trace_bytes = 0
+                self._dropped_spans = 0
+            self._parent_trace_id = None
+            self._parent_span_id = None
+            self._sampling_priority = None
+            self._sampled = True
+            return trace, sampled
+
+        elif self._partial_flush_enabled and self._finished_spans >= self._partial_flush_min_spans:
+            # partial flush when enabled and we have more than the minimal required spans
+            trace = self._flush_buffer
+            sampled = self._sampled
+            sampling_priority = self._sampling_priority
+            # attach the sampling priority to the context root span
+            if sampled and sampling_priority is not None and trace:
+                trace[0].set_metric(SAMPLING_PRIORITY_KEY, sampling_priority)
+            origin = self._dd_origin
+            # attach the origin to the root span tag
+            if sampled and origin is not None and trace:
+                trace[0].set_tag(ORIGIN_KEY, origin)
+
+            # Any open spans remain as `self._trace`, the finished ones
+            # were moved to the flush buffer when they were closed
+            self._flush_buffer = []
+            self._finished_spans = 0
+
+            return trace, sampled
+        else:
+            return None, None
 
     def _is_finished(self):
         """
         Internal method that checks if the ``Context`` is finished or not.
         """
-        num_traces = len(self._trace)
-        return num_traces > 0 and num_traces == self._finished_spans
+        num_spans = len(self._trace) + len(self._flush_buffer)
+        return num_spans > 0 and num_spans == self._finished_spans
+
+
+class LocalContext(Context):
+    """
+    ``Context`` owned by the thread that creates it, used by default by the
+    thread-local and ``asyncio`` context providers.
+
+    Reads and updates made by the owner thread skip the ``Context`` lock.
+    The first time the context is updated from another thread, for instance
+    when a span is finished in an executor, the context is upgraded to a
+    thread-safe ``Context`` for the rest of its life, once the owner thread is
+    done with the update it may be making without the lock. ``clone()``
+    returns a thread-safe ``Context`` that can be handed to another thread.
+    """
+    def __init__(self, *args, **kwargs):
+        super(LocalContext, self).__init__(*args, **kwargs)
+        self._owner = get_ident()
+        # DEV: set by the owner thread while it updates the context without the lock
+        self._owner_busy = False
+        # DEV: set by the first other thread using the context
+        self._shared = False
+
+    @property
+    def trace_id(self):
+        """Return current context trace_id."""
+        return self._parent_trace_id
+
+    @property
+    def span_id(self):
+        """Return current context span_id."""
+        return self._parent_span_id
+
+    @property
+    def sampled(self):
+        """Return current context sampled flag."""
+        return self._sampled
+
+    @property
+    def sampling_priority(self):
+        """Return current context sampling priority."""
+        return self._sampling_priority
+
+    @sampling_priority.setter
+    def sampling_priority(self, value):
+        """Set sampling priority."""
+        self._sampling_priority = value
+
+    def get_current_span(self):
+        return self._current_span
+
+    def add_span(self, span):
+        if not self._enter():
+            return Context.add_span(self, span)
+        try:
+            self._add_span(span)
+        finally:
+            self._owner_busy = False
+
+    def close_span(self, span):
+        if not self._enter():
+            return Context.close_span(self, span)
+        try:
+            self._close_span(span)
+        finally:
+            self._owner_busy = False
+
+    def add_noop_span(self, span):
+        if not self._enter():
+            return Context.add_noop_span(self, span)
+        try:
+            self._add_noop_span(span)
+        finally:
+            self._owner_busy = False
+
+    def close_noop_span(self, span):
+        if not self._enter():
+            return Context.close_noop_span(self, span)
+        try:
+            self._close_noop_span(span)
+        finally:
+            self._owner_busy = False
+
+    def is_finished(self):
+        return self._is_finished()
+
+    def is_sampled(self):
+        return self._sampled
+
+    def get(self):
+        if not self._enter():
+            return Context.get(self)
+        try:
+            return self._get()
+        finally:
+            self._owner_busy = False
+
+    def _enter(self):
+        """
+        Return whether the current thread can update the context without the
+        lock, marking the owner thread as busy if so. Otherwise, the context is
+        made thread-safe and the caller must take the lock.
+        """
+        if get_ident() == self._owner:
+            self._owner_busy = True
+            if not self._shared:
+                return True
+            self._owner_busy = False
+        self._make_thread_safe()
+        return False
+
+    def _make_thread_safe(self):
+        """
+        Turn this context into a thread-safe ``Context``, once the owner thread
+        is done updating it without the lock. The lock was created by
+        ``Context.__init__`` so switching the class is enough.
+        """
+        self._shared = True
+        # DEV: the owner sets ``_owner_busy`` before checking ``_shared``, and other
+        #      threads set ``_shared`` before checking ``_owner_busy``: at least one
+        #      of them sees the flag of the other one
+        while self._owner_busy:
+            time.sleep(0)
+        self.__class__ = Context
 
 
 class ThreadLocalContext(object):
@@ -265,7 +520,7 @@ class ThreadLocalContext(object):
         ctx = getattr(self._locals, 'context', None)
         if not ctx:
             # create a new Context if it's not available
-            ctx = Context()
+            ctx = LocalContext()
             self._locals.context = ctx
 
         return ctx
@@ -35,6 +35,31 @@ between scheduled coroutines and ``Future`` invoked in separated threads:
       the current active ``Context`` so that generated traces in the new task
       are attached to the main trace
 
+On Python 3.7+, the default context provider of the tracer keeps the active
+``Context`` in a ``contextvars.ContextVar``: each ``asyncio`` task gets its own
+``Context``, continuing the trace that is active when it is created, without
+configuring the ``context_provider`` above, calling the helpers or patching
+the event loop.
+``run_in_executor`` does not propagate context variables, its helper is still
+needed to continue the trace in the executor thread.
+
+Traces are sent to the agent from a background thread by default. The
+``AsyncioWriter`` sends them from a ``Task`` running on the application loop
+instead, with non-blocking sockets, yielding to the other tasks after at most
+``max_blocking_time`` seconds of work. The time it spends on the loop is
+returned in the ``loop.time.*`` values of ``tracer.writer.stats()``::
+
+    from ddtrace.contrib.asyncio import AsyncioWriter
+
+    loop = asyncio.get_event_loop()
+    tracer.configure(
+        context_provider=context_provider,
+        writer=AsyncioWriter(loop=loop, priority_sampler=tracer.priority_sampler),
+    )
+
+Without ``loop``, the ``AsyncioWriter`` runs its own event loop in a background
+thread.
+
 A ``patch(asyncio=True)`` is available if you want to automatically use above
 wrappers without changing your code. In that case, the patch method **must be
 called before** importing stdlib functions.
@@ -52,8 +77,10 @@ with require_modules(required_modules) as missing_modules:
 
         from .helpers import set_call_context, ensure_future, run_in_executor
         from .patch import patch
+        from .writer import AsyncioWriter
 
         __all__ = [
+            'AsyncioWriter',
             'context_provider',
             'set_call_context',
             'ensure_future',
@@ -8,7 +8,7 @@ import ddtrace
 from asyncio.base_events import BaseEventLoop
 
 from .provider import CONTEXT_ATTR
-from ...context import Context
+from ...context import Context, LocalContext
 
 
 _orig_create_task = BaseEventLoop.create_task
@@ -108,7 +108,7 @@ def _wrapped_create_task(wrapped, instance, args, kwargs):
     ctx = getattr(current_task, CONTEXT_ATTR, None)
     if ctx:
         # current task has a context, so parent a new context to the base context
-        new_ctx = Context(
+        new_ctx = LocalContext(
             trace_id=ctx.trace_id,
             span_id=ctx.span_id,
             sampling_priority=ctx.sampling_priority,
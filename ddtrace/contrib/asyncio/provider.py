@@ -1,6 +1,6 @@
 import asyncio
 
-from ...context import Context
+from ...context import LocalContext
 from ...provider import DefaultContextProvider
 
 # Task attribute used to set/get the Context instance
@@ -73,7 +73,7 @@ class AsyncioContextProvider(DefaultContextProvider):
             # providing a detached Context from the current Task, may lead to
             # wrong traces. This defensive behavior grants that a trace can
             # still be built without raising exceptions
-            return Context()
+            return LocalContext()
 
         ctx = getattr(task, CONTEXT_ATTR, None)
         if ctx is not None:
@@ -81,6 +81,6 @@ class AsyncioContextProvider(DefaultContextProvider):
             return ctx
 
         # create a new Context using the Task as a Context carrier
-        ctx = Context()
+        ctx = LocalContext()
         setattr(task, CONTEXT_ATTR, ctx)
         return ctx
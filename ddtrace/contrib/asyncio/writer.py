@@ -0,0 +1,476 @@
+"""
+Trace writer for applications running an ``asyncio`` event loop.
+
+Traces are encoded and sent to the agent by a ``Task`` running either on the
+application loop or on a dedicated loop running in a background thread, using
+non-blocking sockets instead of the ``httplib`` connection of the default
+``AgentWriter``.
+"""
+import asyncio
+import atexit
+import os
+import threading
+import time
+
+from ...api import API, Response, _data_size, _last_response
+from ...compat import httplib
+from ...internal.logger import get_logger
+from ...payload import Payload
+from ...writer import AgentWriter, AsyncWorker
+
+log = get_logger(__name__)
+
+# Maximum time (in seconds) the writer runs on the event loop before yielding
+# control back to the other tasks
+DEFAULT_MAX_BLOCKING_TIME = 0.005
+
+# Maximum time (in seconds) to connect to the agent, or to send a request and
+# read its response
+DEFAULT_REQUEST_TIMEOUT = 2
+
+# Errors raised when the request can't be sent or the response can't be read
+_REQUEST_ERRORS = (httplib.HTTPException, OSError, EOFError, asyncio.TimeoutError)
+
+
+class AsyncioAPI(API):
+    """
+    ``API`` sending traces from coroutines, over a non-blocking connection.
+
+    ``send_traces()`` and ``send_encoded_traces()`` are coroutines. Encoding
+    the traces is split in slices of at most ``max_blocking_time`` seconds
+    between which control is given back to the event loop, and the time spent
+    in each slice is recorded in the ``loop.time`` metric.
+
+    The ``spool`` isn't supported, since writing to disk would block the loop.
+    """
+    def __init__(self, hostname, port, max_blocking_time=DEFAULT_MAX_BLOCKING_TIME,
+                 request_timeout=DEFAULT_REQUEST_TIMEOUT, **kwargs):
+        super(AsyncioAPI, self).__init__(hostname, port, **kwargs)
+        self.max_blocking_time = max_blocking_time
+        self.request_timeout = request_timeout
+        self._stream = None
+
+    @asyncio.coroutine
+    def send_traces(self, traces, encoded=False):
+        """
+        Send the given traces to the agent, like ``API.send_traces()``.
+
+        :param traces: A list of traces, each trace being a list of spans
+        :param bool encoded: If True, the traces are already encoded with ``API.encoder``
+        :returns: The ``Response`` of the last payload sent, ``None`` if there is no trace
+        :raises: The error raised while sending the first payload that failed, if any
+        """
+        return _last_response((yield from self._send_payloads(traces, encoded=encoded)))  # noqa: E999
+
+    @asyncio.coroutine
+    def send_encoded_traces(self, traces):
+        """
+        Send the given traces, already encoded with ``API.encoder``, to the agent,
+        like ``send_traces(traces, encoded=True)``.
+
+        :param traces: A list of encoded traces
+        :returns: The ``Response`` of the last payload sent, ``None`` if there is no trace
+        :raises: The error raised while sending the first payload that failed, if any
+        """
+        return (yield from self.send_traces(traces, encoded=True))
+
+    @asyncio.coroutine
+    def _send_payloads(self, traces, encoded=False):
+        """Send the given traces like ``API._send_payloads()``, returning the list of responses"""
+        if not traces:
+            return []
+
+        start = time.time()
+        slice_start = start
+        responses = []
+        payload = self._new_payload()
+        add_trace = payload.add_encoded_trace if encoded else payload.add_trace
+        # index of the first trace of the current payload
+        first = 0
+        for i, trace in enumerate(traces, 1):
+            if encoded:
+                add_trace(trace)
+            else:
+                encode_start = time.time()
+                add_trace(trace)
+                self.metrics.timing('encode.time', time.time() - encode_start)
+
+            if payload.empty or (not payload.full and i < len(traces)):
+                if time.time() - slice_start >= self.max_blocking_time:
+                    # give the other tasks a chance to run
+                    self.metrics.timing('loop.time', time.time() - slice_start)
+                    yield from asyncio.sleep(0)
+                    slice_start = time.time()
+                continue
+
+            data, headers = self._payload_data(payload)
+            self.metrics.timing('loop.time', time.time() - slice_start)
+            send_start = time.time()
+            response = yield from self._put_with_retries(self._traces, data, payload.length, headers)
+            slice_start = time.time()
+
+            # the API endpoint is not available so we should downgrade the connection and re-try the call
+            # DEV: the traces are recorded in the metrics when they are sent again
+            if self._should_downgrade(response):
+                log.debug('calling endpoint "%s" but received %s; downgrading API', self._traces, response.status)
+                content_type = self._encoder.content_type
+                self._downgrade()
+                if encoded and self._encoder.content_type != content_type:
+                    # DEV: the traces were encoded for the previous API version, we can't send them anymore
+                    log.error('dropping %d traces encoded as %s after an API downgrade',
+                              len(traces) - first, content_type)
+                    self.metrics.increment('traces.failed', len(traces) - first)
+                    return responses + [response]
+                # DEV: the encoder may have changed, so the traces not sent yet must be encoded again
+                return responses + (yield from self._send_payloads(traces[first:], encoded))
+
+            self._record_response(response, payload, data, time.time() - send_start)
+
+            responses.append(response)
+            payload = self._new_payload()
+            add_trace = payload.add_encoded_trace if encoded else payload.add_trace
+            first = i
+
+        self.metrics.timing('loop.time', time.time() - slice_start)
+        log.debug("reported %d traces in %d payloads in %.5fs", len(traces), len(responses), time.time() - start)
+        return responses
+
+    @asyncio.coroutine
+    def _put_with_retries(self, endpoint, data, count=0, headers=None):
+        attempt = 0
+        while True:
+            try:
+                response = yield from self._put(endpoint, data, count, headers=headers)
+            except _REQUEST_ERRORS as err:
+                response = err
+            attempt += 1
+
+            if not self._should_retry(response) or not self.retry_policy.should_retry(attempt):
+                return response
+
+            wait = self.retry_policy.wait_time(attempt - 1)
+            log.debug('failed to send payload to the agent (%s), retrying in %.3fs', response, wait)
+            yield from asyncio.sleep(wait)
+
+    def close(self):
+        """Close the connection to the agent, if any. The next request will open a new one."""
+        self._close_connection()
+
+    def _close_connection(self):
+        stream = self._stream
+        self._stream = None
+        if stream is not None:
+            stream[1].close()
+
+    @asyncio.coroutine
+    def _get_connection(self):
+        """
+        Return the kept-alive ``(reader, writer)`` streams, opening new ones if
+        needed. The second value of the returned tuple tells if the connection
+        was reused.
+        """
+        if self._conn_pid is not None and self._conn_pid != os.getpid():
+            # the streams were inherited from our parent process, never touch them
+            self._stream = None
+        elif self._stream is not None and time.time() - self._conn_last_used > self.connection_idle_timeout:
+            self._close_connection()
+
+        if self._stream is not None:
+            return self._stream, True
+
+        if self.uds_path:
+            connect = asyncio.open_unix_connection(self.uds_path)
+        else:
+            connect = asyncio.open_connection(self.hostname, self.port)
+        self._stream = yield from asyncio.wait_for(connect, self.request_timeout)
+        self._conn_pid = os.getpid()
+        return self._stream, False
+
+    @asyncio.coroutine
+    def _put(self, endpoint, data, count=0, headers=None):
+        headers = self._request_headers(count, headers)
+        stream, reused = yield from self._get_connection()
+        try:
+            try:
+                response, will_close = yield from asyncio.wait_for(
+                    self._request(stream, endpoint, data, headers), self.request_timeout)
+            except _REQUEST_ERRORS:
+                if not reused:
+                    raise
+                # the agent closed the kept-alive connection, retry once on a new one
+                log.debug('connection to the agent was closed, reconnecting')
+                self._close_connection()
+                stream, _ = yield from self._get_connection()
+                response, will_close = yield from asyncio.wait_for(
+                    self._request(stream, endpoint, data, headers), self.request_timeout)
+        except Exception:
+            self._close_connection()
+            raise
+
+        if will_close:
+            self._close_connection()
+        else:
+            self._conn_last_used = time.time()
+        return response
+
+    @asyncio.coroutine
+    def _request(self, stream, endpoint, data, headers):
+        reader, writer = stream
+        lines = ['PUT {0} HTTP/1.1'.format(endpoint), 'Host: {0}:{1}'.format(self.hostname, self.port)]
+        lines.extend('{0}: {1}'.format(name, value) for name, value in headers.items())
+        lines.append('Content-Length: {0}'.format(_data_size(data)))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if isinstance(data, list):
+            writer.writelines(data)
+        else:
+            writer.write(data)
+        yield from writer.drain()
+        return (yield from self._read_response(reader))
+
+    @asyncio.coroutine
+    def _read_response(self, reader):
+        status_line = (yield from reader.readline()).decode('latin-1')
+        try:
+            _, status, reason = (status_line.rstrip('\r\n').split(' ', 2) + [''])[:3]
+            status = int(status)
+        except ValueError:
+            raise httplib.BadStatusLine(status_line)
+
+        headers = {}
+        while True:
+            line = yield from reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        will_close = headers.get('connection', '').lower() == 'close'
+        try:
+            if headers.get('transfer-encoding', '').lower() == 'chunked':
+                chunks = []
+                while True:
+                    size = int((yield from reader.readline()).split(b';')[0], 16)
+                    chunk = yield from reader.readexactly(size + 2)
+                    if not size:
+                        break
+                    chunks.append(chunk[:-2])
+                body = b''.join(chunks)
+            elif 'content-length' in headers:
+                body = yield from reader.readexactly(int(headers['content-length']))
+            elif status < 200 or status in (204, 304):
+                body = b''
+            else:
+                # DEV: the body is delimited by the end of the connection
+                body = yield from reader.read()
+                will_close = True
+        except ValueError:
+            raise httplib.HTTPException('invalid response body framing: {0}'.format(headers))
+
+        return Response(status=status, body=body, reason=reason, msg=headers), will_close
+
+    def _new_payload(self):
+        return Payload(encoder=self._encoder, max_payload_size=self.max_payload_size)
+
+
+class AsyncioWorker(AsyncWorker):
+    """
+    ``AsyncWorker`` flushing the trace queue from a ``Task`` running on the
+    given event loop instead of a thread.
+    """
+    def __init__(self, api, trace_queue, loop, **kwargs):
+        self._loop = loop
+        self._started = False
+        self._task = None
+        self._wakeup = None
+        self._stopped = threading.Event()
+        super(AsyncioWorker, self).__init__(api, trace_queue, **kwargs)
+        # DEV: the flush task doesn't block in ``pop()``, it is woken up when the flush thresholds are reached
+        trace_queue.on_ready = self._wake_threadsafe
+
+    def is_alive(self):
+        return not self._stopped.is_set()
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            log.debug("starting flush task")
+            self._started = True
+            # DEV: the worker is started by the first ``write()``, possibly from another thread
+            try:
+                self._loop.call_soon_threadsafe(self._start_task)
+            except RuntimeError:
+                log.error("cannot start the flush task: the event loop is closed")
+                self._stopped.set()
+                return
+            atexit.register(self._on_shutdown)
+
+    def _start_task(self):
+        self._wakeup = asyncio.Event(loop=self._loop)
+        self._task = self._loop.create_task(self._run())
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _wake_threadsafe(self):
+        try:
+            self._loop.call_soon_threadsafe(self._wake)
+        except RuntimeError:
+            # DEV: the loop is closed, the flush task is not running anymore
+            pass
+
+    def stop(self):
+        """
+        Close the trace queue and wake the flush task up so that it sends the
+        remaining traces and exits
+        """
+        with self._lock:
+            if self._started and self.is_alive():
+                self._trace_queue.close()
+                try:
+                    self._loop.call_soon_threadsafe(self._wake)
+                except RuntimeError:
+                    self._stopped.set()
+
+    def join(self, timeout=2):
+        """
+        Wait for the flush task to exit. It must not be called from the event
+        loop thread.
+        """
+        self._stopped.wait(timeout)
+
+    def flush(self, timeout):
+        if not self._started or not self.is_alive():
+            return False
+        pop = self._trace_queue.wake()
+        # DEV: the flush task cannot run while its loop is stopped, or while its
+        #      loop thread is waiting for it
+        if not self._loop.is_running() or self._in_loop_thread():
+            return False
+        return self._wait_flushed(pop, timeout)
+
+    def _in_loop_thread(self):
+        # DEV: unlike ``asyncio.get_event_loop()``, this never creates an event loop
+        return asyncio._get_running_loop() is self._loop
+
+    def _on_shutdown(self):
+        self.stop()
+        # DEV: the application loop is usually not running anymore when exiting
+        if self._loop.is_running():
+            self._stopped.wait(self._shutdown_timeout)
+
+    @asyncio.coroutine
+    def _run(self):
+        try:
+            while True:
+                try:
+                    yield from asyncio.wait_for(self._wakeup.wait(), self._flush_interval, loop=self._loop)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+                pop = yield from self._flush()
+                with self._flushed_cond:
+                    self._flushed = pop
+                    self._flushed_cond.notify_all()
+
+                done = self._trace_queue.closed() and self._trace_queue.size() == 0
+                if self._reporter:
+                    if done:
+                        self._reporter.report()
+                    else:
+                        self._reporter.maybe_report()
+                if done:
+                    return
+        except Exception:
+            log.error("flush task failed", exc_info=True)
+        finally:
+            self._stopped.set()
+
+    @asyncio.coroutine
+    def _flush(self):
+        """Send the queued traces, returning the number of the queue pop"""
+        traces = self._trace_queue.pop()
+        pop = self._trace_queue.pops
+        self._metrics.gauge('queue.depth', len(traces) if traces else 0)
+        if not traces:
+            return pop
+
+        start = time.time()
+        try:
+            traces = self._apply_filters(traces)
+        except Exception as err:
+            log.error("error while filtering traces:{0}".format(err))
+        self._metrics.timing('loop.time', time.time() - start)
+        if not traces:
+            return pop
+
+        try:
+            if self._encoded:
+                response = yield from self.api.send_traces(traces, encoded=True)
+            else:
+                response = yield from self.api.send_traces(traces)
+        except _REQUEST_ERRORS as err:
+            # DEV: the API records the traces of the payloads it fails to send
+            log.error("cannot send spans to {1}: {0}".format(err, self.api))
+        except Exception as err:
+            log.error("cannot send spans to {1}: {0}".format(err, self.api))
+            self._metrics.increment('traces.failed', len(traces))
+        else:
+            self._process_response(response)
+        return pop
+
+
+class AsyncioWriter(AgentWriter):
+    """
+    ``AgentWriter`` sending traces from a ``Task`` running on an ``asyncio``
+    event loop, with non-blocking sockets.
+
+    When ``loop`` is given, the flush task runs on it: the traces are encoded
+    on the loop, in slices of at most ``max_blocking_time`` seconds, and the
+    time spent on the loop is recorded in the ``loop.time`` metric returned by
+    ``stats()``. Otherwise, a dedicated event loop is run in a background
+    thread.
+
+    Traces are flushed every ``flush_interval`` seconds, or as soon as
+    ``flush_min_traces`` traces or ``flush_min_bytes`` bytes are queued, and
+    the spool isn't supported. The other options are the ones of
+    ``AgentWriter``.
+    """
+    def __init__(self, hostname='localhost', port=8126, uds_path=None, loop=None,
+                 max_blocking_time=DEFAULT_MAX_BLOCKING_TIME, **kwargs):
+        self._loop = loop
+        self._loop_thread = None
+        self._max_blocking_time = max_blocking_time
+        super(AsyncioWriter, self).__init__(hostname, port, uds_path=uds_path, **kwargs)
+
+    def _create_api(self, hostname, port, **kwargs):
+        return AsyncioAPI(hostname, port, max_blocking_time=self._max_blocking_time, **kwargs)
+
+    def _create_worker(self, **kwargs):
+        return AsyncioWorker(self.api, self._traces, self._get_loop(), **kwargs)
+
+    def _get_loop(self):
+        if self._loop is not None and (self._loop_thread is None or self._loop_thread.is_alive()):
+            return self._loop
+
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self._run_loop, args=(loop, ))
+        thread.setDaemon(True)
+        thread.start()
+        self._loop = loop
+        self._loop_thread = thread
+        return loop
+
+    @staticmethod
+    def _run_loop(loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    def _after_fork_in_child(self):
+        super(AsyncioWriter, self)._after_fork_in_child()
+        if self._loop_thread is not None:
+            # the loop thread didn't survive the fork, start a new one on next write
+            self._loop = None
+            self._loop_thread = None
@@ -8,13 +8,14 @@ from ddtrace.vendor.wrapt import ObjectProxy
 
 # project
 import ddtrace
-from ...compat import iteritems
+from ...compat import iteritems, stringify
 from ...constants import ANALYTICS_SAMPLE_RATE_KEY
 from ...ext import AppTypes
 from ...ext import mongo as mongox
 from ...ext import net as netx
 from ...internal.logger import get_logger
 from ...settings import config
+from ...span import LazyTag
 from ...utils.deprecation import deprecated
 from .parse import parse_spec, parse_query, parse_msg
 
@@ -253,9 +254,13 @@ def _set_address_tags(span, address):
 
 def _set_query_metadata(span, cmd):
     """ Sets span `mongodb.query` tag and resource given command query """
+    # DEV: the spans of the traces dropped by the sampler are never sent
+    if not span.sampled:
+        return
     if cmd.query:
         nq = normalize_filter(cmd.query)
-        span.set_tag('mongodb.query', nq)
+        # DEV: the normalized query is only stringified if the span is encoded
+        span.set_tag('mongodb.query', LazyTag(stringify, nq))
         # needed to dump json so we don't get unicode
         # dict keys like {u'foo':'bar'}
         q = json.dumps(nq)
@@ -63,18 +63,20 @@ def traced_execute_command(func, instance, args, kwargs):
         return func(*args, **kwargs)
 
     with pin.tracer.trace(redisx.CMD, service=pin.service, span_type=redisx.TYPE) as s:
-        query = format_command_args(args)
-        s.resource = query
-        s.set_tag(redisx.RAWCMD, query)
-        if pin.tags:
-            s.set_tags(pin.tags)
-        s.set_tags(_get_tags(instance))
-        s.set_metric(redisx.ARGS_LEN, len(args))
-        # set analytics sample rate if enabled
-        s.set_tag(
-            ANALYTICS_SAMPLE_RATE_KEY,
-            config.redis.get_analytics_sample_rate()
-        )
+        # DEV: the spans of the traces dropped by the sampler are never sent
+        if s.sampled:
+            query = format_command_args(args)
+            s.resource = query
+            s.set_tag(redisx.RAWCMD, query)
+            if pin.tags:
+                s.set_tags(pin.tags)
+            s.set_tags(_get_tags(instance))
+            s.set_metric(redisx.ARGS_LEN, len(args))
+            # set analytics sample rate if enabled
+            s.set_tag(
+                ANALYTICS_SAMPLE_RATE_KEY,
+                config.redis.get_analytics_sample_rate()
+            )
         # run the command
         return func(*args, **kwargs)
 
@@ -1,24 +1,26 @@
 import json
 import struct
+import threading
 
+from .compat import string_type, to_unicode
+from .internal import packer
 from .internal.logger import get_logger
 
 
-# check msgpack CPP implementation; if the import fails, we're using the
-# pure Python implementation that is really slow, so the ``Encoder`` should use
-# a different encoding format.
+# check msgpack CPP implementation; if the import fails, we're using our own
+# pure Python packer, specialized for spans. On CPython it is slower than the
+# CPP implementation, and slightly slower than the JSON encoder.
 try:
-    import msgpack
     from msgpack._packer import Packer  # noqa
     from msgpack._unpacker import unpack, unpackb, Unpacker  # noqa
     from msgpack._version import version
     # use_bin_type kwarg only exists since msgpack-python v0.4.0
     MSGPACK_PARAMS = {'use_bin_type': True} if version >= (0, 4, 0) else {}
-    MSGPACK_ENCODING = True
+    MSGPACK_CPP = True
 except ImportError:
-    # fallback to JSON
+    from .internal.packer import Packer, unpackb  # noqa
     MSGPACK_PARAMS = {}
-    MSGPACK_ENCODING = False
+    MSGPACK_CPP = False
 
 log = get_logger(__name__)
 
@@ -76,6 +78,25 @@ class Encoder(object):
         """Helper used to join a list of encoded objects into an encoded list of objects"""
         raise NotImplementedError
 
+    def join_encoded_chunks(self, objs):
+        """
+        Same as ``join_encoded()``, but return the encoded list of objects as a
+        list of buffers, to be written one after the other. Encoders that can
+        return the encoded objects as they are, without copying them into a
+        single buffer, override it.
+        """
+        return [self.join_encoded(objs)]
+
+    # Number of bytes of the data shared by all the traces of a payload (e.g. a string table)
+    shared_size = 0
+
+    def payload_encoder(self):
+        """
+        Return the encoder to use for a new payload. Encoders keeping a state
+        for the whole payload return a new instance, the others return themselves.
+        """
+        return self
+
 
 class JSONEncoder(Encoder):
     def __init__(self):
@@ -95,38 +116,229 @@ class JSONEncoder(Encoder):
 
 
 class MsgpackEncoder(Encoder):
+    """
+    Encode traces with msgpack.
+
+    Each span is still converted to a dict, in the same layout as
+    ``Span.to_dict()``, but the dict is built from the span attributes without
+    going through ``to_dict()`` and its properties, and each thread packs its
+    traces with its own reusable ``Packer``. This is only slightly faster than
+    packing the ``to_dict()`` representation of the spans (up to 20% on
+    ``benchmark_encoder()``).
+    """
     def __init__(self):
         log.debug('using Msgpack encoder')
         self.content_type = 'application/msgpack'
+        self._local = threading.local()
+
+    def _get_packer(self):
+        packer = getattr(self._local, 'packer', None)
+        if packer is None:
+            packer = self._local.packer = Packer()
+        return packer
+
+    def encode_traces(self, traces):
+        return self._get_packer().pack([[_span_to_dict(span) for span in trace] for trace in traces])
+
+    def encode_trace(self, trace):
+        return self._get_packer().pack([_span_to_dict(span) for span in trace])
 
     def encode(self, obj):
-        return msgpack.packb(obj)
+        return self._get_packer().pack(obj)
 
     def decode(self, data):
-        return msgpack.unpackb(data)
+        return unpackb(data)
 
     def join_encoded(self, objs):
         """Join a list of encoded objects together as a msgpack array"""
-        buf = b''.join(objs)
+        return b''.join(self.join_encoded_chunks(objs))
+
+    def join_encoded_chunks(self, objs):
+        """Return the msgpack array header followed by the encoded objects"""
+        chunks = [_array_header(len(objs))]
+        chunks.extend(objs)
+        return chunks
+
+
+class PythonMsgpackEncoder(MsgpackEncoder):
+    """
+    Encode traces with the pure Python msgpack packer of ``ddtrace.internal.packer``.
+
+    Used when the msgpack C extension isn't available: spans are written directly
+    into the payload rather than converted to dicts first.
+
+    DEV: it doesn't encode faster than the JSON encoder it replaces: on CPython
+         it is up to 25% slower (see ``benchmark_python_encoder()``), and it
+         hasn't been measured on PyPy yet. It is used for its payloads, about a third
+         smaller, and so that the msgpack only features (e.g. the v0.5 API)
+         are available
+    """
+    def __init__(self):
+        super(PythonMsgpackEncoder, self).__init__()
+        self._packer = packer.Packer()
+
+    def _get_packer(self):
+        # DEV: the pure Python packer has no state, it can be shared by all the threads
+        return self._packer
+
+    def encode_traces(self, traces):
+        return self._packer.pack_traces(traces)
+
+    def encode_trace(self, trace):
+        return self._packer.pack_trace(trace)
 
-        # Prepend array header to buffer
-        # https://github.com/msgpack/msgpack-python/blob/f46523b1af7ff2d408da8500ea36a4f9f2abe915/msgpack/fallback.py#L948-L955
-        count = len(objs)
-        if count <= 0xf:
-            return struct.pack('B', 0x90 + count) + buf
-        elif count <= 0xffff:
-            return struct.pack('>BH', 0xdc, count) + buf
-        else:
-            return struct.pack('>BI', 0xdd, count) + buf
+
+class MsgpackStringTableEncoder(MsgpackEncoder):
+    """
+    Encode traces with msgpack in the v0.5 format of the trace agent.
+
+    Strings are stored once per payload in a string table, and spans reference
+    them by index. The payload is ``[strings, traces]``, each span being the
+    array ``[service, name, resource, trace_id, span_id, parent_id, start,
+    duration, error, meta, metrics, type]``.
+
+    The string table is shared by all the traces encoded with the same
+    instance: a new instance is used for each payload, and its traces can't be
+    joined with the ones of another instance.
+
+    Payloads are about 4 times smaller than with ``MsgpackEncoder``, but
+    looking the strings up in the table takes about twice as much CPU (see
+    ``benchmark_string_table_encoder()``): this trades CPU for bandwidth, and
+    the v0.4 API remains the default.
+    """
+    def __init__(self):
+        super(MsgpackStringTableEncoder, self).__init__()
+        self._packer = Packer()
+        self._table = {'': 0}
+        self._strings = [self._packer.pack('')]
+        self.shared_size = len(self._strings[0])
+
+    def payload_encoder(self):
+        return MsgpackStringTableEncoder()
+
+    def _index(self, s):
+        """Return the index of the given string in the table, adding it if needed"""
+        if not s:
+            return 0
+        try:
+            return self._table[s]
+        except KeyError:
+            pass
+        if not isinstance(s, string_type):
+            return self._index(to_unicode(s))
+
+        index = self._table[s] = len(self._strings)
+        packed = self._packer.pack(s)
+        self._strings.append(packed)
+        self.shared_size += len(packed)
+        return index
+
+    def encode_traces(self, traces):
+        return self.join_encoded([self.encode_trace(trace) for trace in traces])
+
+    def encode_trace(self, trace):
+        index = self._index
+        spans = []
+        for span in trace:
+            if span._lazy_meta:
+                span._format_lazy_meta()
+            error = span.error
+            spans.append([
+                index(span.service),
+                index(span.name),
+                index(span.resource),
+                span.trace_id,
+                span.span_id,
+                span.parent_id or 0,
+                span.start_ns or 0,
+                span.duration_ns or 0,
+                1 if error and type(error) == bool else error,
+                {index(k): index(v) for k, v in (span._meta or {}).items()},
+                {index(k): v for k, v in (span._metrics or {}).items()},
+                index(span.span_type),
+            ])
+        return self._packer.pack(spans)
+
+    def decode(self, data):
+        """Decode a payload, replacing the string indexes of the spans by their values"""
+        strings, traces = unpackb(data)
+        return [[_decode_span(strings, span) for span in trace] for trace in traces]
+
+    def join_encoded_chunks(self, objs):
+        """Return the string table followed by the list of traces encoded with this instance"""
+        chunks = [
+            b'\x92',  # array of 2 elements
+            _array_header(len(self._strings)),
+        ]
+        chunks.extend(self._strings)
+        chunks.extend(super(MsgpackStringTableEncoder, self).join_encoded_chunks(objs))
+        return chunks
+
+
+def _decode_span(strings, span):
+    service, name, resource, trace_id, span_id, parent_id, start, duration, error, meta, metrics, span_type = span
+    return [
+        strings[service], strings[name], strings[resource], trace_id, span_id, parent_id, start, duration, error,
+        {strings[k]: strings[v] for k, v in meta.items()},
+        {strings[k]: v for k, v in metrics.items()},
+        strings[span_type],
+    ]
+
+
+def _array_header(count):
+    # https://github.com/msgpack/msgpack-python/blob/f46523b1af7ff2d408da8500ea36a4f9f2abe915/msgpack/fallback.py#L948-L955
+    if count <= 0xf:
+        return struct.pack('B', 0x90 + count)
+    elif count <= 0xffff:
+        return struct.pack('>BH', 0xdc, count)
+    else:
+        return struct.pack('>BI', 0xdd, count)
+
+
+def _span_to_dict(span):
+    """
+    Same as ``Span.to_dict()``, inlined for the encoders.
+
+    DEV: packing the spans attributes one by one with ``Packer.pack_map_header()``
+         and ``Packer.pack()`` is about 3 times slower than building a dict packed
+         in a single call by the msgpack C extension, see ``benchmark_encoder()``
+    """
+    if span._lazy_meta:
+        span._format_lazy_meta()
+    error = span.error
+    d = {
+        'trace_id': span.trace_id,
+        'parent_id': span.parent_id,
+        'span_id': span.span_id,
+        'service': span.service,
+        'resource': span.resource,
+        'name': span.name,
+        # DEV: see ``Span.to_dict()``, the error field must be an int
+        'error': 1 if error and type(error) == bool else error,
+    }
+    start = span.start_ns
+    if start:
+        d['start'] = start
+    duration = span.duration_ns
+    if duration:
+        d['duration'] = duration
+    # DEV: read the tags dicts directly, the ``meta`` and ``metrics`` properties allocate them
+    if span._meta:
+        d['meta'] = span._meta
+    if span._metrics:
+        d['metrics'] = span._metrics
+    if span.span_type:
+        d['type'] = span.span_type
+    return d
 
 
 def get_encoder():
     """
     Switching logic that choose the best encoder for the API transport.
-    The default behavior is to use Msgpack if we have a CPP implementation
-    installed, falling back to the Python built-in JSON encoder.
+    The default behavior is to use Msgpack, with the CPP implementation if it is
+    installed or our pure Python packer otherwise.
     """
-    if MSGPACK_ENCODING:
+    if MSGPACK_CPP:
         return MsgpackEncoder()
     else:
-        return JSONEncoder()
+        return PythonMsgpackEncoder()
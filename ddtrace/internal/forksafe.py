@@ -0,0 +1,81 @@
+"""
+Run hooks around ``os.fork()``.
+
+On Python 3.7+ the hooks are called through ``os.register_at_fork``. Older
+versions provide no such mechanism: ``SUPPORTED`` is then ``False`` and the
+callers must detect forks on their own, e.g. by noticing that their threads
+did not survive the fork.
+"""
+import os
+import weakref
+
+from .logger import get_logger
+
+log = get_logger(__name__)
+
+
+SUPPORTED = hasattr(os, 'register_at_fork')
+
+_before = []
+_after_in_child = []
+_after_in_parent = []
+
+
+def _ref(hook):
+    # DEV: bound methods are referenced weakly so that registering them does
+    #      not keep their instance alive forever
+    if getattr(hook, '__self__', None) is not None:
+        return weakref.WeakMethod(hook)
+    return lambda: hook
+
+
+def register(before=None, after_in_child=None, after_in_parent=None):
+    """
+    Register hooks to call before a fork, and after a fork in the child or the
+    parent process. Bound methods are held through weak references.
+
+    Does nothing if ``os.register_at_fork`` isn't available.
+    """
+    if not SUPPORTED:
+        return
+
+    if before is not None:
+        _before.append(_ref(before))
+    if after_in_child is not None:
+        _after_in_child.append(_ref(after_in_child))
+    if after_in_parent is not None:
+        _after_in_parent.append(_ref(after_in_parent))
+
+
+def _run(hooks, reverse=False):
+    for ref in (list(reversed(hooks)) if reverse else list(hooks)):
+        hook = ref()
+        if hook is None:
+            hooks.remove(ref)
+            continue
+
+        try:
+            hook()
+        except Exception:
+            log.exception('error while running fork hook %r', hook)
+
+
+def _run_before():
+    # DEV: the hooks registered last run first, like ``os.register_at_fork``
+    _run(_before, reverse=True)
+
+
+def _run_after_in_child():
+    _run(_after_in_child)
+
+
+def _run_after_in_parent():
+    _run(_after_in_parent)
+
+
+if SUPPORTED:
+    os.register_at_fork(
+        before=_run_before,
+        after_in_child=_run_after_in_child,
+        after_in_parent=_run_after_in_parent,
+    )
@@ -0,0 +1,156 @@
+import socket
+import threading
+import time
+
+from .logger import get_logger
+
+log = get_logger(__name__)
+
+
+class HealthMetrics(object):
+    """
+    Thread-safe counters, gauges and timers describing the health of the tracer.
+
+    Counters and timers are cumulative since the creation of the instance,
+    gauges hold the last value set.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        # name -> [count, total, max]
+        self._timers = {}
+
+    def increment(self, name, value=1):
+        """
+        Increment the given counter
+
+        :param str name: The name of the counter
+        :param int value: The value to add to the counter
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """
+        Set the value of the given gauge
+
+        :param str name: The name of the gauge
+        :param value: The new value of the gauge
+        """
+        with self._lock:
+            self._gauges[name] = value
+
+    def timing(self, name, duration):
+        """
+        Record a duration for the given timer
+
+        :param str name: The name of the timer
+        :param float duration: The duration, in seconds
+        """
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                self._timers[name] = [1, duration, duration]
+            else:
+                timer[0] += 1
+                timer[1] += duration
+                if duration > timer[2]:
+                    timer[2] = duration
+
+    def collect(self):
+        """
+        Return copies of the counters, gauges and timers. Timers are
+        ``(count, total, max)`` tuples of durations in seconds.
+
+        :rtype: tuple
+        """
+        with self._lock:
+            timers = dict((name, tuple(timer)) for name, timer in self._timers.items())
+            return dict(self._counters), dict(self._gauges), timers
+
+    def snapshot(self):
+        """
+        Return the current values of all the metrics as a flat ``dict``. Timers
+        are reported as ``<name>.count``, ``<name>.total`` and ``<name>.max``,
+        in seconds.
+
+        :rtype: dict
+        """
+        counters, gauges, timers = self.collect()
+        stats = counters
+        stats.update(gauges)
+        for name, (count, total, max_) in timers.items():
+            stats[name + '.count'] = count
+            stats[name + '.total'] = total
+            stats[name + '.max'] = max_
+        return stats
+
+
+class DogStatsdReporter(object):
+    """
+    Periodically send ``HealthMetrics`` to a DogStatsD server over UDP.
+
+    Counters are sent as the increase since the previous report, gauges as
+    their current value and timers as the average duration, in milliseconds,
+    of the operations timed since the previous report.
+    """
+    def __init__(self, metrics, hostname='localhost', port=8125, interval=10, prefix='datadog.tracer', tags=None):
+        """
+        :param metrics: The metrics to report
+        :type metrics: ``HealthMetrics``
+        :param str hostname: The DogStatsD server hostname
+        :param int port: The DogStatsD server port
+        :param float interval: The minimum time, in seconds, between two reports
+        :param str prefix: The prefix of all the metric names
+        :param list tags: ``key:value`` tags added to all the metrics
+        """
+        self.metrics = metrics
+        self.hostname = hostname
+        self.port = port
+        self.interval = interval
+        self.prefix = prefix
+        self.tags = tags or []
+        self._last_report = time.time()
+        self._last_counters = {}
+        self._last_timers = {}
+        self._sock = None
+
+    def maybe_report(self):
+        """Report the metrics if the last report is older than ``interval``"""
+        if time.time() - self._last_report >= self.interval:
+            self.report()
+
+    def report(self):
+        """Send the metrics to the DogStatsD server"""
+        self._last_report = time.time()
+        counters, gauges, timers = self.metrics.collect()
+        lines = self._format(counters, gauges, timers)
+        self._last_counters = counters
+        self._last_timers = timers
+        if not lines:
+            return
+
+        try:
+            if self._sock is None:
+                self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self._sock.setblocking(0)
+            self._sock.sendto('\n'.join(lines).encode('utf-8'), (self.hostname, self.port))
+        except socket.error as err:
+            log.debug('cannot send health metrics to dogstatsd at %s:%s: %s', self.hostname, self.port, err)
+
+    def _format(self, counters, gauges, timers):
+        tags = '|#' + ','.join(self.tags) if self.tags else ''
+        lines = []
+        for name, value in sorted(counters.items()):
+            delta = value - self._last_counters.get(name, 0)
+            if delta:
+                lines.append('{0}.{1}:{2}|c{3}'.format(self.prefix, name, delta, tags))
+        for name, value in sorted(gauges.items()):
+            lines.append('{0}.{1}:{2}|g{3}'.format(self.prefix, name, value, tags))
+        for name, (count, total, _) in sorted(timers.items()):
+            last_count, last_total, _ = self._last_timers.get(name, (0, 0, 0))
+            if count > last_count:
+                average = (total - last_total) * 1000.0 / (count - last_count)
+                lines.append('{0}.{1}:{2:.3f}|ms{3}'.format(self.prefix, name, average, tags))
+        return lines
@@ -0,0 +1,83 @@
+"""
+Generate the random 64-bit ids of traces and spans.
+
+Ids are unpacked in batches from ``os.urandom`` blocks, instead of drawing
+them one by one from the global ``random`` instance, that is shared with the
+application and is not reseeded after a fork on Python < 3.7. The ids left in
+a batch are discarded in the child process of a fork so that prefork workers
+never share ids.
+"""
+import os
+import random
+import struct
+
+from . import forksafe
+
+
+class IDGenerator(object):
+    """
+    Generate random 64-bit ids, ``batch_size`` ids at a time.
+
+    Ids are taken from a per-process state: the batch is dropped after a fork,
+    through the ``forksafe`` hooks or, when they are not supported, by
+    checking the current pid for each id.
+    """
+    def __init__(self, batch_size=512):
+        """
+        :param int batch_size: The number of ids generated at a time
+        """
+        self._batch = struct.Struct('<{0}Q'.format(batch_size))
+        self._ids = []
+        self._random = None
+        self._pid = os.getpid()
+        if forksafe.SUPPORTED:
+            forksafe.register(after_in_child=self._reset)
+        else:
+            self.new_id = self._new_id_checking_pid
+
+    def new_id(self):
+        """Return a new random 64-bit id"""
+        try:
+            return self._ids.pop()
+        except IndexError:
+            return self._refill()
+
+    def seed(self, value):
+        """
+        Generate the ids with a pseudo-random generator seeded with ``value``
+        instead of ``os.urandom``, to get the same ids on each run. The
+        generator is seeded again from ``os.urandom`` after a fork.
+
+        :param value: The seed of the generator
+        """
+        self._random = random.Random(value)
+        self._ids = []
+
+    def _new_id_checking_pid(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._reset()
+        try:
+            return self._ids.pop()
+        except IndexError:
+            return self._refill()
+
+    def _refill(self):
+        if self._random is None:
+            ids = list(self._batch.unpack(os.urandom(self._batch.size)))
+        else:
+            getrandbits = self._random.getrandbits
+            ids = [getrandbits(64) for _ in range(self._batch.size // 8)]
+        # DEV: a batch generated concurrently by another thread may be replaced,
+        #      its ids are lost but never returned twice
+        new_id = ids.pop()
+        self._ids = ids
+        return new_id
+
+    def _reset(self):
+        self._ids = []
+        self._random = None
+
+
+id_generator = IDGenerator()
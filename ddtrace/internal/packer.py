@@ -0,0 +1,403 @@
+"""
+Pure Python msgpack packer used when the msgpack C extension isn't available.
+
+It only supports the types found in traces (``None``, ``bool``, integers,
+floats, strings, lists, tuples and dicts) and produces the same bytes as
+the default ``msgpack.Packer`` (strings and bytes are packed as raw strings,
+floats as doubles). ``Packer.pack_trace()`` writes the spans directly into a
+buffer without building their dict representation first.
+"""
+import struct
+
+from ..compat import PY2
+
+
+if PY2:
+    _TEXT_TYPE = unicode  # noqa: F821
+    _INT_TYPES = (int, long)  # noqa: F821
+else:
+    _TEXT_TYPE = str
+    _INT_TYPES = (int, )
+
+_BYTE = struct.Struct('>B').pack
+_UINT8 = struct.Struct('>BB').pack
+_UINT16 = struct.Struct('>BH').pack
+_UINT32 = struct.Struct('>BI').pack
+_UINT64 = struct.Struct('>BQ').pack
+_INT8 = struct.Struct('>Bb').pack
+_INT16 = struct.Struct('>Bh').pack
+_INT32 = struct.Struct('>Bi').pack
+_INT64 = struct.Struct('>Bq').pack
+_DOUBLE = struct.Struct('>Bd').pack
+
+
+def _key(name):
+    """Return the packed representation of the given span field name"""
+    return _BYTE(0xa0 | len(name)) + name.encode('ascii')
+
+
+_TRACE_ID = _key('trace_id')
+_PARENT_ID = _key('parent_id')
+_SPAN_ID = _key('span_id')
+_SERVICE = _key('service')
+_RESOURCE = _key('resource')
+_NAME = _key('name')
+_ERROR = _key('error')
+_START = _key('start')
+_DURATION = _key('duration')
+_META = _key('meta')
+_METRICS = _key('metrics')
+_TYPE = _key('type')
+
+
+class Packer(object):
+    """
+    Serialize objects with msgpack, with the same ``pack()`` interface as the
+    ``Packer`` of the msgpack C extension.
+
+    The packed representation of the strings of the spans is cached: services,
+    names, resources and tags are mostly the same from one trace to another.
+    """
+    # Maximum number of packed strings kept in the cache
+    MAX_CACHED_STRINGS = 4096
+
+    def __init__(self):
+        self._strings = {None: b'\xc0'}
+
+    def pack(self, obj):
+        """
+        Return the msgpack representation of the given object
+
+        :param obj: The object to pack
+        :rtype: bytes
+        """
+        buf = bytearray()
+        self._pack(obj, buf)
+        return bytes(buf)
+
+    def pack_trace(self, trace):
+        """
+        Return the msgpack representation of the given trace, in the same
+        layout as its spans ``Span.to_dict()``
+
+        :param list trace: The spans of the trace
+        :rtype: bytes
+        """
+        buf = bytearray()
+        try:
+            self._pack_trace(trace, buf)
+        except TypeError:
+            # DEV: unhashable values can't be looked up in the strings cache,
+            #      pack the spans from their dict, which raises for the values
+            #      that can't be serialized at all
+            return self.pack([span.to_dict() for span in trace])
+        return bytes(buf)
+
+    def pack_traces(self, traces):
+        """
+        Return the msgpack representation of the given list of traces
+
+        :param list traces: The traces, each of them being a list of spans
+        :rtype: bytes
+        """
+        buf = bytearray()
+        _pack_array_header(len(traces), buf)
+        for trace in traces:
+            buf += self.pack_trace(trace)
+        return bytes(buf)
+
+    def _pack_string(self, obj):
+        """Return the packed representation of a value of the spans, caching it for strings"""
+        obj_type = type(obj)
+        if obj_type is _TEXT_TYPE:
+            packed = _raw(obj.encode('utf-8'))
+        elif obj_type is bytes:
+            packed = _raw(obj)
+        else:
+            return self.pack(obj)
+
+        strings = self._strings
+        if len(strings) >= self.MAX_CACHED_STRINGS:
+            strings.clear()
+            strings[None] = b'\xc0'
+        strings[obj] = packed
+        return packed
+
+    def _pack_trace(self, trace, buf):
+        pack = self._pack
+        get = self._strings.get
+        pack_string = self._pack_string
+        uint64 = _UINT64
+        _pack_array_header(len(trace), buf)
+        for span in trace:
+            # DEV: the fixmap header can hold up to 15 fields, spans have at most 12,
+            #      its size is set once the optional fields are written
+            header = len(buf)
+            buf.append(0x87)
+            # DEV: ids and timestamps in ns are mostly 64 bits integers, check for it inline
+            buf += _TRACE_ID
+            value = span.trace_id
+            if type(value) in _INT_TYPES and 0xffffffff < value <= 0xffffffffffffffff:
+                buf += uint64(0xcf, value)
+            else:
+                pack(value, buf)
+            buf += _PARENT_ID
+            value = span.parent_id
+            if type(value) in _INT_TYPES and 0xffffffff < value <= 0xffffffffffffffff:
+                buf += uint64(0xcf, value)
+            else:
+                pack(value, buf)
+            buf += _SPAN_ID
+            value = span.span_id
+            if type(value) in _INT_TYPES and 0xffffffff < value <= 0xffffffffffffffff:
+                buf += uint64(0xcf, value)
+            else:
+                pack(value, buf)
+            buf += _SERVICE
+            value = span.service
+            buf += get(value) or pack_string(value)
+            buf += _RESOURCE
+            value = span.resource
+            buf += get(value) or pack_string(value)
+            buf += _NAME
+            value = span.name
+            buf += get(value) or pack_string(value)
+            buf += _ERROR
+            value = span.error
+            if type(value) is int and 0 <= value <= 0x7f:
+                buf.append(value)
+            else:
+                # DEV: see ``Span.to_dict()``, the error field must be an int
+                pack(1 if value and type(value) == bool else value, buf)
+
+            size = 0x87
+            value = span.start_ns
+            if value:
+                size += 1
+                buf += _START
+                if type(value) in _INT_TYPES and 0xffffffff < value <= 0xffffffffffffffff:
+                    buf += uint64(0xcf, value)
+                else:
+                    pack(value, buf)
+            value = span.duration_ns
+            if value:
+                size += 1
+                buf += _DURATION
+                pack(value, buf)
+            if span._lazy_meta:
+                span._format_lazy_meta()
+            value = span._meta
+            if value:
+                size += 1
+                buf += _META
+                _pack_map_header(len(value), buf)
+                for key, value in value.items():
+                    buf += get(key) or pack_string(key)
+                    buf += get(value) or pack_string(value)
+            value = span._metrics
+            if value:
+                size += 1
+                buf += _METRICS
+                _pack_map_header(len(value), buf)
+                for key, value in value.items():
+                    buf += get(key) or pack_string(key)
+                    pack(value, buf)
+            value = span.span_type
+            if value:
+                size += 1
+                buf += _TYPE
+                buf += get(value) or pack_string(value)
+            buf[header] = size
+
+    def _pack(self, obj, buf):
+        # DEV: the types are checked in the order of their frequency in traces
+        obj_type = type(obj)
+        if obj_type is _TEXT_TYPE:
+            _pack_raw(obj.encode('utf-8'), buf)
+        elif obj_type is bytes:
+            _pack_raw(obj, buf)
+        elif obj_type is bool:
+            buf.append(0xc3 if obj else 0xc2)
+        elif obj_type in _INT_TYPES:
+            _pack_int(obj, buf)
+        elif obj_type is float:
+            buf += _DOUBLE(0xcb, obj)
+        elif obj is None:
+            buf.append(0xc0)
+        elif obj_type is dict:
+            _pack_map_header(len(obj), buf)
+            pack = self._pack
+            for key, value in obj.items():
+                pack(key, buf)
+                pack(value, buf)
+        elif obj_type is list or obj_type is tuple:
+            _pack_array_header(len(obj), buf)
+            pack = self._pack
+            for item in obj:
+                pack(item, buf)
+        # subclasses of the supported types
+        elif isinstance(obj, _TEXT_TYPE):
+            _pack_raw(obj.encode('utf-8'), buf)
+        elif isinstance(obj, bytes):
+            _pack_raw(obj, buf)
+        elif isinstance(obj, _INT_TYPES):
+            _pack_int(obj, buf)
+        elif isinstance(obj, float):
+            buf += _DOUBLE(0xcb, obj)
+        elif isinstance(obj, dict):
+            self._pack(dict(obj), buf)
+        elif isinstance(obj, (list, tuple)):
+            self._pack(list(obj), buf)
+        else:
+            raise TypeError('cannot serialize {!r} object'.format(obj_type.__name__))
+
+
+def _pack_raw(data, buf):
+    n = len(data)
+    if n <= 0x1f:
+        buf.append(0xa0 | n)
+    elif n <= 0xffff:
+        buf += _UINT16(0xda, n)
+    elif n <= 0xffffffff:
+        buf += _UINT32(0xdb, n)
+    else:
+        raise ValueError('string is too large')
+    buf += data
+
+
+def _raw(data):
+    buf = bytearray()
+    _pack_raw(data, buf)
+    return bytes(buf)
+
+
+def _pack_int(obj, buf):
+    if 0 <= obj:
+        if obj <= 0x7f:
+            buf.append(obj)
+        elif obj <= 0xff:
+            buf += _UINT8(0xcc, obj)
+        elif obj <= 0xffff:
+            buf += _UINT16(0xcd, obj)
+        elif obj <= 0xffffffff:
+            buf += _UINT32(0xce, obj)
+        elif obj <= 0xffffffffffffffff:
+            buf += _UINT64(0xcf, obj)
+        else:
+            raise OverflowError('integer out of range')
+    elif -0x20 <= obj:
+        buf.append(obj & 0xff)
+    elif -0x80 <= obj:
+        buf += _INT8(0xd0, obj)
+    elif -0x8000 <= obj:
+        buf += _INT16(0xd1, obj)
+    elif -0x80000000 <= obj:
+        buf += _INT32(0xd2, obj)
+    elif -0x8000000000000000 <= obj:
+        buf += _INT64(0xd3, obj)
+    else:
+        raise OverflowError('integer out of range')
+
+
+def _pack_array_header(n, buf):
+    if n <= 0xf:
+        buf.append(0x90 | n)
+    elif n <= 0xffff:
+        buf += _UINT16(0xdc, n)
+    else:
+        buf += _UINT32(0xdd, n)
+
+
+def _pack_map_header(n, buf):
+    if n <= 0xf:
+        buf.append(0x80 | n)
+    elif n <= 0xffff:
+        buf += _UINT16(0xde, n)
+    else:
+        buf += _UINT32(0xdf, n)
+
+
+# (struct format, size) of the fixed size types
+_FIXED = {
+    0xca: ('>f', 4),
+    0xcb: ('>d', 8),
+    0xcc: ('>B', 1),
+    0xcd: ('>H', 2),
+    0xce: ('>I', 4),
+    0xcf: ('>Q', 8),
+    0xd0: ('>b', 1),
+    0xd1: ('>h', 2),
+    0xd2: ('>i', 4),
+    0xd3: ('>q', 8),
+}
+
+# struct format of the length of the variable size types
+_RAW = {0xc4: '>B', 0xc5: '>H', 0xc6: '>I', 0xd9: '>B', 0xda: '>H', 0xdb: '>I'}
+_ARRAY = {0xdc: '>H', 0xdd: '>I'}
+_MAP = {0xde: '>H', 0xdf: '>I'}
+
+
+def unpackb(data):
+    """
+    Deserialize the given msgpack data. Strings are returned as bytes, like
+    the default ``msgpack.unpackb()``.
+
+    :param bytes data: The data to deserialize
+    """
+    obj, offset = _unpack(bytearray(data), 0)
+    if offset != len(data):
+        raise ValueError('extra data')
+    return obj
+
+
+def _unpack(data, offset):
+    b = data[offset]
+    offset += 1
+    if b <= 0x7f:
+        return b, offset
+    elif b >= 0xe0:
+        return b - 0x100, offset
+    elif 0xa0 <= b <= 0xbf:
+        end = offset + (b & 0x1f)
+        return bytes(data[offset:end]), end
+    elif 0x90 <= b <= 0x9f:
+        return _unpack_array(data, offset, b & 0x0f)
+    elif 0x80 <= b <= 0x8f:
+        return _unpack_map(data, offset, b & 0x0f)
+    elif b == 0xc0:
+        return None, offset
+    elif b == 0xc2:
+        return False, offset
+    elif b == 0xc3:
+        return True, offset
+    elif b in _FIXED:
+        fmt, size = _FIXED[b]
+        return struct.unpack_from(fmt, data, offset)[0], offset + size
+    elif b in _RAW:
+        fmt = _RAW[b]
+        n = struct.unpack_from(fmt, data, offset)[0]
+        offset += struct.calcsize(fmt)
+        return bytes(data[offset:offset + n]), offset + n
+    elif b in _ARRAY:
+        fmt = _ARRAY[b]
+        return _unpack_array(data, offset + struct.calcsize(fmt), struct.unpack_from(fmt, data, offset)[0])
+    elif b in _MAP:
+        fmt = _MAP[b]
+        return _unpack_map(data, offset + struct.calcsize(fmt), struct.unpack_from(fmt, data, offset)[0])
+    raise ValueError('unsupported msgpack type 0x{:02x}'.format(b))
+
+
+def _unpack_array(data, offset, n):
+    items = []
+    for _ in range(n):
+        item, offset = _unpack(data, offset)
+        items.append(item)
+    return items, offset
+
+
+def _unpack_map(data, offset, n):
+    obj = {}
+    for _ in range(n):
+        key, offset = _unpack(data, offset)
+        obj[key], offset = _unpack(data, offset)
+    return obj, offset
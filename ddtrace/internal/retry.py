@@ -0,0 +1,56 @@
+import random
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff retry policy with jitter.
+
+    The wait before the retry ``n`` (starting at 0) is picked randomly in
+    ``[(1 - jitter) * wait, wait]`` where ``wait`` is
+    ``min(max_wait, initial_wait * multiplier ** n)``, so that processes
+    failing at the same time don't retry all at once.
+    """
+    __slots__ = ('max_attempts', 'initial_wait', 'max_wait', 'multiplier', 'jitter')
+
+    def __init__(self, max_attempts=3, initial_wait=0.1, max_wait=2.0, multiplier=2.0, jitter=0.5):
+        """
+        :param int max_attempts: The total number of attempts, including the first one
+        :param float initial_wait: The wait, in seconds, before the first retry
+        :param float max_wait: The maximum wait, in seconds, between two attempts
+        :param float multiplier: The factor applied to the wait after each retry
+        :param float jitter: The ratio of the wait that is randomized, from 0 to 1
+        """
+        self.max_attempts = max_attempts
+        self.initial_wait = initial_wait
+        self.max_wait = max_wait
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def should_retry(self, attempt):
+        """
+        Whether another attempt is allowed after the given number of failed attempts
+
+        :param int attempt: The number of attempts already made
+        :rtype: bool
+        """
+        return attempt < self.max_attempts
+
+    def wait_time(self, retry):
+        """
+        The time to wait, in seconds, before the given retry
+
+        :param int retry: The number of the retry, starting at 0
+        :rtype: float
+        """
+        wait = min(self.max_wait, self.initial_wait * (self.multiplier ** retry))
+        return wait * (1 - self.jitter * random.random())
+
+    def __repr__(self):
+        return '{0}(max_attempts={1!r}, initial_wait={2!r}, max_wait={3!r}, multiplier={4!r}, jitter={5!r})'.format(
+            self.__class__.__name__,
+            self.max_attempts,
+            self.initial_wait,
+            self.max_wait,
+            self.multiplier,
+            self.jitter,
+        )
@@ -0,0 +1,227 @@
+import errno
+import itertools
+import json
+import os
+import time
+
+from .logger import get_logger
+
+log = get_logger(__name__)
+
+
+class Spool(object):
+    """
+    Bounded on-disk storage for the payloads that could not be sent to the agent.
+
+    Each payload is stored in its own file, along with the endpoint and the
+    headers of the request, so that it can be sent again as is. When the spool
+    grows over ``max_size`` bytes, the oldest payloads are evicted.
+
+    Files are named after their creation time, so that listing them in order
+    returns the oldest first. Several processes can share the same directory:
+    a payload is claimed by renaming it before being sent again, so that it is
+    sent by a single process. The payloads claimed by processes that died
+    before sending them are released when payloads are claimed.
+
+    The size of the spool, claimed payloads included, is tracked as the
+    payloads are stored and removed, and the directory is only scanned again
+    when that size goes over ``max_size`` or every ``RESCAN_INTERVAL``
+    seconds, to account for the payloads of the other processes.
+    """
+    SUFFIX = '.payload'
+    CLAIMED_SUFFIX = '.claimed'
+
+    # Default max spool size of 50mb
+    DEFAULT_MAX_SIZE = 50 * 1000000
+
+    RESCAN_INTERVAL = 60
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self._counter = itertools.count()
+        self._size = None
+        self._last_scan = 0
+
+    def put(self, endpoint, data, headers):
+        """
+        Store a payload in the spool, evicting the oldest ones if needed
+
+        :param str endpoint: The endpoint the payload must be sent to
+        :param bytes data: The payload
+        :param dict headers: The headers specific to this payload
+        :returns: Whether the payload was stored
+        :rtype: bool
+        """
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+
+        meta = json.dumps(dict(endpoint=endpoint, headers=headers)).encode('utf-8')
+        if len(meta) + len(data) + 1 > self.max_size:
+            log.debug('payload of %d bytes is too large to be spooled', len(data))
+            return False
+
+        name = '{0:020d}-{1}-{2}'.format(int(time.time() * 1e6), os.getpid(), next(self._counter))
+        path = os.path.join(self.directory, name + self.SUFFIX)
+        tmp_path = os.path.join(self.directory, '.' + name)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(tmp_path, 'wb') as f:
+                f.write(meta)
+                f.write(b'\n')
+                f.write(data)
+            # DEV: rename so that other processes never read a partially written payload
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            log.error('cannot spool payload to %s', self.directory, exc_info=True)
+            return False
+
+        if self._size is not None:
+            self._size += len(meta) + len(data) + 1
+        self._evict()
+        return True
+
+    def paths(self):
+        """Return the paths of the spooled payloads not claimed, oldest first"""
+        return [os.path.join(self.directory, n) for n in self._names() if n.endswith(self.SUFFIX)]
+
+    def _names(self):
+        try:
+            return sorted(os.listdir(self.directory))
+        except (IOError, OSError):
+            return []
+
+    def claim(self, limit):
+        """
+        Claim the oldest spooled payloads, so that no other process sends them
+
+        The claimed payloads must be removed once sent, or released.
+
+        :param int limit: The maximum number of payloads claimed
+        :returns: The paths of the claimed payloads, oldest first
+        :rtype: list
+        """
+        pid = os.getpid()
+        paths = []
+        for name in self._names():
+            path = os.path.join(self.directory, name)
+            if name.endswith(self.SUFFIX):
+                paths.append(path)
+            elif name.endswith(self.CLAIMED_SUFFIX):
+                owner = _claim_owner(name)
+                if owner is None or owner == pid or _pid_alive(owner):
+                    continue
+                log.debug('releasing spooled payload %s claimed by process %d that is gone', path, owner)
+                released = self.release(path)
+                if released is not None:
+                    paths.append(released)
+        paths.sort()
+
+        claimed = []
+        suffix = '.{0}{1}'.format(pid, self.CLAIMED_SUFFIX)
+        for path in paths:
+            if len(claimed) >= limit:
+                break
+            try:
+                os.rename(path, path + suffix)
+            except (IOError, OSError):
+                # DEV: another process claimed or evicted it first
+                continue
+            claimed.append(path + suffix)
+        return claimed
+
+    def release(self, path):
+        """
+        Give back a claimed payload, so that it is sent again later
+
+        :returns: The path of the released payload, ``None`` if it cannot be released
+        :rtype: str
+        """
+        released = path[:path.rindex(self.SUFFIX) + len(self.SUFFIX)]
+        try:
+            os.rename(path, released)
+        except (IOError, OSError):
+            log.debug('cannot release spooled payload %s', path, exc_info=True)
+            return None
+        return released
+
+    def read(self, path):
+        """
+        Read a spooled payload
+
+        :returns: The ``(endpoint, data, headers)`` tuple, or ``None`` if the
+            payload cannot be read anymore
+        """
+        try:
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline().decode('utf-8'))
+                return meta['endpoint'], f.read(), meta['headers']
+        except (IOError, OSError, ValueError, KeyError):
+            log.debug('cannot read spooled payload %s', path, exc_info=True)
+            self.remove(path)
+            return None
+
+    def remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except (IOError, OSError):
+            # DEV: another process may have removed it already
+            return
+        if self._size is not None:
+            self._size -= size
+
+    def size(self):
+        """Return the size in bytes of the spooled payloads, claimed ones included"""
+        return sum(size for _, size in self._sizes())
+
+    def _sizes(self):
+        sizes = []
+        for name in self._names():
+            if not name.endswith(self.SUFFIX) and not name.endswith(self.CLAIMED_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                sizes.append((path, os.path.getsize(path)))
+            except (IOError, OSError):
+                pass
+        return sizes
+
+    def _evict(self):
+        now = time.time()
+        if self._size is not None and self._size <= self.max_size and now - self._last_scan < self.RESCAN_INTERVAL:
+            return
+
+        sizes = self._sizes()
+        total = sum(size for _, size in sizes)
+        for path, size in sizes:
+            if total <= self.max_size:
+                break
+            log.debug('spool is full, evicting %s', path)
+            try:
+                os.remove(path)
+            except (IOError, OSError):
+                pass
+            total -= size
+        self._size = total
+        self._last_scan = now
+
+
+def _claim_owner(name):
+    """Return the process id of the process that claimed a payload, from its file name"""
+    try:
+        return int(name[:-len(Spool.CLAIMED_SUFFIX)].rsplit('.', 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def _pid_alive(pid):
+    # DEV: ``os.kill()`` terminates the process on Windows, claims are never released there
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
@@ -0,0 +1,184 @@
+"""
+Capture the stacks of the spans, to format them when the spans are encoded.
+
+Formatting a traceback reads the source lines of each frame and builds a
+large string, which is expensive for the request thread when many requests
+fail at once. Spans only keep the code locations of the frames, and the
+writer formats them once per distinct stack: the formatted stacks are kept in
+a LRU cache keyed by their code locations, and the stacks formatted per second
+are capped.
+"""
+import linecache
+import threading
+import traceback
+from collections import OrderedDict
+
+from ..compat import monotonic_ns
+from ..utils.formats import get_env
+
+
+_TRACEBACK_HEADER = 'Traceback (most recent call last):\n'
+_CAUSE_MESSAGE = '\nThe above exception was the direct cause of the following exception:\n\n'
+_CONTEXT_MESSAGE = '\nDuring handling of the above exception, another exception occurred:\n\n'
+
+
+class StackFormatter(object):
+    """
+    Format the code locations of stacks, caching the ``cache_size`` most
+    recently used stacks.
+
+    At most ``max_per_second`` stacks that aren't in the cache are formatted
+    each second, the frames of the other ones are omitted.
+    """
+    DEFAULT_CACHE_SIZE = 256
+    DEFAULT_MAX_PER_SECOND = 100
+
+    def __init__(self, cache_size=DEFAULT_CACHE_SIZE, max_per_second=DEFAULT_MAX_PER_SECOND):
+        """
+        :param int cache_size: The maximum number of formatted stacks kept
+        :param int max_per_second: The maximum number of stacks formatted per
+            second, ``0`` for no limit
+        """
+        self.cache_size = cache_size
+        self.max_per_second = max_per_second
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._second = None
+        self._formatted = 0
+
+    def format(self, locations):
+        """
+        Return the formatted frames of the given code locations, or ``None``
+        if too many stacks were formatted in the last second
+
+        :param tuple locations: The ``(code, lineno)`` pairs of the frames,
+            the most recent call last
+        :rtype: str
+        """
+        with self._lock:
+            try:
+                # DEV: re-insert the stack to keep the cache ordered from the least recently used
+                formatted = self._cache.pop(locations)
+            except KeyError:
+                if not self._acquire():
+                    return None
+            else:
+                self._cache[locations] = formatted
+                return formatted
+
+        formatted = ''.join(traceback.format_list([_frame_summary(code, lineno) for code, lineno in locations]))
+        with self._lock:
+            self._cache[locations] = formatted
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return formatted
+
+    def _acquire(self):
+        if not self.max_per_second:
+            return True
+        second = monotonic_ns() // 1000000000
+        if second != self._second:
+            self._second = second
+            self._formatted = 0
+        if self._formatted >= self.max_per_second:
+            return False
+        self._formatted += 1
+        return True
+
+
+class DeferredStack(object):
+    """
+    Stack captured on a span, calling it returns its formatted text.
+
+    The frames are formatted with ``stack_formatter``, the exception messages
+    are formatted when the stack is captured since the exceptions aren't kept.
+    """
+    __slots__ = ('_parts', )
+
+    def __init__(self, parts):
+        """
+        :param list parts: The text of the stack, a ``(header, locations)``
+            tuple standing for the formatted frames
+        """
+        self._parts = parts
+
+    def __call__(self):
+        text = []
+        for part in self._parts:
+            if isinstance(part, tuple):
+                header, locations = part
+                formatted = stack_formatter.format(locations)
+                if formatted is None:
+                    continue
+                text.append(header)
+                text.append(formatted)
+            else:
+                text.append(part)
+        return ''.join(text)
+
+
+def capture_exception(exc_type, exc_val, exc_tb, limit=20):
+    """
+    Capture an exception, that formats like ``traceback.print_exception()``
+    including the exceptions it is chained to
+
+    :param int limit: The maximum number of frames of each traceback
+    :rtype: DeferredStack
+    """
+    parts = []
+    seen = set()
+    while True:
+        seen.add(id(exc_val))
+        parts.append(''.join(traceback.format_exception_only(exc_type, exc_val)))
+        if exc_tb is not None:
+            parts.append((_TRACEBACK_HEADER, _traceback_locations(exc_tb, limit)))
+
+        # DEV: Python 2 exceptions don't have these attributes
+        chained = getattr(exc_val, '__cause__', None)
+        if chained is not None and id(chained) not in seen:
+            parts.append(_CAUSE_MESSAGE)
+        else:
+            chained = getattr(exc_val, '__context__', None)
+            if chained is None or id(chained) in seen or exc_val.__suppress_context__:
+                break
+            parts.append(_CONTEXT_MESSAGE)
+        exc_type, exc_val, exc_tb = type(chained), chained, chained.__traceback__
+
+    parts.reverse()
+    return DeferredStack(parts)
+
+
+def capture_stack(frame, limit=20):
+    """
+    Capture the stack of a frame, that formats like ``traceback.format_stack()``
+
+    :param frame: The most recent frame of the stack
+    :param int limit: The maximum number of frames
+    :rtype: DeferredStack
+    """
+    locations = []
+    while frame is not None and len(locations) < limit:
+        locations.append((frame.f_code, frame.f_lineno))
+        frame = frame.f_back
+    locations.reverse()
+    return DeferredStack([('', tuple(locations))])
+
+
+def _traceback_locations(tb, limit):
+    locations = []
+    while tb is not None and len(locations) < limit:
+        locations.append((tb.tb_frame.f_code, tb.tb_lineno))
+        tb = tb.tb_next
+    return tuple(locations)
+
+
+def _frame_summary(code, lineno):
+    filename = code.co_filename
+    linecache.checkcache(filename)
+    return (filename, lineno, code.co_name, linecache.getline(filename, lineno).strip())
+
+
+stack_formatter = StackFormatter(
+    cache_size=int(get_env('tracer', 'stack_cache_size', StackFormatter.DEFAULT_CACHE_SIZE)),
+    max_per_second=int(get_env('tracer', 'max_stacks_per_second', StackFormatter.DEFAULT_MAX_PER_SECOND)),
+)
@@ -0,0 +1,24 @@
+import socket
+
+from ..compat import httplib
+
+
+class UDSHTTPConnection(httplib.HTTPConnection):
+    """
+    An HTTP connection established over a Unix Domain Socket.
+
+    The HTTP protocol is unchanged: only the transport differs, so the
+    ``host`` is only used to build the ``Host`` header of the requests.
+    """
+    # It's "important" to keep the hostname and port arguments here; while there are not used by the connection
+    # mechanism, they are actually used as HTTP headers such as `Host`.
+    def __init__(self, path, *args, **kwargs):
+        httplib.HTTPConnection.__init__(self, *args, **kwargs)
+        self.path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None and self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self.sock = sock
@@ -1,4 +1,5 @@
 import logging
+import zlib
 
 from .encoding import get_encoder
 
@@ -31,7 +32,8 @@ class Payload:
             being considered full (default: 5mb)
         """
         self.max_payload_size = max_payload_size
-        self.encoder = encoder or get_encoder()
+        # DEV: encoders keeping a state for the whole payload return a new instance
+        self.encoder = (encoder or get_encoder()).payload_encoder()
         self.traces = []
         self.size = 0
 
@@ -47,7 +49,18 @@ class Payload:
             return
 
         # Encode the trace, append, and add it's length to the size
-        encoded = self.encoder.encode_trace(trace)
+        self.add_encoded_trace(self.encoder.encode_trace(trace))
+
+    def add_encoded_trace(self, encoded):
+        """
+        Append a trace already encoded with this payload encoder
+
+        :param encoded: An encoded trace to append
+        :type encoded: str | bytes
+        """
+        if not encoded:
+            return
+
         self.traces.append(encoded)
         self.size += len(encoded)
 
@@ -79,7 +92,7 @@ class Payload:
         :returns: Whether we have reached the max payload size yet or not
         :rtype: bool
         """
-        return self.size >= self.max_payload_size
+        return self.size + self.encoder.shared_size >= self.max_payload_size
 
     def get_payload(self):
         """
@@ -91,6 +104,35 @@ class Payload:
         # DEV: `self.traces` is an array of encoded traces, `join_encoded` joins them together
         return self.encoder.join_encoded(self.traces)
 
+    def get_payload_chunks(self):
+        """
+        Get the fully encoded payload as a list of buffers, to be sent one after
+        the other without copying the encoded traces into a single buffer
+
+        :returns: The buffers of the fully encoded payload
+        :rtype: list
+        """
+        return [
+            chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+            for chunk in self.encoder.join_encoded_chunks(self.traces)
+        ]
+
+    def get_compressed_payload(self, compression_level):
+        """
+        Get the fully encoded payload, compressed in the gzip format
+
+        :param compression_level: The zlib compression level, from 1 (fastest) to 9 (smallest)
+        :type compression_level: int
+        :returns: The gzip compressed payload
+        :rtype: bytes
+        """
+        # DEV: `wbits=31` selects the gzip container; `gzip.compress` does not exist in Python 2
+        compressor = zlib.compressobj(compression_level, zlib.DEFLATED, 31)
+        # DEV: compress the buffers one after the other, the uncompressed payload is never joined
+        compressed = [compressor.compress(chunk) for chunk in self.get_payload_chunks()]
+        compressed.append(compressor.flush())
+        return b''.join(compressed)
+
     def __repr__(self):
         """Get the string representation of this payload"""
         return '{0}(length={1}, size={2}b, full={3})'.format(self.__class__.__name__, self.length, self.size, self.full)
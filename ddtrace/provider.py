@@ -1,4 +1,7 @@
-from .context import ThreadLocalContext
+import sys
+
+from .compat import contextvars
+from .context import LocalContext, ThreadLocalContext
 
 
 class BaseContextProvider(object):
@@ -56,3 +59,79 @@ class DefaultContextProvider(BaseContextProvider):
         implementation.
         """
         return self._local.get()
+
+
+class ContextVarsContextProvider(BaseContextProvider):
+    """
+    Context provider that stores the active ``Context`` in a ``ContextVar``.
+    It is the default provider on Python 3.7+, where it replaces both the
+    thread-local storage and the ``asyncio`` context provider: each thread
+    and each ``asyncio`` task has its own ``Context``.
+
+    ``asyncio`` tasks inherit the ``ContextVar`` of the code that created
+    them: the first time a task looks its ``Context`` up, it gets a new one
+    continuing the trace that was active when the task was created, like the
+    ``create_task()`` helper of the ``asyncio`` integration. Concurrent tasks
+    never share a ``Context``.
+    """
+    def __init__(self):
+        # DEV: holds the ``(task, context)`` tuple, to detect the inherited contexts
+        self._context = contextvars.ContextVar('datadog_context', default=None)
+
+    def _has_active_context(self):
+        """
+        Check whether we have a currently active context.
+
+        :returns: Whether we have an active context
+        :rtype: bool
+        """
+        return self._context.get() is not None
+
+    def activate(self, context):
+        """Makes the given ``context`` active in the current execution context."""
+        self._context.set((_current_task(), context))
+        return context
+
+    def active(self):
+        """Returns the ``Context`` active in the current execution context,
+        creating a new one if there is none.
+        """
+        task = _current_task()
+        value = self._context.get()
+        if value is not None:
+            owner, ctx = value
+            if owner is task:
+                return ctx
+            # the context was inherited from the code that created the current task
+            ctx = _child_context(ctx)
+        else:
+            ctx = LocalContext()
+        self._context.set((task, ctx))
+        return ctx
+
+
+def _current_task():
+    """Return the ``asyncio`` task running in the current thread, if any"""
+    # DEV: there is no task to look up if the application doesn't use asyncio
+    asyncio = sys.modules.get('asyncio')
+    if asyncio is None:
+        return None
+    loop = asyncio._get_running_loop()
+    if loop is None:
+        return None
+    return asyncio.current_task(loop)
+
+
+def _child_context(ctx):
+    """Return a new ``Context`` continuing the trace of the given one from its active span"""
+    # DEV: the ids are read once, the context may be updated by another thread
+    trace_id, span_id = ctx.trace_id, ctx.span_id
+    if trace_id is None or span_id is None:
+        return LocalContext()
+    return LocalContext(
+        trace_id=trace_id,
+        span_id=span_id,
+        sampled=ctx.sampled,
+        sampling_priority=ctx.sampling_priority,
+        _dd_origin=ctx._dd_origin,
+    )
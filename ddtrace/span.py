@@ -1,12 +1,11 @@
 import math
-import random
 import sys
-import time
-import traceback
 
-from .compat import StringIO, stringify, iteritems, numeric_types
+from .compat import stringify, iteritems, numeric_types, time_ns, monotonic_ns
 from .constants import NUMERIC_TAGS
 from .ext import errors
+from .internal.idgen import id_generator
+from .internal.stacks import capture_exception, capture_stack
 from .internal.logger import get_logger
 
 
@@ -23,15 +22,17 @@ class Span(object):
         'span_id',
         'trace_id',
         'parent_id',
-        'meta',
         'error',
-        'metrics',
         'span_type',
-        'start',
-        'duration',
+        'start_ns',
+        'duration_ns',
         # Sampler attributes
         'sampled',
         # Internal attributes
+        '_meta',
+        '_lazy_meta',
+        '_metrics',
+        '_start_monotonic_ns',
         '_tracer',
         '_context',
         '_finished',
@@ -68,7 +69,7 @@ class Span(object):
         :param int parent_id: the id of this span's direct parent span.
         :param int span_id: the id of this span.
 
-        :param int start: the start time of request as a unix epoch in seconds
+        :param float start: the start time of request as a unix epoch in seconds
         :param object context: the Context of the span.
         """
         # required span info
@@ -78,13 +79,22 @@ class Span(object):
         self.span_type = span_type
 
         # tags / metatdata
-        self.meta = {}
+        # DEV: the tags dicts are only allocated once a tag is set, see ``meta`` and ``metrics``
+        self._meta = None
+        self._lazy_meta = None
         self.error = 0
-        self.metrics = {}
+        self._metrics = None
 
         # timing
-        self.start = start or time.time()
-        self.duration = None
+        # DEV: the start is a wall clock time, the duration is measured with a monotonic clock
+        #      so that it isn't affected by the wall clock changes
+        if start:
+            self.start_ns = int(start * 1e9)
+            self._start_monotonic_ns = None
+        else:
+            self.start_ns = time_ns()
+            self._start_monotonic_ns = monotonic_ns()
+        self.duration_ns = None
 
         # tracing
         self.trace_id = trace_id or _new_id()
@@ -101,6 +111,57 @@ class Span(object):
         # state
         self._finished = False
 
+    @property
+    def meta(self):
+        """The string tags of the span"""
+        if self._lazy_meta:
+            self._format_lazy_meta()
+        meta = self._meta
+        if meta is None:
+            meta = self._meta = {}
+        return meta
+
+    @meta.setter
+    def meta(self, value):
+        self._meta = value
+        self._lazy_meta = None
+
+    @property
+    def metrics(self):
+        """The numeric tags of the span"""
+        metrics = self._metrics
+        if metrics is None:
+            metrics = self._metrics = {}
+        return metrics
+
+    @metrics.setter
+    def metrics(self, value):
+        self._metrics = value
+
+    @property
+    def start(self):
+        """The start time of the span as a unix epoch in seconds"""
+        if self.start_ns is None:
+            return None
+        return self.start_ns / 1e9
+
+    @start.setter
+    def start(self, value):
+        self.start_ns = None if value is None else int(value * 1e9)
+        # DEV: the duration can't be measured with the monotonic clock anymore
+        self._start_monotonic_ns = None
+
+    @property
+    def duration(self):
+        """The duration of the span in seconds, ``None`` until the span is finished"""
+        if self.duration_ns is None:
+            return None
+        return self.duration_ns / 1e9
+
+    @duration.setter
+    def duration(self, value):
+        self.duration_ns = None if value is None else int(value * 1e9)
+
     def finish(self, finish_time=None):
         """ Mark the end time of the span and submit it to the tracer.
             If the span has already been finished don't do anything
@@ -112,10 +173,13 @@ class Span(object):
             return
         self._finished = True
 
-        if self.duration is None:
-            ft = finish_time or time.time()
-            # be defensive so we don't die if start isn't set
-            self.duration = ft - (self.start or ft)
+        if self.duration_ns is None:
+            if not finish_time and self._start_monotonic_ns is not None:
+                self.duration_ns = monotonic_ns() - self._start_monotonic_ns
+            else:
+                ft = int(finish_time * 1e9) if finish_time else time_ns()
+                # be defensive so we don't die if start isn't set
+                self.duration_ns = ft - (self.start_ns or ft)
 
         # if a tracer is available to process the current context
         if self._tracer and self._context:
@@ -129,28 +193,67 @@ class Span(object):
         """ Set the given key / value tag pair on the span. Keys and values
             must be strings (or stringable). If a casting error occurs, it will
             be ignored.
+
+            Values wrapped in a ``LazyTag`` are only stringified when the span
+            is encoded.
         """
 
         if key in NUMERIC_TAGS:
             try:
+                if isinstance(value, LazyTag):
+                    value = value()
                 self.set_metric(key, float(value))
             except (TypeError, ValueError):
                 log.debug("error setting numeric metric {}:{}".format(key, value))
 
             return
         try:
-            self.meta[key] = stringify(value)
+            if isinstance(value, LazyTag):
+                self._set_lazy_tag(key, value)
+                return
+            meta = self._meta
+            if meta is None:
+                meta = self._meta = {}
+            meta[key] = stringify(value)
+            if self._lazy_meta:
+                self._lazy_meta.pop(key, None)
         except Exception:
             log.debug("error setting tag %s, ignoring it", key, exc_info=True)
 
     def _remove_tag(self, key):
-        if key in self.meta:
-            del self.meta[key]
+        if self._meta and key in self._meta:
+            del self._meta[key]
+        if self._lazy_meta:
+            self._lazy_meta.pop(key, None)
+
+    def _set_lazy_tag(self, key, value):
+        # DEV: ``value`` is called to get the string value of the tag when the span is encoded
+        lazy_meta = self._lazy_meta
+        if lazy_meta is None:
+            lazy_meta = self._lazy_meta = {}
+        lazy_meta[key] = value
+        if self._meta:
+            self._meta.pop(key, None)
+
+    def _format_lazy_meta(self):
+        """Set the string value of the tags computed when the span is encoded"""
+        lazy_meta = self._lazy_meta
+        self._lazy_meta = None
+        meta = self._meta
+        if meta is None:
+            meta = self._meta = {}
+        for key, value in iteritems(lazy_meta):
+            try:
+                meta[key] = stringify(value())
+            except Exception:
+                log.debug("error setting tag %s, ignoring it", key, exc_info=True)
 
     def get_tag(self, key):
         """ Return the given tag or None if it doesn't exist.
         """
-        return self.meta.get(key, None)
+        if self._lazy_meta:
+            self._format_lazy_meta()
+        return self._meta.get(key, None) if self._meta else None
 
     def set_tags(self, tags):
         """ Set a dictionary of tags on the given span. Keys and values
@@ -186,7 +289,10 @@ class Span(object):
             log.debug("ignoring not real metric %s:%s", key, value)
             return
 
-        self.metrics[key] = value
+        metrics = self._metrics
+        if metrics is None:
+            metrics = self._metrics = {}
+        metrics[key] = value
 
     def set_metrics(self, metrics):
         if metrics:
@@ -194,9 +300,12 @@ class Span(object):
                 self.set_metric(k, v)
 
     def get_metric(self, key):
-        return self.metrics.get(key)
+        return self._metrics.get(key) if self._metrics else None
 
     def to_dict(self):
+        if self._lazy_meta:
+            self._format_lazy_meta()
+
         d = {
             'trace_id': self.trace_id,
             'parent_id': self.parent_id,
@@ -214,17 +323,17 @@ class Span(object):
         if err and type(err) == bool:
             d['error'] = 1
 
-        if self.start:
-            d['start'] = int(self.start * 1e9)  # ns
+        if self.start_ns:
+            d['start'] = self.start_ns
 
-        if self.duration:
-            d['duration'] = int(self.duration * 1e9)  # ns
+        if self.duration_ns:
+            d['duration'] = self.duration_ns
 
-        if self.meta:
-            d['meta'] = self.meta
+        if self._meta:
+            d['meta'] = self._meta
 
-        if self.metrics:
-            d['metrics'] = self.metrics
+        if self._metrics:
+            d['metrics'] = self._metrics
 
         if self.span_type:
             d['type'] = self.span_type
@@ -240,8 +349,9 @@ class Span(object):
         if (exc_type and exc_val and exc_tb):
             self.set_exc_info(exc_type, exc_val, exc_tb)
         else:
-            tb = ''.join(traceback.format_stack(limit=limit + 1)[:-1])
-            self.set_tag(errors.ERROR_STACK, tb)  # FIXME[gabin] Want to replace "error.stack" tag with "python.stack"
+            # DEV: only the code locations are captured, the stack is formatted when the span is encoded
+            # FIXME[gabin] Want to replace "error.stack" tag with "python.stack"
+            self._set_lazy_tag(errors.ERROR_STACK, capture_stack(sys._getframe(1), limit=limit))
 
     def set_exc_info(self, exc_type, exc_val, exc_tb):
         """ Tag the span with an error tuple as from `sys.exc_info()`. """
@@ -250,17 +360,13 @@ class Span(object):
 
         self.error = 1
 
-        # get the traceback
-        buff = StringIO()
-        traceback.print_exception(exc_type, exc_val, exc_tb, file=buff, limit=20)
-        tb = buff.getvalue()
-
         # readable version of type (e.g. exceptions.ZeroDivisionError)
         exc_type_str = "%s.%s" % (exc_type.__module__, exc_type.__name__)
 
         self.set_tag(errors.ERROR_MSG, exc_val)
         self.set_tag(errors.ERROR_TYPE, exc_type_str)
-        self.set_tag(errors.ERROR_STACK, tb)
+        # DEV: the traceback is formatted when the span is encoded
+        self._set_lazy_tag(errors.ERROR_STACK, capture_exception(exc_type, exc_val, exc_tb, limit=20))
 
     def _remove_exc_info(self):
         """ Remove all exception related information from the span. """
@@ -286,7 +392,9 @@ class Span(object):
             ("tags", "")
         ]
 
-        lines.extend((" ", "%s:%s" % kv) for kv in sorted(self.meta.items()))
+        if self._lazy_meta:
+            self._format_lazy_meta()
+        lines.extend((" ", "%s:%s" % kv) for kv in sorted((self._meta or {}).items()))
         return "\n".join("%10s %s" % l for l in lines)
 
     @property
@@ -321,6 +429,183 @@ class Span(object):
         )
 
 
+class NoopSpan(Span):
+    """
+    Span of an unsampled trace, that is never recorded.
+
+    It only carries the ids of the trace, for the propagation and the logs
+    correlation, and its parenting: its tags and errors are ignored, and it is
+    the active span of its context until it is finished, without being added
+    to the trace. Integrations can check ``span.sampled`` to skip computing
+    the tags of unsampled spans.
+    """
+    __slots__ = ()
+
+    def __init__(
+        self,
+        tracer,
+        name,
+
+        service=None,
+        resource=None,
+        span_type=None,
+        trace_id=None,
+        span_id=None,
+        parent_id=None,
+        start=None,
+        context=None,
+    ):
+        # DEV: same attributes as ``Span.__init__()``, without the timing
+        self.name = name
+        self.service = service
+        self.resource = resource or name
+        self.span_type = span_type
+        self._meta = self._lazy_meta = self._metrics = None
+        self.error = 0
+        self.start_ns = self.duration_ns = self._start_monotonic_ns = None
+        self.trace_id = trace_id or _new_id()
+        self.span_id = span_id or _new_id()
+        self.parent_id = parent_id
+        self.sampled = False
+        self._tracer = tracer
+        self._context = context
+        self._parent = None
+        self._finished = False
+
+    def finish(self, finish_time=None):
+        if self._finished:
+            return
+        self._finished = True
+        if self._context:
+            self._context.close_noop_span(self)
+
+    def set_tag(self, key, value):
+        pass
+
+    def set_tags(self, tags):
+        pass
+
+    def set_metric(self, key, value):
+        pass
+
+    def set_metrics(self, metrics):
+        pass
+
+    def set_traceback(self, limit=20):
+        pass
+
+    def set_exc_info(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class LazyTag(object):
+    """
+    Value of a tag computed when the span is encoded, rather than when the tag is set.
+
+    ``func(*args)`` is called once, by the writer when the trace is encoded or
+    when the tag is read, and its result is stringified like the values given
+    to ``Span.set_tag()``. Nothing is computed for the traces dropped before
+    being encoded. The arguments must not be modified once the tag is set::
+
+        span.set_tag('mongodb.query', LazyTag(normalize_filter, query))
+    """
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        """
+        :param func: The function returning the value of the tag
+        :param args: The arguments given to ``func``
+        """
+        self.func = func
+        self.args = args
+
+    def __call__(self):
+        return self.func(*self.args)
+
+    def __repr__(self):
+        return '<LazyTag(func=%r)>' % (self.func, )
+
+
+class SpanFreeList(object):
+    """
+    Finished spans kept to be initialized again instead of allocating new ones.
+
+    Spans must only be released once they are finished, e.g. once they have
+    been encoded by a writer encoding the traces on enqueue. The spans still
+    referenced by something else than their trace, e.g. by the application or
+    a test writer, are never kept: they are left untouched and freed as usual.
+    This includes the span whose ``finish()`` wrote the trace, and the parents
+    of the spans kept.
+    Spans are only recycled on CPython, where their references are counted.
+    """
+    # Default maximum number of spans kept in the list
+    DEFAULT_MAX_SIZE = 1000
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        """
+        :param int max_size: The maximum number of spans kept in the list
+        """
+        self.max_size = max_size
+        self._spans = []
+
+    def __len__(self):
+        return len(self._spans)
+
+    def acquire(self, *args, **kwargs):
+        """Return a span initialized with the given arguments, like ``Span()``"""
+        # DEV: ``list.pop()`` and ``list.extend()`` are atomic, no lock is needed
+        try:
+            span = self._spans.pop()
+        except IndexError:
+            return Span(*args, **kwargs)
+        span.__init__(*args, **kwargs)
+        return span
+
+    def release(self, spans):
+        """
+        Keep the given finished spans to be used again, up to ``max_size`` spans
+
+        :param list spans: The spans to release
+        """
+        free = self.max_size - len(self._spans)
+        if free <= 0 or _REFCOUNT_BASE is None:
+            return
+
+        # DEV: count the references before binding any of the spans to a local variable
+        refcounts = _refcounts(spans)
+
+        # DEV: the children of a span in the trace reference it as well
+        children = {}
+        for span in spans:
+            if span._parent is not None:
+                children[id(span._parent)] = children.get(id(span._parent), 0) + 1
+
+        held = set()
+        for span, refcount in zip(spans, refcounts):
+            if refcount > _REFCOUNT_BASE + children.get(id(span), 0):
+                # the parents of a span still referenced are referenced as well
+                parent = span
+                while parent is not None and id(parent) not in held:
+                    held.add(id(parent))
+                    parent = parent._parent
+
+        released = [span for span in spans if id(span) not in held][:free]
+        for span in released:
+            # drop the references to the other objects so that they can be freed
+            span._tracer = span._context = span._parent = span._meta = span._lazy_meta = span._metrics = None
+        self._spans.extend(released)
+
+
+def _refcounts(objects):
+    """Return the reference counts of the given objects"""
+    return [sys.getrefcount(o) for o in objects]
+
+
+# DEV: only CPython counts the references to the objects, this is the count
+#      of an object only referenced by the list given to ``_refcounts()``
+_REFCOUNT_BASE = _refcounts([object()])[0] if hasattr(sys, 'getrefcount') else None
+
+
 def _new_id():
     """Generate a random trace_id or span_id"""
-    return random.getrandbits(64)
+    return id_generator.new_id()
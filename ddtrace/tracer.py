@@ -1,17 +1,21 @@
 import functools
+import math
 from os import environ, getpid
 
 from .ext import system
+from .internal import forksafe
+from .internal.idgen import id_generator
 from .internal.logger import get_logger
-from .provider import DefaultContextProvider
-from .context import Context
+from .provider import ContextVarsContextProvider, DefaultContextProvider
+from .context import Context, LocalContext
 from .sampler import AllSampler, RateSampler, RateByServiceSampler
 from .writer import AgentWriter
-from .span import Span
-from .constants import FILTERS_KEY, SAMPLE_RATE_METRIC_KEY
+from .span import LazyTag, NoopSpan, Span
+from .constants import FILTERS_KEY, NUMERIC_TAGS, SAMPLE_RATE_METRIC_KEY
 from . import compat
 from .ext.priority import AUTO_REJECT, AUTO_KEEP
 from .utils.deprecation import deprecated
+from .utils.formats import asbool, get_env
 
 
 log = get_logger(__name__)
@@ -30,6 +34,8 @@ class Tracer(object):
     """
     DEFAULT_HOSTNAME = environ.get('DD_AGENT_HOST', environ.get('DATADOG_TRACE_AGENT_HOSTNAME', 'localhost'))
     DEFAULT_PORT = int(environ.get('DD_TRACE_AGENT_PORT', 8126))
+    # e.g. ``unix:///var/run/datadog/apm.socket`` or ``http://localhost:8126``
+    DEFAULT_AGENT_URL = environ.get('DD_TRACE_AGENT_URL')
 
     def __init__(self):
         """
@@ -38,21 +44,80 @@ class Tracer(object):
         """
         self.sampler = None
         self.priority_sampler = None
+        # globally set tags
+        self._tags = {}
+
+        hostname, port, uds_path = self.DEFAULT_HOSTNAME, self.DEFAULT_PORT, None
+        if self.DEFAULT_AGENT_URL:
+            hostname, port, uds_path = _parse_agent_url(self.DEFAULT_AGENT_URL, hostname, port)
 
         # Apply the default configuration
         self.configure(
             enabled=True,
-            hostname=self.DEFAULT_HOSTNAME,
-            port=self.DEFAULT_PORT,
+            hostname=hostname,
+            port=port,
+            uds_path=uds_path,
             sampler=AllSampler(),
-            context_provider=DefaultContextProvider(),
+            context_provider=ContextVarsContextProvider() if compat.contextvars else DefaultContextProvider(),
+            id_generator=id_generator,
+            noop_unsampled_spans=asbool(get_env('tracer', 'noop_unsampled_spans', 'false')),
         )
 
         # A hook for local debugging. shouldn't be needed or used in production
         self.debug_logging = False
 
-        # globally set tags
-        self.tags = {}
+        forksafe.register(after_in_child=self._update_tag_templates)
+
+    @property
+    def tags(self):
+        """
+        The tags set on each span created by the tracer, updated with ``set_tags()``
+
+        The tags are stringified once, when they are set: after updating them
+        in place, ``set_tags()`` must be called for the new spans to get them,
+        e.g. ``tracer.set_tags({})``.
+        """
+        return self._tags
+
+    @tags.setter
+    def tags(self, tags):
+        self._tags = tags
+        self._update_tag_templates()
+
+    def _update_tag_templates(self):
+        # DEV: the tags are stringified once and copied in bulk to the new spans,
+        #      root spans also get the process id
+        meta = {}
+        metrics = {}
+        for key, value in compat.iteritems(self._tags):
+            try:
+                # DEV: same conversions as ``Span.set_tag()``
+                if isinstance(value, LazyTag):
+                    value = value()
+                if key in NUMERIC_TAGS:
+                    value = float(value)
+                    if not math.isnan(value) and not math.isinf(value):
+                        metrics[key] = value
+                else:
+                    meta[key] = compat.stringify(value)
+            except Exception:
+                log.debug('error setting tag %s, ignoring it', key, exc_info=True)
+        self._span_tags = (meta, metrics)
+        self._pid = getpid()
+        root_meta = dict(meta)
+        root_meta[system.PID] = compat.stringify(self._pid)
+        self._root_span_tags = (root_meta, metrics)
+
+    @property
+    def writer(self):
+        """The writer sending the finished traces to the agent"""
+        return self._writer
+
+    @writer.setter
+    def writer(self, writer):
+        self._writer = writer
+        # DEV: writers recycling the spans once encoded provide the list new spans are taken from
+        self._span_free_list = getattr(writer, 'span_free_list', None)
 
     def get_call_context(self, *args, **kwargs):
         """
@@ -77,9 +142,9 @@ class Tracer(object):
         """Returns the current Tracer Context Provider"""
         return self._context_provider
 
-    def configure(self, enabled=None, hostname=None, port=None, sampler=None,
+    def configure(self, enabled=None, hostname=None, port=None, uds_path=None, sampler=None,
                   context_provider=None, wrap_executor=None, priority_sampling=None,
-                  settings=None):
+                  settings=None, writer=None, id_generator=None, noop_unsampled_spans=None):
         """
         Configure an existing Tracer the easy way.
         Allow to configure or reconfigure a Tracer instance.
@@ -88,6 +153,8 @@ class Tracer(object):
             Otherwise they'll be dropped.
         :param str hostname: Hostname running the Trace Agent
         :param int port: Port of the Trace Agent
+        :param str uds_path: The Unix Domain Socket path of the Trace Agent. When set, it is used
+            instead of ``hostname`` and ``port`` to reach the agent.
         :param object sampler: A custom Sampler instance, locally deciding to totally drop the trace or not.
         :param object context_provider: The ``ContextProvider`` that will be used to retrieve
             automatically the current call context. This is an advanced option that usually
@@ -97,6 +164,15 @@ class Tracer(object):
             from the default value
         :param priority_sampling: enable priority sampling, this is required for
             complete distributed tracing support. Enabled by default.
+        :param object writer: The writer sending the traces to the agent, e.g. an
+            ``AsyncioWriter`` for applications running an ``asyncio`` event loop. It
+            replaces the ``AgentWriter`` built from ``hostname``, ``port`` and ``uds_path``.
+        :param object id_generator: The object whose ``new_id()`` method returns the random
+            64-bit ids of the new traces and spans. This is an advanced option that usually
+            doesn't need to be changed from the default value
+        :param bool noop_unsampled_spans: If True, the spans of the traces dropped by the sampler
+            are ``NoopSpan`` instances, that keep their ids but ignore their tags. Defaults to
+            the ``DD_TRACER_NOOP_UNSAMPLED_SPANS`` environment variable.
         """
         if enabled is not None:
             self.enabled = enabled
@@ -115,17 +191,25 @@ class Tracer(object):
         elif priority_sampling is False:
             self.priority_sampler = None
 
-        if hostname is not None or port is not None or filters is not None or \
+        if writer is not None:
+            self.writer = writer
+        elif hostname is not None or port is not None or uds_path is not None or filters is not None or \
                 priority_sampling is not None:
-            # Preserve hostname and port when overriding filters or priority sampling
+            # Preserve hostname, port and socket path when overriding filters or priority sampling
             default_hostname = self.DEFAULT_HOSTNAME
             default_port = self.DEFAULT_PORT
+            default_uds_path = None
             if hasattr(self, 'writer') and hasattr(self.writer, 'api'):
                 default_hostname = self.writer.api.hostname
                 default_port = self.writer.api.port
+                default_uds_path = getattr(self.writer.api, 'uds_path', None)
+            if hostname is not None or port is not None:
+                # an explicit TCP address replaces a previously configured socket path
+                default_uds_path = None
             self.writer = AgentWriter(
                 hostname or default_hostname,
                 port or default_port,
+                uds_path=uds_path or default_uds_path,
                 filters=filters,
                 priority_sampler=self.priority_sampler,
             )
@@ -136,6 +220,14 @@ class Tracer(object):
         if wrap_executor is not None:
             self._wrap_executor = wrap_executor
 
+        if id_generator is not None:
+            self._id_generator = id_generator
+
+        if noop_unsampled_spans is not None:
+            self._noop_unsampled_spans = noop_unsampled_spans
+
+        self._update_tag_templates()
+
     def start_span(self, name, child_of=None, service=None, resource=None, span_type=None):
         """
         Return a span that will trace an operation called `name`. This method allows
@@ -168,16 +260,35 @@ class Tracer(object):
             context = child_of if child_of_context else child_of.context
             parent = child_of.get_current_span() if child_of_context else child_of
         else:
-            context = Context()
+            context = LocalContext()
             parent = None
 
         if parent:
+            if not parent.sampled and self._noop_unsampled_spans:
+                # the trace is dropped, the span is only kept for the propagation and the parenting
+                span = NoopSpan(
+                    self,
+                    name,
+                    trace_id=parent.trace_id,
+                    span_id=self._id_generator.new_id(),
+                    parent_id=parent.span_id,
+                    service=service or parent.service,
+                    resource=resource,
+                    span_type=span_type,
+                )
+                span._parent = parent
+                context.add_noop_span(span)
+                return span
+
             trace_id = parent.trace_id
             parent_span_id = parent.span_id
         else:
             trace_id = context.trace_id
             parent_span_id = context.span_id
 
+        new_span = self._span_free_list.acquire if self._span_free_list is not None else Span
+        new_id = self._id_generator.new_id
+
         if trace_id:
             # child_of a non-empty context, so either a local child span or from a remote context
 
@@ -185,10 +296,11 @@ class Tracer(object):
             if parent:
                 service = service or parent.service
 
-            span = Span(
+            span = new_span(
                 self,
                 name,
                 trace_id=trace_id,
+                span_id=new_id(),
                 parent_id=parent_span_id,
                 service=service,
                 resource=resource,
@@ -202,9 +314,11 @@ class Tracer(object):
 
         else:
             # this is the root span of a new trace
-            span = Span(
+            span = new_span(
                 self,
                 name,
+                trace_id=new_id(),
+                span_id=new_id(),
                 service=service,
                 resource=resource,
                 span_type=span_type,
@@ -229,12 +343,30 @@ class Tracer(object):
                 if self.priority_sampler:
                     # If dropped by the local sampler, distributed instrumentation can drop it too.
                     context.sampling_priority = 0
+                if self._noop_unsampled_spans:
+                    # DEV: the samplers need a span, the root span is turned into a ``NoopSpan`` afterwards
+                    span.__class__ = NoopSpan
+                    context.add_noop_span(span)
+                    return span
 
         # add common tags
-        if self.tags:
-            span.set_tags(self.tags)
-        if not span._parent:
-            span.set_tag(system.PID, getpid())
+        if span._parent:
+            meta, metrics = self._span_tags
+        else:
+            # DEV: forks are detected with the process id when the fork hooks aren't available
+            if not forksafe.SUPPORTED and self._pid != getpid():
+                self._update_tag_templates()
+            meta, metrics = self._root_span_tags
+        if meta:
+            if span._meta is None:
+                span._meta = meta.copy()
+            else:
+                span._meta.update(meta)
+        if metrics:
+            if span._metrics is None:
+                span._metrics = metrics.copy()
+            else:
+                span._metrics.update(metrics)
 
         # add it to the current context
         context.add_span(span)
@@ -431,6 +563,23 @@ class Tracer(object):
         """ Set some tags at the tracer level.
         This will append those tags to each span created by the tracer.
 
-        :param dict tags: dict of tags to set at tracer level
+        :param dict tags: dict of tags to set at tracer level, the tags of
+            ``Tracer.tags`` updated in place are applied as well
         """
-        self.tags.update(tags)
+        self._tags.update(tags)
+        self._update_tag_templates()
+
+
+def _parse_agent_url(url, default_hostname, default_port):
+    """
+    Parse a trace agent URL such as ``unix:///var/run/datadog/apm.socket`` or
+    ``http://localhost:8126`` into a ``(hostname, port, uds_path)`` tuple.
+    """
+    parsed = compat.parse.urlparse(url)
+    if parsed.scheme == 'unix':
+        return default_hostname, default_port, parsed.path
+    if parsed.scheme == 'http':
+        return parsed.hostname or default_hostname, parsed.port or default_port, None
+
+    log.warning('unsupported trace agent URL %r, using %s:%s', url, default_hostname, default_port)
+    return default_hostname, default_port, None
@@ -5,35 +5,266 @@ import random
 import os
 import time
 
+import ddtrace
 from . import api
+from .constants import SAMPLING_PRIORITY_KEY
+from .context import Context
+from .ext.priority import AUTO_KEEP, AUTO_REJECT, USER_KEEP, USER_REJECT
+from .internal import forksafe
+from .internal.health import DogStatsdReporter, HealthMetrics
 from .internal.logger import get_logger
+from .internal.spool import Spool
+from .span import SpanFreeList
+from .utils.formats import asbool, get_env
 
 log = get_logger(__name__)
 
 
 MAX_TRACES = 1000
+# Maximum number of bytes of encoded traces buffered when traces are encoded on enqueue
+MAX_BUFFER_SIZE = 8 * 1000000
 
 DEFAULT_TIMEOUT = 5
 LOG_ERR_INTERVAL = 60
 
+# Maximum time (in seconds) a trace can wait in the queue before being flushed
+DEFAULT_FLUSH_INTERVAL = 1.0
+# Wake the worker up early when this many traces are waiting, so that bursts
+# are flushed before the queue reaches ``MAX_TRACES`` and starts dropping
+DEFAULT_FLUSH_MIN_TRACES = MAX_TRACES // 2
+# Same as ``DEFAULT_FLUSH_MIN_TRACES`` for the encoded traces buffer
+DEFAULT_FLUSH_MIN_BYTES = MAX_BUFFER_SIZE // 2
+# Maximum time (in seconds) a fork waits for the queued traces to be sent,
+# by default they are sent by the parent process after the fork
+DEFAULT_FORK_FLUSH_TIMEOUT = 0
+
+# Names of the sampling priorities in the ``traces.dropped.*`` metrics
+_PRIORITY_NAMES = {
+    USER_REJECT: 'user_reject',
+    AUTO_REJECT: 'auto_reject',
+    AUTO_KEEP: 'auto_keep',
+    USER_KEEP: 'user_keep',
+}
+
+# Minimum time (in seconds) between two reports of the health metrics to dogstatsd
+HEALTH_METRICS_INTERVAL = 10
 
-class AgentWriter(object):
 
-    def __init__(self, hostname='localhost', port=8126, filters=None, priority_sampler=None):
+class AgentWriter(object):
+    """
+    Buffer the finished traces and send them to the trace agent from a
+    background thread.
+
+    By default, traces are buffered as lists of spans and encoded by the
+    background thread. When ``encode_on_enqueue`` is enabled, traces are filtered
+    and encoded as soon as they are written, so that their spans can be freed
+    right away, and they are buffered up to ``max_buffer_size`` bytes instead
+    of ``MAX_TRACES`` traces. With ``recycle_spans`` (or the
+    ``DD_TRACER_RECYCLE_SPANS`` environment variable), the spans are even kept
+    in ``span_free_list`` once encoded, and the tracer initializes them again
+    for its next spans rather than allocating new ones: the application must
+    not keep references to finished spans.
+
+    The version of the agent API is chosen from ``priority_sampler`` unless
+    ``api_version`` (or the ``DD_TRACE_API_VERSION`` environment variable) is
+    set, e.g. to ``v0.5`` to send each string once per payload: payloads are
+    smaller, but take more CPU to encode (see ``MsgpackStringTableEncoder``).
+    It is downgraded if the agent doesn't support it.
+
+    Payloads are gzip compressed when ``compression_level`` (or the
+    ``DD_TRACER_COMPRESSION_LEVEL`` environment variable) is set to a zlib
+    level between 1 and 9.
+
+    Payloads that can't be sent after retrying are dropped, unless a
+    ``spool_dir`` (or the ``DD_TRACER_SPOOL_DIR`` environment variable) is
+    set: they are then stored in that directory, up to ``spool_max_size``
+    bytes, and sent again once the agent is reachable.
+
+    When the queue is full, the traces with the lowest sampling priority are
+    dropped first. With ``prioritize_errors`` (or the
+    ``DD_TRACER_PRIORITIZE_ERRORS`` environment variable), traces with an
+    error are kept over the other traces with the same priority.
+
+    The writer is fork-safe: traces buffered when the process forks are kept
+    by the parent process, and sent by its worker thread without delaying the
+    fork. A parent exiting right after forking can set ``fork_flush_timeout``
+    (or the ``DD_TRACER_FORK_FLUSH_TIMEOUT`` environment variable) to wait up
+    to that many seconds for them to be sent before forking. The child process
+    starts with a new queue and worker thread.
+
+    Health metrics about the traces enqueued, dropped, sent and failed, the
+    bytes sent, the encoding and sending durations and the queue depth are
+    returned by ``stats()``. When ``health_metrics_enabled`` (or the
+    ``DD_TRACER_HEALTH_METRICS_ENABLED`` environment variable) is set, they
+    are also sent to the dogstatsd server at ``dogstatsd_hostname:dogstatsd_port``
+    every ``HEALTH_METRICS_INTERVAL`` seconds.
+    """
+    _encode_on_enqueue = asbool(get_env('tracer', 'encode_on_enqueue', 'false'))
+    _recycle_spans = asbool(get_env('tracer', 'recycle_spans', 'false'))
+    _compression_level = int(get_env('tracer', 'compression_level', 0))
+    _spool_dir = get_env('tracer', 'spool_dir')
+    _spool_max_size = int(get_env('tracer', 'spool_max_size', Spool.DEFAULT_MAX_SIZE))
+    _api_version = get_env('trace', 'api_version')
+    _prioritize_errors = asbool(get_env('tracer', 'prioritize_errors', 'false'))
+    _health_metrics_enabled = asbool(get_env('tracer', 'health_metrics_enabled', 'false'))
+    _dogstatsd_hostname = get_env('dogstatsd', 'host', 'localhost')
+    _dogstatsd_port = int(get_env('dogstatsd', 'port', 8125))
+    _fork_flush_timeout = float(get_env('tracer', 'fork_flush_timeout', DEFAULT_FORK_FLUSH_TIMEOUT))
+
+    def __init__(self, hostname='localhost', port=8126, uds_path=None, filters=None, priority_sampler=None,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, flush_min_traces=DEFAULT_FLUSH_MIN_TRACES,
+                 flush_min_bytes=DEFAULT_FLUSH_MIN_BYTES, encode_on_enqueue=None, max_buffer_size=MAX_BUFFER_SIZE,
+                 compression_level=None, spool_dir=None, spool_max_size=None, health_metrics_enabled=None,
+                 dogstatsd_hostname=None, dogstatsd_port=None, prioritize_errors=None, api_version=None,
+                 recycle_spans=None, fork_flush_timeout=None):
         self._pid = None
         self._traces = None
         self._worker = None
         self._filters = filters
         self._priority_sampler = priority_sampler
-        priority_sampling = priority_sampler is not None
-        self.api = api.API(hostname, port, priority_sampling=priority_sampling)
+        self._flush_interval = flush_interval
+        self._flush_min_traces = flush_min_traces
+        self._flush_min_bytes = flush_min_bytes
+        if encode_on_enqueue is not None:
+            self._encode_on_enqueue = encode_on_enqueue
+        self._max_buffer_size = max_buffer_size
+        if compression_level is not None:
+            self._compression_level = compression_level
+        if spool_dir is not None:
+            self._spool_dir = spool_dir
+        if spool_max_size is not None:
+            self._spool_max_size = spool_max_size
+        if api_version is not None:
+            self._api_version = api_version
+        if self._encode_on_enqueue and self._api_version == 'v0.5':
+            # DEV: the string table is built for each payload, traces can't be encoded before
+            log.warning('the v0.5 API can not be used when encoding traces on enqueue, using v0.4')
+            self._api_version = 'v0.4'
+        if recycle_spans is not None:
+            self._recycle_spans = recycle_spans
+        self.span_free_list = None
+        if self._recycle_spans:
+            if not self._encode_on_enqueue:
+                # DEV: otherwise the spans are referenced by the queue until they are sent
+                log.warning('spans can only be recycled when encoding traces on enqueue')
+            elif Context._partial_flush_enabled:
+                # DEV: the spans still opened reference their parent, that may be flushed before them
+                log.warning('spans can not be recycled when partial flush is enabled')
+            else:
+                self.span_free_list = SpanFreeList()
+        if prioritize_errors is not None:
+            self._prioritize_errors = prioritize_errors
+        if health_metrics_enabled is not None:
+            self._health_metrics_enabled = health_metrics_enabled
+        if dogstatsd_hostname is not None:
+            self._dogstatsd_hostname = dogstatsd_hostname
+        if dogstatsd_port is not None:
+            self._dogstatsd_port = dogstatsd_port
+        if fork_flush_timeout is not None:
+            self._fork_flush_timeout = fork_flush_timeout
+        self._metrics = HealthMetrics()
+        self._reporter = None
+        if self._health_metrics_enabled:
+            self._reporter = DogStatsdReporter(
+                self._metrics,
+                hostname=self._dogstatsd_hostname,
+                port=self._dogstatsd_port,
+                interval=HEALTH_METRICS_INTERVAL,
+                tags=['lang:python', 'tracer_version:{}'.format(ddtrace.__version__)],
+            )
+        self.api = self._create_api(
+            hostname,
+            port,
+            uds_path=uds_path,
+            priority_sampling=priority_sampler is not None,
+            compression_level=self._compression_level,
+            metrics=self._metrics,
+            version=self._api_version,
+        )
+        forksafe.register(before=self._before_fork, after_in_child=self._after_fork_in_child)
 
     def write(self, spans=None, services=None):
         # if the worker needs to be reset, do it.
-        self._reset_worker()
+        # DEV: the fork hooks reset the worker in the child process. Threads don't
+        #      survive a fork, so a dead worker is how forks are detected when
+        #      ``os.register_at_fork`` isn't available
+        if self._worker is None or (not forksafe.SUPPORTED and not self._worker.is_alive()):
+            self._reset_worker()
 
         if spans:
-            self._traces.add(spans)
+            if self._encode_on_enqueue:
+                self._write_encoded(spans)
+                if self.span_free_list is not None:
+                    self.span_free_list.release(spans)
+            else:
+                self._traces.add(spans, priority=spans[0].get_metric(SAMPLING_PRIORITY_KEY),
+                                 error=self._prioritize_errors and _has_error(spans))
+
+    def stats(self):
+        """
+        Return the health metrics of the writer, as a ``dict`` mapping the
+        metric names to their values:
+
+        * ``traces.enqueued``, ``traces.dropped``: traces added to the queue,
+          and dropped because it was full
+        * ``traces.dropped.<priority>``: traces dropped, by sampling priority
+          (``user_reject``, ``auto_reject``, ``auto_keep``, ``user_keep`` or
+          ``no_priority``)
+        * ``traces.sent``, ``traces.failed``: traces sent to the agent, and
+          that failed to be sent
+        * ``bytes.sent``: size of the payloads sent to the agent
+        * ``encode.time.*``, ``send.time.*``: ``count``, ``total`` and ``max``
+          durations (in seconds) of the traces encoding and payloads sending
+        * ``queue.depth``, ``queue.bytes``: traces currently in the queue, and
+          their size when encoded on enqueue
+
+        :rtype: dict
+        """
+        stats = self._metrics.snapshot()
+        traces = self._traces
+        stats['queue.depth'] = traces.size() if traces is not None else 0
+        stats['queue.bytes'] = traces.bytes() if traces is not None else 0
+        return stats
+
+    def _write_encoded(self, trace):
+        # DEV: filters must see the spans, so they are applied before encoding
+        try:
+            trace = _apply_filters(self._filters, trace)
+        except Exception as err:
+            log.error("error while filtering traces:{0}".format(err))
+            return
+        if not trace:
+            return
+
+        start = time.time()
+        try:
+            encoded = self.api.encoder.encode_trace(trace)
+        except Exception as err:
+            log.error("error while encoding trace:{0}".format(err))
+            self._metrics.increment('traces.dropped')
+            return
+        finally:
+            self._metrics.timing('encode.time', time.time() - start)
+        self._traces.add(encoded, len(encoded), priority=trace[0].get_metric(SAMPLING_PRIORITY_KEY),
+                         error=self._prioritize_errors and _has_error(trace))
+
+    def _before_fork(self):
+        # the traces are sent by the parent process only, the child process
+        # discards its copy of the queue
+        if self._worker is None or self._pid != os.getpid():
+            return
+        if self._fork_flush_timeout > 0:
+            self._worker.flush(self._fork_flush_timeout)
+        else:
+            # DEV: don't wait for the network, the worker sends them once the process is forked
+            self._traces.wake()
+
+    def _after_fork_in_child(self):
+        # the worker thread didn't survive the fork, and the queue and its lock
+        # may have been copied in any state: start from scratch on next write
+        self._pid = None
+        self._traces = None
+        self._worker = None
 
     def _reset_worker(self):
         # if this queue was created in a different process (i.e. this was
@@ -41,31 +272,63 @@ class AgentWriter(object):
         pid = os.getpid()
         if self._pid != pid:
             log.debug("resetting queues. pids(old:%s new:%s)", self._pid, pid)
-            self._traces = Q(max_size=MAX_TRACES)
+            if self._encode_on_enqueue:
+                self._traces = Q(
+                    max_size=0,
+                    max_bytes=self._max_buffer_size,
+                    flush_min_bytes=self._flush_min_bytes,
+                    metrics=self._metrics,
+                )
+            else:
+                self._traces = Q(
+                    max_size=MAX_TRACES,
+                    flush_min_size=self._flush_min_traces,
+                    flush_min_bytes=self._flush_min_bytes,
+                    metrics=self._metrics,
+                )
             self._worker = None
             self._pid = pid
 
         # ensure we have an active thread working on this queue
         if not self._worker or not self._worker.is_alive():
-            self._worker = AsyncWorker(
-                self.api,
-                self._traces,
-                filters=self._filters,
+            self._worker = self._create_worker(
+                filters=None if self._encode_on_enqueue else self._filters,
                 priority_sampler=self._priority_sampler,
+                flush_interval=self._flush_interval,
+                encoded=self._encode_on_enqueue,
+                metrics=self._metrics,
+                reporter=self._reporter,
             )
 
+    def _create_api(self, hostname, port, **kwargs):
+        """Create the API sending the traces to the agent with the given options"""
+        spool = Spool(self._spool_dir, max_size=self._spool_max_size) if self._spool_dir else None
+        return api.API(hostname, port, spool=spool, **kwargs)
+
+    def _create_worker(self, **kwargs):
+        """Create and start the worker sending the queued traces with the given options"""
+        return AsyncWorker(self.api, self._traces, **kwargs)
+
 
 class AsyncWorker(object):
 
     def __init__(self, api, trace_queue, service_queue=None, shutdown_timeout=DEFAULT_TIMEOUT,
-                 filters=None, priority_sampler=None):
+                 filters=None, priority_sampler=None, flush_interval=DEFAULT_FLUSH_INTERVAL, encoded=False,
+                 metrics=None, reporter=None):
         self._trace_queue = trace_queue
+        self._encoded = encoded
         self._lock = threading.Lock()
         self._thread = None
         self._shutdown_timeout = shutdown_timeout
+        self._flush_interval = flush_interval
         self._filters = filters
         self._priority_sampler = priority_sampler
         self._last_error_ts = 0
+        self._metrics = metrics or HealthMetrics()
+        self._reporter = reporter
+        # number of the last queue pop whose traces were sent
+        self._flushed = 0
+        self._flushed_cond = threading.Condition(threading.Lock())
         self.api = api
         self.start()
 
@@ -96,6 +359,28 @@ class AsyncWorker(object):
         """
         self._thread.join(timeout)
 
+    def flush(self, timeout):
+        """
+        Wake the worker up and wait up to ``timeout`` seconds for it to send
+        the traces queued so far, including the ones it is already sending.
+
+        :returns: Whether the traces were sent in time
+        :rtype: bool
+        """
+        if threading.current_thread() is self._thread or not self.is_alive():
+            return False
+        return self._wait_flushed(self._trace_queue.wake(), timeout)
+
+    def _wait_flushed(self, pop, timeout):
+        deadline = time.time() + timeout
+        with self._flushed_cond:
+            while self._flushed < pop:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._flushed_cond.wait(remaining)
+        return True
+
     def _on_shutdown(self):
         with self._lock:
             if not self._thread:
@@ -113,16 +398,18 @@ class AsyncWorker(object):
                     self._shutdown_timeout,
                     key,
                 )
-                timeout = time.time() + self._shutdown_timeout
-                while time.time() < timeout and self._trace_queue.size():
-                    # FIXME[matt] replace with a queue join
-                    time.sleep(0.05)
+                # the queue is closed so the worker flushes what is left and exits
+                self._thread.join(self._shutdown_timeout)
 
     def _target(self):
-        traces_response = None
-
         while True:
-            traces = self._trace_queue.pop()
+            # block until enough traces are queued, the flush interval expires
+            # or the queue is closed
+            traces = self._trace_queue.pop(timeout=self._flush_interval)
+            # DEV: this is the only consumer, the count is the one of this pop
+            pop = self._trace_queue.pops
+            traces_response = None
+            self._metrics.gauge('queue.depth', len(traces) if traces else 0)
             if traces:
                 # Before sending the traces, make them go through the
                 # filters
@@ -133,23 +420,41 @@ class AsyncWorker(object):
             if traces:
                 # If we have data, let's try to send it.
                 try:
-                    traces_response = self.api.send_traces(traces)
+                    if self._encoded:
+                        traces_response = self.api.send_traces(traces, encoded=True)
+                    else:
+                        traces_response = self.api.send_traces(traces)
+                except api._REQUEST_ERRORS as err:
+                    # DEV: the API records the traces of the payloads it fails to send
+                    log.error("cannot send spans to {1}: {0}".format(err, self.api))
                 except Exception as err:
-                    log.error("cannot send spans to {1}:{2}: {0}".format(err, self.api.hostname, self.api.port))
+                    log.error("cannot send spans to {1}: {0}".format(err, self.api))
+                    self._metrics.increment('traces.failed', len(traces))
+
+            self._process_response(traces_response)
+
+            with self._flushed_cond:
+                self._flushed = pop
+                self._flushed_cond.notify_all()
+
+            done = self._trace_queue.closed() and self._trace_queue.size() == 0
+            if self._reporter:
+                if done:
+                    self._reporter.report()
+                else:
+                    self._reporter.maybe_report()
 
-            if self._trace_queue.closed() and self._trace_queue.size() == 0:
+            if done:
                 # no traces and the queue is closed. our work is done
                 return
 
-            if self._priority_sampler and traces_response:
-                result_traces_json = traces_response.get_json()
-                if result_traces_json and 'rate_by_service' in result_traces_json:
-                    self._priority_sampler.set_sample_rate_by_service(result_traces_json['rate_by_service'])
+    def _process_response(self, response):
+        if self._priority_sampler and response:
+            result_traces_json = response.get_json()
+            if result_traces_json and 'rate_by_service' in result_traces_json:
+                self._priority_sampler.set_sample_rate_by_service(result_traces_json['rate_by_service'])
 
-            self._log_error_status(traces_response, "traces")
-            traces_response = None
-
-            time.sleep(1)  # replace with a blocking pop.
+        self._log_error_status(response, "traces")
 
     def _log_error_status(self, response, response_name):
         if not isinstance(response, api.Response):
@@ -178,55 +483,284 @@ class AsyncWorker(object):
         if self._filters is not None:
             filtered_traces = []
             for trace in traces:
-                for filtr in self._filters:
-                    trace = filtr.process_trace(trace)
-                    if trace is None:
-                        break
+                trace = _apply_filters(self._filters, trace)
                 if trace is not None:
                     filtered_traces.append(trace)
             return filtered_traces
         return traces
 
 
+def _has_error(trace):
+    """Whether any span of the given trace is an error"""
+    for span in trace:
+        if span.error:
+            return True
+    return False
+
+
+def _apply_filters(filters, trace):
+    """
+    Make the given trace go through the filters. Returns the filtered trace,
+    or ``None`` if a filter dropped it.
+    """
+    if filters is not None:
+        for filtr in filters:
+            trace = filtr.process_trace(trace)
+            if trace is None:
+                break
+    return trace
+
+
 class Q(object):
     """
     Q is a threadsafe queue that let's you pop everything at once and
     will randomly overwrite elements when it's over the max size.
+
+    Producers can report the size in bytes of each element with
+    ``add(thing, size)``: when ``max_bytes`` is set, elements are overwritten
+    as well to keep the queue under that size.
+
+    Elements are ranked by their sampling priority, then by their error flag:
+    the overwritten elements are picked among the lowest ranked ones, and new
+    elements ranking lower than the ones they would overwrite are dropped
+    instead.
+
+    Consumers can block in ``pop()`` until the queue holds at least
+    ``flush_min_size`` elements or ``flush_min_bytes`` bytes, the queue is
+    closed, or the given timeout expires.
+
+    The number of elements added and dropped are counted in the
+    ``traces.enqueued`` and ``traces.dropped`` ``metrics``, and the dropped
+    elements are also counted by priority, e.g. ``traces.dropped.auto_reject``.
     """
-    def __init__(self, max_size=1000):
+    def __init__(self, max_size=1000, flush_min_size=0, flush_min_bytes=0, max_bytes=0, metrics=None):
         self._things = []
+        self._sizes = []
+        self._priorities = []
+        self._element_ranks = []
+        # (priority, error) -> indexes of the elements with that rank
+        self._ranks = {}
+        # position of each element in the indexes of its rank
+        self._rank_positions = []
+        self._bytes = 0
         self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
         self._max_size = max_size
+        self._max_bytes = max_bytes
+        self._flush_min_size = flush_min_size
+        self._flush_min_bytes = flush_min_bytes
         self._closed = False
+        self._woken = False
+        self._ready_signaled = False
+        # number of times the queue was popped
+        self.pops = 0
+        # called when the queue becomes ready to be popped, for consumers not
+        # blocking in ``pop()``
+        self.on_ready = None
+        self._metrics = metrics or HealthMetrics()
 
     def size(self):
         with self._lock:
             return len(self._things)
 
+    def bytes(self):
+        """Return the sum of the sizes reported for the queued elements"""
+        with self._lock:
+            return self._bytes
+
     def close(self):
         with self._lock:
             self._closed = True
+            # wake up any consumer so that it can drain the queue
+            self._not_empty.notify_all()
 
     def closed(self):
         with self._lock:
             return self._closed
 
-    def add(self, thing):
+    def add(self, thing, size=0, priority=None, error=False):
+        """
+        Add an element to the queue.
+
+        :param thing: The element to add
+        :param int size: The size of the element, in bytes
+        :param int priority: The sampling priority of the trace, if any
+        :param bool error: Whether the trace is an error, which ranks it higher
+            than the other traces with the same priority
+        :returns: Whether the element was added
+        :rtype: bool
+        """
         with self._lock:
-            if self._closed:
-                return False
+            added, dropped_priorities = self._add(thing, size, priority, error)
+            signal = self._signal_ready()
+        # DEV: count outside of the queue lock so that producers don't wait on each other
+        if signal:
+            self.on_ready()
+        if added:
+            self._metrics.increment('traces.enqueued')
+        for dropped_priority in dropped_priorities:
+            self._metrics.increment('traces.dropped')
+            self._metrics.increment('traces.dropped.' + _PRIORITY_NAMES.get(dropped_priority, 'no_priority'))
+        return added
+
+    def _add(self, thing, size, priority, error):
+        """
+        Internal method that adds an element to the queue. Returns whether the
+        element was added and the priorities of the dropped elements.
 
-            if len(self._things) < self._max_size or self._max_size <= 0:
-                self._things.append(thing)
-                return True
-            else:
-                idx = random.randrange(0, len(self._things))
-                self._things[idx] = thing
+        Non-safe if not used with a lock.
+        """
+        if self._closed or 0 < self._max_bytes < size:
+            return False, [priority]
+
+        # DEV: traces without priority rank like the ones kept by the sampler
+        rank = (AUTO_KEEP if priority is None else priority, error)
+        count = 1 if 0 < self._max_size <= len(self._things) else 0
+        overflow = self._bytes + size - self._max_bytes if self._max_bytes > 0 else 0
+        dropped_priorities = []
+        if count or overflow > 0:
+            overwritten = self._pick_overwritten(rank, count, overflow)
+            if overwritten is None:
+                return False, [priority]
+            dropped_priorities = self._remove(overwritten)
+
+        indexes = self._ranks.setdefault(rank, [])
+        self._rank_positions.append(len(indexes))
+        indexes.append(len(self._things))
+        self._things.append(thing)
+        self._sizes.append(size)
+        self._priorities.append(priority)
+        self._element_ranks.append(rank)
+        self._bytes += size
+        if self._is_ready():
+            self._not_empty.notify()
+        return True, dropped_priorities
+
+    def _pick_overwritten(self, rank, count, size):
+        """
+        Internal method that picks at least ``count`` elements, and at least
+        ``size`` bytes, to overwrite with an element of the given rank: random
+        elements among the lowest ranked ones first. Returns their indexes, or
+        ``None`` if the new element ranks lower than the elements to overwrite.
 
-    def pop(self):
+        Non-safe if not used with a lock.
+        """
+        overwritten = []
+        for lowest in sorted(r for r, indexes in self._ranks.items() if indexes):
+            if lowest > rank:
+                return None
+            # DEV: shuffle the indexes as they are picked, so that each element of
+            #      the rank is picked independently and only the picked ones are drawn
+            indexes = list(self._ranks[lowest])
+            for i in range(len(indexes)):
+                j = random.randrange(i, len(indexes))
+                indexes[i], indexes[j] = indexes[j], indexes[i]
+                overwritten.append(indexes[i])
+                size -= self._sizes[indexes[i]]
+                if len(overwritten) >= count and size <= 0:
+                    return overwritten
+        return None
+
+    def _remove(self, indexes):
+        """
+        Internal method that removes the elements at the given indexes, moving
+        the last elements in their place. Returns the priorities of the removed
+        elements.
+
+        Non-safe if not used with a lock.
+        """
+        dropped_priorities = []
+        # DEV: remove the highest indexes first so that the last element is never one of the removed ones
+        for idx in sorted(indexes, reverse=True):
+            # remove the element from the indexes of its rank, moving the last index of the rank in its place
+            rank_indexes = self._ranks[self._element_ranks[idx]]
+            moved = rank_indexes.pop()
+            if moved != idx:
+                position = self._rank_positions[idx]
+                rank_indexes[position] = moved
+                self._rank_positions[moved] = position
+            dropped_priorities.append(self._priorities[idx])
+            self._bytes -= self._sizes[idx]
+
+            last = len(self._things) - 1
+            if idx != last:
+                self._ranks[self._element_ranks[last]][self._rank_positions[last]] = idx
+                self._things[idx] = self._things[last]
+                self._sizes[idx] = self._sizes[last]
+                self._priorities[idx] = self._priorities[last]
+                self._element_ranks[idx] = self._element_ranks[last]
+                self._rank_positions[idx] = self._rank_positions[last]
+            self._things.pop()
+            self._sizes.pop()
+            self._priorities.pop()
+            self._element_ranks.pop()
+            self._rank_positions.pop()
+        return dropped_priorities
+
+    def wake(self):
+        """
+        Wake the consumer up, so that it pops the queue without waiting for the flush thresholds
+
+        :returns: The number of the next pop, that returns the elements queued so far
+        :rtype: int
+        """
+        with self._lock:
+            self._woken = True
+            self._not_empty.notify_all()
+            pop = self.pops + 1
+            signal = self._signal_ready()
+        if signal:
+            self.on_ready()
+        return pop
+
+    def _signal_ready(self):
+        """
+        Internal method that checks if ``on_ready`` must be called, once per pop.
+
+        Non-safe if not used with a lock.
+        """
+        if self.on_ready is None or self._ready_signaled or not self._is_ready():
+            return False
+        self._ready_signaled = True
+        return True
+
+    def _is_ready(self):
+        """
+        Internal method that checks if a blocked consumer should be woken up.
+
+        Non-safe if not used with a lock.
+        """
+        if self._closed or self._woken:
+            return True
+        if self._flush_min_size > 0 and len(self._things) >= self._flush_min_size:
+            return True
+        if self._flush_min_bytes > 0 and self._bytes >= self._flush_min_bytes:
+            return True
+        return False
+
+    def pop(self, timeout=None):
+        """
+        Pop all the elements of the queue at once.
+
+        :param float timeout: if given, wait up to ``timeout`` seconds for the
+            queue to reach one of its flush thresholds or to be closed before
+            returning whatever it holds. By default it doesn't block.
+        :returns: the list of queued elements or ``None`` if the queue is empty
+        """
         with self._lock:
+            if timeout is not None and not self._is_ready():
+                self._not_empty.wait(timeout)
+            self._woken = False
+            self._ready_signaled = False
+            self.pops += 1
             if not self._things:
                 return None
             things = self._things
             self._things = []
+            self._sizes = []
+            self._priorities = []
+            self._element_ranks = []
+            self._ranks = {}
+            self._rank_positions = []
+            self._bytes = 0
             return things
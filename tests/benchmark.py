@@ -1,6 +1,27 @@
+import gc
+import mock
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
 import timeit
+from distutils.spawn import find_executable
 
 from ddtrace import Tracer
+from ddtrace.compat import contextvars, stringify
+from ddtrace.context import Context, LocalContext
+from ddtrace.provider import ContextVarsContextProvider, DefaultContextProvider
+from ddtrace.encoding import (
+    MSGPACK_CPP, Encoder, JSONEncoder, MsgpackEncoder, MsgpackStringTableEncoder, PythonMsgpackEncoder, get_encoder,
+)
+from ddtrace.internal import forksafe
+from ddtrace.internal.idgen import IDGenerator
+from ddtrace.payload import Payload
+from ddtrace.sampler import RateSampler
+from ddtrace.span import LazyTag, Span, SpanFreeList
+from ddtrace.writer import AgentWriter
 
 from .test_tracer import DummyWriter
 from os import getpid
@@ -73,6 +94,298 @@ def benchmark_tracer_wrap():
     print("- method execution time: {:8.6f}".format(min(result)))
 
 
+def _typical_trace(tracer):
+    # a web request with a few database and cache calls
+    with tracer.trace("flask.request", service="web", resource="GET /users/<id>", span_type="http") as root:
+        root.set_tag("http.method", "GET")
+        root.set_tag("http.url", "http://localhost:8080/users/42")
+        root.set_tag("http.status_code", 200)
+        for i in range(10):
+            with tracer.trace("postgres.query", service="postgres", resource="SELECT * FROM users WHERE id = %s",
+                              span_type="sql") as span:
+                span.set_tag("db.name", "users")
+                span.set_tag("out.host", "db.internal")
+                span.set_metric("db.rowcount", i)
+            with tracer.trace("redis.command", service="redis", resource="GET", span_type="redis") as span:
+                span.set_tag("redis.raw_command", "GET user:42:profile")
+                span.set_tag("out.host", "cache.internal")
+    return tracer.writer.pop()
+
+
+def benchmark_payload_compression():
+    tracer = Tracer()
+    tracer.writer = DummyWriter()
+
+    payload = Payload(encoder=get_encoder())
+    for _ in range(100):
+        payload.add_trace(_typical_trace(tracer))
+    data = payload.get_payload()
+
+    print("## payload compression benchmark: {} traces, {} bytes ##".format(payload.length, len(data)))
+    for level in (1, 6, 9):
+        timer = timeit.Timer(lambda: payload.get_compressed_payload(level))
+        result = timer.repeat(repeat=REPEAT, number=100)
+        size = len(payload.get_compressed_payload(level))
+        print("- level {}: {:8.6f}s per payload, {} bytes ({:.1%})".format(
+            level, min(result) / 100, size, float(size) / len(data),
+        ))
+
+
+def benchmark_encoder():
+    tracer = Tracer()
+    tracer.writer = DummyWriter()
+    trace = _typical_trace(tracer)
+    encoder = MsgpackEncoder()
+
+    print("## msgpack encoder benchmark: {} spans trace, {} loops ##".format(len(trace), NUMBER // 10))
+    # DEV: ``Encoder.encode_trace`` packs the ``Span.to_dict()`` representation of the spans
+    timer = timeit.Timer(lambda: Encoder.encode_trace(encoder, trace))
+    result = timer.repeat(repeat=REPEAT, number=NUMBER // 10)
+    print("- to_dict() execution time: {:8.6f}".format(min(result)))
+    timer = timeit.Timer(lambda: encoder.encode_trace(trace))
+    result = timer.repeat(repeat=REPEAT, number=NUMBER // 10)
+    print("- MsgpackEncoder execution time: {:8.6f}".format(min(result)))
+    if not MSGPACK_CPP:
+        return
+    # DEV: the alternative to the dict built for each span, one packer call per field
+    timer = timeit.Timer(lambda: _pack_span_fields(encoder._get_packer(), trace))
+    result = timer.repeat(repeat=REPEAT, number=NUMBER // 10)
+    print("- field by field execution time: {:8.6f}".format(min(result)))
+
+
+def _pack_span_fields(packer, trace):
+    pack = packer.pack
+    chunks = [packer.pack_array_header(len(trace))]
+    for span in trace:
+        fields = [
+            ('trace_id', span.trace_id),
+            ('parent_id', span.parent_id),
+            ('span_id', span.span_id),
+            ('service', span.service),
+            ('resource', span.resource),
+            ('name', span.name),
+            ('error', span.error),
+        ]
+        for name, value in (('start', span.start_ns), ('duration', span.duration_ns), ('meta', span._meta),
+                            ('metrics', span._metrics), ('type', span.span_type)):
+            if value:
+                fields.append((name, value))
+        chunks.append(packer.pack_map_header(len(fields)))
+        for name, value in fields:
+            chunks.append(pack(name))
+            chunks.append(pack(value))
+    return b''.join(chunks)
+
+
+def benchmark_string_table_encoder():
+    tracer = Tracer()
+    tracer.writer = DummyWriter()
+    traces = [_typical_trace(tracer) for _ in range(100)]
+
+    print("## string table encoder benchmark: {} traces payload ##".format(len(traces)))
+    for encoder in (MsgpackEncoder(), MsgpackStringTableEncoder()):
+        def encode():
+            payload = Payload(encoder=encoder)
+            for trace in traces:
+                payload.add_trace(trace)
+            return payload.get_payload()
+
+        result = timeit.Timer(encode).repeat(repeat=REPEAT, number=10)
+        print("- {}: {:8.6f}s per payload, {} bytes".format(
+            type(encoder).__name__, min(result) / 10, len(encode()),
+        ))
+
+
+def benchmark_python_encoder():
+    _benchmark_python_encoder()
+
+    # DEV: the pure Python packer matters most on PyPy, where the msgpack C extension isn't used
+    if platform.python_implementation() == 'PyPy':
+        return
+    pypy = os.environ.get('DD_BENCHMARK_PYPY') or find_executable('pypy3') or find_executable('pypy')
+    if not pypy:
+        print("## pure Python encoder benchmark: PyPy not found, set DD_BENCHMARK_PYPY to run it ##")
+        return
+    subprocess.call(
+        [pypy, '-c', 'from tests.benchmark import _benchmark_python_encoder; _benchmark_python_encoder()'],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+
+
+def _benchmark_python_encoder():
+    tracer = Tracer()
+    tracer.writer = DummyWriter()
+    traces = [_typical_trace(tracer) for _ in range(100)]
+
+    print("## pure Python encoder benchmark: {} traces payload, {} {} ##".format(
+        len(traces), platform.python_implementation(), platform.python_version(),
+    ))
+    # DEV: the C extension is only there for comparison, the pure Python packer replaces the JSON encoder
+    encoders = [JSONEncoder(), PythonMsgpackEncoder()]
+    if MSGPACK_CPP:
+        encoders.append(MsgpackEncoder())
+    for encoder in encoders:
+        def encode():
+            payload = Payload(encoder=encoder)
+            for trace in traces:
+                payload.add_trace(trace)
+            return payload.get_payload()
+
+        result = timeit.Timer(encode).repeat(repeat=REPEAT, number=10)
+        print("- {}: {:8.6f}s per payload, {} bytes".format(
+            type(encoder).__name__, min(result) / 10, len(encode()),
+        ))
+
+
+class FlushingWriter(object):
+    """Writer encoding the traces by batches of ``flush_size``, like ``AgentWriter`` flushing its queue"""
+    def __init__(self, recycle_spans, flush_size=100):
+        self.encoder = MsgpackEncoder()
+        self.span_free_list = SpanFreeList() if recycle_spans else None
+        self.flush_size = flush_size
+        self.traces = []
+
+    def write(self, spans=None, services=None):
+        self.traces.append(spans)
+        if len(self.traces) < self.flush_size:
+            return
+        self.encoder.encode_traces(self.traces)
+        if self.span_free_list is not None:
+            for trace in self.traces:
+                self.span_free_list.release(trace)
+        self.traces = []
+
+
+def benchmark_span_allocations():
+    try:
+        import tracemalloc
+    except ImportError:
+        # DEV: Python 2 and PyPy don't have tracemalloc
+        print("## span allocations benchmark: skipped, tracemalloc is not available ##")
+        return
+
+    def trace(tracer):
+        with tracer.trace("web.request", service="web", resource="GET /"):
+            for _ in range(5):
+                # DEV: most of the spans have no tag
+                with tracer.trace("template.render"):
+                    pass
+
+    span_init = Span.__init__
+    allocated = []
+
+    def counting_init(self, *args, **kwargs):
+        # DEV: the slots of new spans are not set yet, recycled spans are initialized again
+        if not hasattr(self, 'name'):
+            allocated.append(None)
+        span_init(self, *args, **kwargs)
+
+    def eager_meta_init(self, *args, **kwargs):
+        # DEV: spans used to allocate their tags dicts when initialized
+        counting_init(self, *args, **kwargs)
+        self._meta = {}
+        self._metrics = {}
+
+    number = NUMBER // 10
+    print("## span allocations benchmark: {} traces of 6 spans, flushed by 100 ##".format(number))
+    for eager_meta, recycle_spans in ((True, False), (False, False), (False, True)):
+        tracer = Tracer()
+        tracer.writer = FlushingWriter(recycle_spans)
+        with mock.patch.object(Span, '__init__', eager_meta_init if eager_meta else counting_init):
+            # DEV: fill the free list up, like in a running application
+            for _ in range(tracer.writer.flush_size):
+                trace(tracer)
+            del allocated[:]
+            gc.collect()
+            collections = [stats['collections'] for stats in gc.get_stats()]
+            tracemalloc.start()
+            start = time.time()
+            for _ in range(number):
+                trace(tracer)
+            duration = time.time() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            collections = [stats['collections'] - c for stats, c in zip(gc.get_stats(), collections)]
+
+        print("- eager_meta={} recycle_spans={}: {:8.6f}s, {} spans allocated, {} GC collections by generation, "
+              "{} bytes peak".format(eager_meta, recycle_spans, duration, len(allocated), collections, peak))
+
+
+def benchmark_context():
+    span = Span(tracer=None, name='a')
+
+    # DEV: the calls made by the tracer for each span of a trace
+    def trace(ctx):
+        ctx.get_current_span()
+        ctx.trace_id
+        ctx.span_id
+        ctx.add_span(span)
+        ctx.close_span(span)
+        ctx.get()
+
+    print("## context benchmark: {} spans ##".format(NUMBER))
+    for context_class in (Context, LocalContext):
+        ctx = context_class()
+        result = timeit.Timer(lambda: trace(ctx)).repeat(repeat=REPEAT, number=NUMBER)
+        print("- {}: {:8.6f}".format(context_class.__name__, min(result)))
+
+
+def benchmark_context_providers():
+    try:
+        import asyncio
+        from ddtrace.contrib.asyncio.provider import AsyncioContextProvider
+    except ImportError:
+        # DEV: Python 2 doesn't have asyncio
+        print("## context providers benchmark: skipped, asyncio is not available ##")
+        return
+
+    providers = [DefaultContextProvider(), AsyncioContextProvider()]
+    if contextvars is not None:
+        providers.append(ContextVarsContextProvider())
+
+    print("## context providers benchmark: {} lookups in a task ##".format(NUMBER))
+    loop = asyncio.new_event_loop()
+    for provider in providers:
+        @asyncio.coroutine
+        def lookup():
+            provider.active().add_span(Span(tracer=None, name='a'))
+            return timeit.Timer(provider.active).repeat(repeat=REPEAT, number=NUMBER)
+
+        result = loop.run_until_complete(lookup())
+        print("- {}: {:8.6f}".format(type(provider).__name__, min(result)))
+    loop.close()
+
+
+def benchmark_partial_flush():
+    def trace(tracer):
+        with tracer.trace("batch"):
+            # DEV: long running spans stay opened while the other spans are flushed
+            opened = [tracer.trace("worker") for _ in range(100)]
+            for _ in range(10000):
+                with tracer.trace("item"):
+                    pass
+            for span in reversed(opened):
+                span.finish()
+
+    print("## partial flush benchmark: 10100 spans, 100 opened ##")
+    tracer = Tracer()
+    tracer.writer = DummyWriter()
+    with mock.patch.object(Context, '_partial_flush_enabled', True), \
+            mock.patch.object(Context, '_partial_flush_min_spans', 500):
+        result = timeit.Timer(lambda: trace(tracer)).repeat(repeat=REPEAT, number=1)
+    print("- trace execution time: {:8.6f}".format(min(result)))
+
+
+def benchmark_id_generator():
+    generator = IDGenerator()
+    rand = random.Random()
+
+    print("## id generator benchmark: {} ids ##".format(NUMBER))
+    for name, new_id in (('getrandbits', lambda: rand.getrandbits(64)), ('IDGenerator', generator.new_id)):
+        result = timeit.Timer(new_id).repeat(repeat=REPEAT, number=NUMBER)
+        print("- {}: {:8.6f}".format(name, min(result)))
+
+
 def benchmark_getpid():
     timer = timeit.Timer(getpid)
     result = timer.repeat(repeat=REPEAT, number=NUMBER)
@@ -80,7 +393,102 @@ def benchmark_getpid():
     print("- getpid execution time: {:8.6f}".format(min(result)))
 
 
+class NullQueue(object):
+    """Queue dropping the traces, to only measure ``AgentWriter.write()``"""
+    def add(self, thing, size=0, priority=None, error=False):
+        pass
+
+
+def benchmark_writer_write():
+    writer = AgentWriter(flush_interval=3600)
+    writer.api = mock.Mock()
+    trace = [Span(None, 'a')]
+    writer.write(trace)
+    worker, writer._traces = writer._worker, NullQueue()
+
+    print("## AgentWriter.write() benchmark: {} loops ##".format(NUMBER))
+    for name, supported in (('fork hooks', True), ('worker check', False)):
+        with mock.patch.object(forksafe, 'SUPPORTED', supported):
+            result = timeit.Timer(lambda: writer.write(trace)).repeat(repeat=REPEAT, number=NUMBER)
+        print("- {}: {:8.6f}".format(name, min(result)))
+    worker.stop()
+
+
+def benchmark_exc_info():
+    try:
+        _raise_nested(10)
+    except ValueError:
+        exc_info = sys.exc_info()
+
+    def set_exc_info():
+        Span(None, 'a').set_exc_info(*exc_info)
+
+    def set_exc_info_and_encode():
+        span = Span(None, 'a')
+        span.set_exc_info(*exc_info)
+        span.to_dict()
+
+    print("## span.set_exc_info() benchmark: {} loops ##".format(NUMBER))
+    for name, func in (('set_exc_info', set_exc_info), ('set_exc_info + encoding', set_exc_info_and_encode)):
+        result = timeit.Timer(func).repeat(repeat=REPEAT, number=NUMBER)
+        print("- {}: {:8.6f}".format(name, min(result)))
+
+
+def _raise_nested(depth):
+    if depth:
+        _raise_nested(depth - 1)
+    raise ValueError('error')
+
+
+def benchmark_lazy_tag():
+    query = {'$or': [{'age': {'$lt': i}} for i in range(20)]}
+
+    def set_tag():
+        Span(None, 'a').set_tag('query', query)
+
+    def set_lazy_tag():
+        Span(None, 'a').set_tag('query', LazyTag(stringify, query))
+
+    print("## span.set_tag() benchmark: {} loops ##".format(NUMBER))
+    for name, func in (('set_tag', set_tag), ('set_tag with LazyTag', set_lazy_tag)):
+        result = timeit.Timer(func).repeat(repeat=REPEAT, number=NUMBER)
+        print("- {}: {:8.6f}".format(name, min(result)))
+
+
+def benchmark_noop_unsampled_spans():
+    def trace(tracer):
+        with tracer.trace("a", service="s", resource="r", span_type="t") as s:
+            s.set_tag("a", "b")
+            s.set_tag("b", 1)
+            with tracer.trace("another.thing"):
+                pass
+            with tracer.trace("another.thing"):
+                pass
+
+    print("## tracer.trace() benchmark with a 1% sample rate: {} loops ##".format(NUMBER))
+    for noop_unsampled_spans in (False, True):
+        tracer = Tracer()
+        tracer.writer = DummyWriter()
+        tracer.sampler = RateSampler(0.01)
+        tracer.configure(noop_unsampled_spans=noop_unsampled_spans)
+        result = timeit.Timer(lambda: trace(tracer)).repeat(repeat=REPEAT, number=NUMBER)
+        print("- noop_unsampled_spans={}: {:8.6f}".format(noop_unsampled_spans, min(result)))
+
+
 if __name__ == '__main__':
     benchmark_tracer_wrap()
     benchmark_tracer_trace()
     benchmark_getpid()
+    benchmark_writer_write()
+    benchmark_payload_compression()
+    benchmark_encoder()
+    benchmark_string_table_encoder()
+    benchmark_python_encoder()
+    benchmark_span_allocations()
+    benchmark_context()
+    benchmark_context_providers()
+    benchmark_partial_flush()
+    benchmark_id_generator()
+    benchmark_exc_info()
+    benchmark_lazy_tag()
+    benchmark_noop_unsampled_spans()
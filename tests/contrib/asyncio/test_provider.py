@@ -0,0 +1,76 @@
+# flake8: noqa
+# DEV: Skip linting, we lint with Python 2, we'll get SyntaxErrors from `yield from`
+import asyncio
+import unittest
+
+from ddtrace.compat import contextvars
+from ddtrace.provider import ContextVarsContextProvider
+
+from .utils import AsyncioTestCase, mark_asyncio
+
+
+@unittest.skipIf(contextvars is None, 'contextvars requires Python 3.7+')
+class ContextVarsProviderTest(AsyncioTestCase):
+    def setUp(self):
+        super(ContextVarsProviderTest, self).setUp()
+        self.tracer.configure(context_provider=ContextVarsContextProvider())
+
+    @mark_asyncio
+    def test_task_inherits_trace(self):
+        @asyncio.coroutine
+        def child():
+            with self.tracer.trace('child'):
+                yield from asyncio.sleep(0)
+
+        with self.tracer.trace('root') as root:
+            yield from asyncio.ensure_future(child())
+
+        # DEV: the spans of the task are flushed from its own context
+        traces = self.tracer.writer.pop_traces()
+        self.assertEqual([[span.name for span in trace] for trace in traces], [['child'], ['root']])
+        self.assertEqual(traces[0][0].trace_id, root.trace_id)
+        self.assertEqual(traces[0][0].parent_id, root.span_id)
+
+    @mark_asyncio
+    def test_concurrent_tasks_parents(self):
+        @asyncio.coroutine
+        def child(i):
+            with self.tracer.trace('child{}'.format(i)):
+                yield from asyncio.sleep(0)
+                with self.tracer.trace('grandchild{}'.format(i)):
+                    yield from asyncio.sleep(0)
+                yield from asyncio.sleep(0)
+
+        with self.tracer.trace('root') as root:
+            yield from asyncio.gather(child(1), child(2))
+            with self.tracer.trace('after'):
+                pass
+
+        spans = {span.name: span for trace in self.tracer.writer.pop_traces() for span in trace}
+        self.assertEqual(len(spans), 6)
+        for span in spans.values():
+            self.assertEqual(span.trace_id, root.trace_id)
+        for i in (1, 2):
+            self.assertEqual(spans['child{}'.format(i)].parent_id, root.span_id)
+            self.assertEqual(spans['grandchild{}'.format(i)].parent_id, spans['child{}'.format(i)].span_id)
+        self.assertEqual(spans['after'].parent_id, root.span_id)
+
+    @mark_asyncio
+    def test_tasks_do_not_share_idle_context(self):
+        # DEV: the idle Context of the main task is inherited by the other tasks
+        self.tracer.get_call_context()
+        contexts = []
+
+        @asyncio.coroutine
+        def task(name):
+            with self.tracer.trace(name):
+                contexts.append(self.tracer.get_call_context())
+                yield from asyncio.sleep(0)
+
+        yield from asyncio.gather(task('a'), task('b'))
+
+        self.assertIsNot(contexts[0], contexts[1])
+        traces = self.tracer.writer.pop_traces()
+        self.assertEqual(sorted(t[0].name for t in traces), ['a', 'b'])
+        self.assertEqual([len(t) for t in traces], [1, 1])
+        self.assertNotEqual(traces[0][0].trace_id, traces[1][0].trace_id)
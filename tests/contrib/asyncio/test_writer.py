@@ -0,0 +1,271 @@
+# flake8: noqa
+# DEV: Skip linting, we lint with Python 2, we'll get SyntaxErrors from `yield from`
+import asyncio
+import threading
+
+from ddtrace.contrib.asyncio import AsyncioWriter
+from ddtrace.contrib.asyncio.writer import AsyncioAPI
+from ddtrace.encoding import MsgpackEncoder
+from ddtrace.internal.retry import RetryPolicy
+from ddtrace.span import Span
+
+from .utils import AsyncioTestCase, mark_asyncio
+
+
+class AgentStub(object):
+    """
+    Trace agent answering the requests it receives with the given status, and
+    closing the connection after the body when ``close_delimited`` is set
+    """
+    def __init__(self, status=200, body=b'{}', close_delimited=False):
+        self.status = status
+        self.body = body
+        self.close_delimited = close_delimited
+        self.requests = []
+        self.connections = 0
+        self.active = 0
+        self.server = None
+
+    @asyncio.coroutine
+    def start(self):
+        self.server = yield from asyncio.start_server(self._handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    @asyncio.coroutine
+    def wait_disconnected(self):
+        """Wait for the clients to close their connections"""
+        for _ in range(1000):
+            if not self.active:
+                return
+            yield from asyncio.sleep(0.001)
+
+    @asyncio.coroutine
+    def _handle(self, reader, writer):
+        self.connections += 1
+        self.active += 1
+        while True:
+            request_line = yield from reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while True:
+                line = yield from reader.readline()
+                if line == b'\r\n':
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = yield from reader.readexactly(int(headers['content-length']))
+            self.requests.append((request_line.decode('latin-1').split(' ')[1], headers, body))
+            if self.close_delimited:
+                writer.write('HTTP/1.1 {0} Status\r\n\r\n'.format(self.status).encode('latin-1') + self.body)
+                break
+            writer.write('HTTP/1.1 {0} Status\r\nContent-Length: {1}\r\n\r\n'.format(
+                self.status, len(self.body)).encode('latin-1') + self.body)
+        writer.close()
+        self.active -= 1
+
+
+def _trace(trace_id):
+    return [Span(tracer=None, name='name', trace_id=trace_id, span_id=j) for j in range(1, 4)]
+
+
+class AsyncioAPITest(AsyncioTestCase):
+    def setUp(self):
+        super(AsyncioAPITest, self).setUp()
+        self.agent = AgentStub()
+
+    def tearDown(self):
+        self.agent.close()
+        super(AsyncioAPITest, self).tearDown()
+
+    @mark_asyncio
+    def test_send_traces(self):
+        port = yield from self.agent.start()
+        api = AsyncioAPI('127.0.0.1', port, encoder=MsgpackEncoder())
+        responses = yield from api._send_payloads([_trace(1), _trace(2)])
+        response = yield from api.send_traces([_trace(3)])
+        api.close()
+        yield from self.agent.wait_disconnected()
+
+        self.assertEqual([r.status for r in responses], [200])
+        self.assertEqual(responses[0].body, b'{}')
+        self.assertEqual(response.status, 200)
+        # the connection is kept alive between the requests
+        self.assertEqual(self.agent.connections, 1)
+        self.assertEqual(len(self.agent.requests), 2)
+        endpoint, headers, body = self.agent.requests[0]
+        self.assertEqual(endpoint, '/v0.3/traces')
+        self.assertEqual(headers['x-datadog-trace-count'], '2')
+        self.assertEqual(headers['content-type'], 'application/msgpack')
+        self.assertEqual([t[0][b'trace_id'] for t in MsgpackEncoder().decode(body)], [1, 2])
+
+        stats = api.metrics.snapshot()
+        self.assertEqual(stats['traces.sent'], 3)
+        self.assertEqual(stats['encode.time.count'], 3)
+        self.assertGreaterEqual(stats['loop.time.count'], 2)
+
+    @mark_asyncio
+    def test_send_traces_yields(self):
+        port = yield from self.agent.start()
+        api = AsyncioAPI('127.0.0.1', port, encoder=MsgpackEncoder(), max_blocking_time=0)
+        ticks = []
+
+        @asyncio.coroutine
+        def other_task():
+            for _ in range(3):
+                ticks.append(api.metrics.snapshot().get('encode.time.count', 0))
+                yield from asyncio.sleep(0)
+
+        task = asyncio.ensure_future(other_task())
+        yield from api.send_traces([_trace(i) for i in range(1, 5)])
+        yield from task
+        api.close()
+        yield from self.agent.wait_disconnected()
+
+        # the other task ran while the traces were being encoded
+        self.assertTrue(any(0 < tick < 4 for tick in ticks))
+        self.assertGreaterEqual(api.metrics.snapshot()['loop.time.count'], 4)
+
+    @mark_asyncio
+    def test_send_traces_close_delimited(self):
+        self.agent.close_delimited = True
+        port = yield from self.agent.start()
+        api = AsyncioAPI('127.0.0.1', port, request_timeout=5)
+        responses = []
+        for i in range(2):
+            response = yield from api.send_traces([_trace(i)])
+            responses.append(response)
+        api.close()
+
+        # the body is read until the agent closes the connection, that isn't reused
+        self.assertEqual([(r.status, r.body) for r in responses], [(200, b'{}')] * 2)
+        self.assertEqual(self.agent.connections, 2)
+
+    @mark_asyncio
+    def test_send_traces_error(self):
+        self.agent.status = 500
+        port = yield from self.agent.start()
+        api = AsyncioAPI('127.0.0.1', port, retry_policy=RetryPolicy(max_attempts=2, initial_wait=0))
+        response = yield from api.send_traces([_trace(1)])
+        api.close()
+        yield from self.agent.wait_disconnected()
+
+        self.assertEqual(response.status, 500)
+        self.assertEqual(len(self.agent.requests), 2)
+        self.assertEqual(api.metrics.snapshot()['traces.failed'], 1)
+
+    @mark_asyncio
+    def test_send_traces_connection_refused(self):
+        port = yield from self.agent.start()
+        self.agent.close()
+        yield from self.agent.server.wait_closed()
+        self.agent.server = None
+        api = AsyncioAPI('127.0.0.1', port, retry_policy=RetryPolicy(max_attempts=1))
+        responses = yield from api._send_payloads([_trace(1)])
+        self.assertIsInstance(responses[0], OSError)
+        with self.assertRaises(OSError):
+            yield from api.send_traces([_trace(1)])
+
+
+class AsyncioWriterTest(AsyncioTestCase):
+    def setUp(self):
+        super(AsyncioWriterTest, self).setUp()
+        self.agent = AgentStub()
+
+    def tearDown(self):
+        self.agent.close()
+        super(AsyncioWriterTest, self).tearDown()
+
+    @mark_asyncio
+    def test_write(self):
+        port = yield from self.agent.start()
+        writer = AsyncioWriter('127.0.0.1', port, loop=self.loop, flush_interval=60)
+        writer.write(_trace(1))
+        writer.write(_trace(2))
+        # let the flush task start
+        yield from asyncio.sleep(0)
+        self.assertTrue(writer._worker.is_alive())
+        # the loop thread cannot wait for the flush task
+        self.assertFalse(writer._worker.flush(5))
+
+        writer._worker.stop()
+        yield from asyncio.wait_for(writer._worker._task, 5)
+        self.assertFalse(writer._worker.is_alive())
+
+        self.assertEqual(len(self.agent.requests), 1)
+        self.assertEqual(self.agent.requests[0][1]['x-datadog-trace-count'], '2')
+        stats = writer.stats()
+        self.assertEqual(stats['traces.enqueued'], 2)
+        self.assertEqual(stats['traces.sent'], 2)
+        self.assertGreater(stats['loop.time.count'], 0)
+        writer.api.close()
+        yield from self.agent.wait_disconnected()
+
+    @mark_asyncio
+    def test_write_flush_min_traces(self):
+        port = yield from self.agent.start()
+        writer = AsyncioWriter('127.0.0.1', port, loop=self.loop, flush_interval=60, flush_min_traces=2)
+        writer.write(_trace(1))
+        yield from asyncio.sleep(0.01)
+        self.assertEqual(writer._traces.size(), 1)
+
+        # the flush task is woken up once enough traces are queued
+        writer.write(_trace(2))
+        for _ in range(100):
+            if self.agent.requests:
+                break
+            yield from asyncio.sleep(0.01)
+        self.assertEqual(len(self.agent.requests), 1)
+        self.assertEqual(self.agent.requests[0][1]['x-datadog-trace-count'], '2')
+
+        writer._worker.stop()
+        yield from asyncio.wait_for(writer._worker._task, 5)
+        writer.api.close()
+        yield from self.agent.wait_disconnected()
+
+    def test_spool_not_created(self):
+        writer = AsyncioWriter(spool_dir='/nonexistent')
+        self.assertIsInstance(writer.api, AsyncioAPI)
+        self.assertIsNone(writer.api.spool)
+
+    def test_write_dedicated_loop(self):
+        ready = threading.Event()
+        port = []
+
+        # run the agent in its own loop so that the writer loop is independent
+        agent_loop = asyncio.new_event_loop()
+
+        def run_agent():
+            asyncio.set_event_loop(agent_loop)
+            port.append(agent_loop.run_until_complete(self.agent.start()))
+            ready.set()
+            agent_loop.run_forever()
+
+        agent_thread = threading.Thread(target=run_agent)
+        agent_thread.start()
+        try:
+            self.assertTrue(ready.wait(5))
+            writer = AsyncioWriter('127.0.0.1', port[0], flush_interval=60)
+            writer.write(_trace(1))
+            self.assertIsNot(writer._loop, self.loop)
+            self.assertTrue(writer._loop_thread.is_alive())
+
+            # other threads can wait for the flush task to send the queued traces
+            self.assertTrue(writer._worker.flush(5))
+            self.assertEqual(len(self.agent.requests), 1)
+
+            writer._worker.stop()
+            writer._worker.join(5)
+            self.assertFalse(writer._worker.is_alive())
+            self.assertEqual(len(self.agent.requests), 1)
+            writer._loop.call_soon_threadsafe(writer.api.close)
+            asyncio.run_coroutine_threadsafe(self.agent.wait_disconnected(), agent_loop).result(5)
+        finally:
+            agent_loop.call_soon_threadsafe(self.agent.close)
+            agent_loop.call_soon_threadsafe(agent_loop.stop)
+            agent_thread.join(5)
+            self.agent.server = None
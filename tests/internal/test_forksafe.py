@@ -0,0 +1,99 @@
+import os
+
+import mock
+
+from ddtrace.internal import forksafe
+
+from ..base import BaseTestCase
+
+
+class Hooks(object):
+    def __init__(self):
+        self.calls = []
+
+    def before(self):
+        self.calls.append('before')
+
+    def after_in_child(self):
+        self.calls.append('after_in_child')
+
+    def after_in_parent(self):
+        self.calls.append('after_in_parent')
+
+
+@mock.patch.object(forksafe, 'SUPPORTED', True)
+class ForksafeTestCase(BaseTestCase):
+    def setUp(self):
+        super(ForksafeTestCase, self).setUp()
+        self.hooks = (forksafe._before, forksafe._after_in_child, forksafe._after_in_parent)
+        forksafe._before = []
+        forksafe._after_in_child = []
+        forksafe._after_in_parent = []
+
+    def tearDown(self):
+        forksafe._before, forksafe._after_in_child, forksafe._after_in_parent = self.hooks
+        super(ForksafeTestCase, self).tearDown()
+
+    def test_run_hooks(self):
+        hooks = Hooks()
+        forksafe.register(before=hooks.before, after_in_child=hooks.after_in_child,
+                          after_in_parent=hooks.after_in_parent)
+
+        forksafe._run_before()
+        forksafe._run_after_in_parent()
+        forksafe._run_after_in_child()
+        self.assertEqual(hooks.calls, ['before', 'after_in_parent', 'after_in_child'])
+
+    def test_before_reverse_order(self):
+        calls = []
+        forksafe.register(before=lambda: calls.append(1))
+        forksafe.register(before=lambda: calls.append(2))
+        forksafe._run_before()
+        self.assertEqual(calls, [2, 1])
+
+    def test_weak_methods(self):
+        hooks = Hooks()
+        forksafe.register(before=hooks.before)
+        self.assertEqual(len(forksafe._before), 1)
+
+        del hooks
+        forksafe._run_before()
+        self.assertEqual(forksafe._before, [])
+
+    def test_hook_exception(self):
+        calls = []
+
+        def failing():
+            raise Exception('boom')
+
+        forksafe.register(after_in_child=failing)
+        forksafe.register(after_in_child=lambda: calls.append(1))
+        forksafe._run_after_in_child()
+        self.assertEqual(calls, [1])
+
+    def test_unsupported(self):
+        with mock.patch.object(forksafe, 'SUPPORTED', False):
+            forksafe.register(before=lambda: None)
+        self.assertEqual(forksafe._before, [])
+
+
+class ForksafeForkTestCase(BaseTestCase):
+    def test_fork(self):
+        if not forksafe.SUPPORTED:
+            self.skipTest('os.register_at_fork is not available')
+
+        r, w = os.pipe()
+        hooks = Hooks()
+        forksafe.register(before=hooks.before, after_in_child=hooks.after_in_child,
+                          after_in_parent=hooks.after_in_parent)
+
+        pid = os.fork()
+        if pid == 0:
+            os.write(w, ','.join(hooks.calls).encode('ascii'))
+            os._exit(0)
+
+        os.waitpid(pid, 0)
+        os.close(w)
+        self.assertEqual(os.read(r, 1024), b'before,after_in_child')
+        os.close(r)
+        self.assertEqual(hooks.calls, ['before', 'after_in_parent'])
@@ -0,0 +1,91 @@
+import socket
+
+import mock
+
+from ddtrace.internal.health import DogStatsdReporter, HealthMetrics
+
+from ..base import BaseTestCase
+
+
+class HealthMetricsTestCase(BaseTestCase):
+    def test_snapshot(self):
+        metrics = HealthMetrics()
+        metrics.increment('traces.sent')
+        metrics.increment('traces.sent', 2)
+        metrics.gauge('queue.depth', 4)
+        metrics.gauge('queue.depth', 3)
+        metrics.timing('send.time', 0.5)
+        metrics.timing('send.time', 0.25)
+
+        self.assertEqual(metrics.snapshot(), {
+            'traces.sent': 3,
+            'queue.depth': 3,
+            'send.time.count': 2,
+            'send.time.total': 0.75,
+            'send.time.max': 0.5,
+        })
+
+    def test_collect_copies(self):
+        metrics = HealthMetrics()
+        metrics.timing('send.time', 0.5)
+        counters, gauges, timers = metrics.collect()
+        metrics.timing('send.time', 0.5)
+        self.assertEqual(timers, {'send.time': (1, 0.5, 0.5)})
+
+
+class DogStatsdReporterTestCase(BaseTestCase):
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(5)
+        self.metrics = HealthMetrics()
+        self.reporter = DogStatsdReporter(
+            self.metrics, hostname='127.0.0.1', port=self.server.getsockname()[1], tags=['lang:python'],
+        )
+
+    def tearDown(self):
+        self.server.close()
+
+    def _receive(self):
+        return self.server.recv(65535).decode('utf-8').split('\n')
+
+    def test_report(self):
+        self.metrics.increment('traces.sent', 2)
+        self.metrics.gauge('queue.depth', 3)
+        self.metrics.timing('send.time', 0.5)
+        self.metrics.timing('send.time', 0.25)
+        self.reporter.report()
+        self.assertEqual(self._receive(), [
+            'datadog.tracer.traces.sent:2|c|#lang:python',
+            'datadog.tracer.queue.depth:3|g|#lang:python',
+            'datadog.tracer.send.time:375.000|ms|#lang:python',
+        ])
+
+        # counters and timers are reported since the previous report
+        self.metrics.increment('traces.sent')
+        self.metrics.increment('traces.failed')
+        self.metrics.timing('send.time', 0.1)
+        self.reporter.report()
+        self.assertEqual(self._receive(), [
+            'datadog.tracer.traces.failed:1|c|#lang:python',
+            'datadog.tracer.traces.sent:1|c|#lang:python',
+            'datadog.tracer.queue.depth:3|g|#lang:python',
+            'datadog.tracer.send.time:100.000|ms|#lang:python',
+        ])
+
+    def test_maybe_report(self):
+        self.reporter.interval = 60
+        with mock.patch.object(self.reporter, 'report') as report:
+            self.reporter.maybe_report()
+            report.assert_not_called()
+            self.reporter._last_report -= 60
+            self.reporter.maybe_report()
+            report.assert_called_once_with()
+
+    def test_report_error(self):
+        self.metrics.increment('traces.sent')
+        # errors are logged and ignored
+        with mock.patch('ddtrace.internal.health.socket.socket') as sock:
+            sock.return_value.sendto.side_effect = socket.error('unreachable')
+            self.reporter.report()
+        sock.return_value.sendto.assert_called_once()
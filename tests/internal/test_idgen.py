@@ -0,0 +1,79 @@
+import os
+import struct
+
+import mock
+
+from ddtrace.internal import forksafe
+from ddtrace.internal.idgen import IDGenerator
+
+from ..base import BaseTestCase
+
+
+class IDGeneratorTestCase(BaseTestCase):
+    def test_new_id(self):
+        generator = IDGenerator(batch_size=16)
+        ids = [generator.new_id() for _ in range(100)]
+        self.assertEqual(len(set(ids)), 100)
+        for id_ in ids:
+            self.assertTrue(0 <= id_ < 2 ** 64)
+        # the last batch was partially used
+        self.assertEqual(len(generator._ids), 12)
+
+    def test_seed(self):
+        generator = IDGenerator(batch_size=16)
+        generator.new_id()
+        generator.seed(1234)
+        ids = [generator.new_id() for _ in range(20)]
+
+        other = IDGenerator(batch_size=16)
+        other.seed(1234)
+        self.assertEqual([other.new_id() for _ in range(20)], ids)
+
+    def test_fork_hook(self):
+        with mock.patch.object(forksafe, 'SUPPORTED', True), mock.patch.object(forksafe, '_after_in_child', []):
+            generator = IDGenerator()
+            generator.seed(1234)
+            generator.new_id()
+            forksafe._run_after_in_child()
+        self.assertEqual(generator._ids, [])
+        self.assertIsNone(generator._random)
+
+    def test_fork_pid_check(self):
+        with mock.patch.object(forksafe, 'SUPPORTED', False):
+            generator = IDGenerator()
+        generator.new_id()
+        self.assertEqual(len(generator._ids), 511)
+        with mock.patch('ddtrace.internal.idgen.os.getpid', return_value=generator._pid + 1):
+            generator.new_id()
+        self.assertEqual(len(generator._ids), 511)
+
+    def test_unique_across_forks(self):
+        generator = IDGenerator()
+        # DEV: the children would reuse the rest of this batch if it wasn't dropped
+        parent_ids = [generator.new_id()]
+
+        children = []
+        for _ in range(4):
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_fd)
+                ids = [generator.new_id() for _ in range(1000)]
+                os.write(write_fd, struct.pack('<1000Q', *ids))
+                os._exit(0)
+            os.close(write_fd)
+            children.append((pid, read_fd))
+
+        parent_ids.extend(generator.new_id() for _ in range(1000))
+        ids = set(parent_ids)
+        for pid, read_fd in children:
+            data = b''
+            while len(data) < 8000:
+                chunk = os.read(read_fd, 8000 - len(data))
+                self.assertTrue(chunk)
+                data += chunk
+            os.close(read_fd)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            ids.update(struct.unpack('<1000Q', data))
+
+        self.assertEqual(len(ids), 5001)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import msgpack
+
+from ddtrace.internal.packer import Packer, unpackb
+
+from ..base import BaseTestCase
+
+
+class PackerTestCase(BaseTestCase):
+    VALUES = [
+        None, True, False,
+        0, 1, 127, 128, 255, 256, 65535, 65536, 2 ** 32 - 1, 2 ** 32, 2 ** 64 - 1,
+        -1, -32, -33, -128, -129, -32768, -32769, -2 ** 31, -2 ** 31 - 1, -2 ** 63,
+        0.0, 1.5, -2.25, 1e300,
+        u'', u'a', u'☃', u'a' * 31, u'a' * 32, u'a' * 255, u'a' * 256, u'a' * 65536,
+        b'', b'bytes', b'b' * 40,
+        [], [1, u'a'], list(range(15)), list(range(16)), list(range(65536)), (1, 2),
+        {}, {u'a': 1}, dict((str(i), i) for i in range(16)), {u'nested': {u'list': [None, {u'b': 1.0}]}},
+    ]
+
+    def test_pack(self):
+        # the values are packed like the default msgpack packer does
+        packer = Packer()
+        for value in self.VALUES:
+            self.assertEqual(packer.pack(value), msgpack.packb(value), value)
+
+    def test_pack_subclass(self):
+        class Text(type(u'')):
+            pass
+
+        class Int(int):
+            pass
+
+        self.assertEqual(Packer().pack([Text(u'a'), Int(1)]), msgpack.packb([u'a', 1]))
+
+    def test_pack_error(self):
+        packer = Packer()
+        with self.assertRaises(TypeError):
+            packer.pack({u'key': object()})
+        with self.assertRaises(OverflowError):
+            packer.pack(2 ** 64)
+        with self.assertRaises(OverflowError):
+            packer.pack(-2 ** 63 - 1)
+        # the packer can be reused after an error
+        self.assertEqual(packer.pack([1]), b'\x91\x01')
+
+    def test_unpackb(self):
+        for value in self.VALUES:
+            expected = msgpack.unpackb(msgpack.packb(value))
+            self.assertEqual(unpackb(msgpack.packb(value)), expected)
+        # binary, str8 and float types aren't produced by the packer
+        for value in [b'bin', u'a' * 40]:
+            data = msgpack.packb(value, use_bin_type=True)
+            self.assertEqual(unpackb(data), msgpack.unpackb(data))
+        data = msgpack.packb(1.5, use_single_float=True)
+        self.assertEqual(unpackb(data), 1.5)
+
+    def test_unpackb_error(self):
+        with self.assertRaises(ValueError):
+            unpackb(b'\x01\x02')
+        with self.assertRaises(ValueError):
+            unpackb(b'\xc1')
@@ -0,0 +1,22 @@
+from ddtrace.internal.retry import RetryPolicy
+
+from ..base import BaseTestCase
+
+
+class RetryPolicyTestCase(BaseTestCase):
+    def test_should_retry(self):
+        policy = RetryPolicy(max_attempts=3)
+        self.assertTrue(policy.should_retry(1))
+        self.assertTrue(policy.should_retry(2))
+        self.assertFalse(policy.should_retry(3))
+
+    def test_wait_time_no_jitter(self):
+        policy = RetryPolicy(initial_wait=0.1, max_wait=0.5, multiplier=2, jitter=0)
+        self.assertEqual([policy.wait_time(n) for n in range(5)], [0.1, 0.2, 0.4, 0.5, 0.5])
+
+    def test_wait_time_jitter(self):
+        policy = RetryPolicy(initial_wait=1, max_wait=10, multiplier=2, jitter=0.5)
+        for retry in range(5):
+            wait = min(10, 2 ** retry)
+            for _ in range(100):
+                self.assertTrue(wait / 2.0 <= policy.wait_time(retry) <= wait)
@@ -0,0 +1,131 @@
+import errno
+import os
+import shutil
+import tempfile
+
+import mock
+
+from ddtrace.internal.spool import Spool
+
+from ..base import BaseTestCase
+
+
+class SpoolTestCase(BaseTestCase):
+    def setUp(self):
+        super(SpoolTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(SpoolTestCase, self).tearDown()
+
+    def test_put_read(self):
+        spool = Spool(os.path.join(self.directory, 'spool'))
+        self.assertEqual(spool.paths(), [])
+
+        self.assertTrue(spool.put('/v0.4/traces', b'first', {'Content-Type': 'application/msgpack'}))
+        self.assertTrue(spool.put('/v0.4/traces', u'second', {}))
+
+        paths = spool.paths()
+        self.assertEqual(len(paths), 2)
+        self.assertEqual(spool.read(paths[0]), ('/v0.4/traces', b'first', {'Content-Type': 'application/msgpack'}))
+        self.assertEqual(spool.read(paths[1]), ('/v0.4/traces', b'second', {}))
+
+        spool.remove(paths[0])
+        self.assertEqual(spool.paths(), paths[1:])
+        # removing twice is harmless
+        spool.remove(paths[0])
+
+    def test_evict_oldest(self):
+        spool = Spool(self.directory, max_size=200)
+        for i in range(5):
+            spool.put('/v0.4/traces', str(i).encode('ascii') * 50, {})
+
+        self.assertLessEqual(spool.size(), 200)
+        payloads = [spool.read(path)[1] for path in spool.paths()]
+        self.assertEqual(payloads, [b'3' * 50, b'4' * 50])
+
+    def test_payload_too_large(self):
+        spool = Spool(self.directory, max_size=10)
+        self.assertFalse(spool.put('/v0.4/traces', b'x' * 20, {}))
+        self.assertEqual(spool.paths(), [])
+
+    def test_read_corrupted(self):
+        spool = Spool(self.directory)
+        path = os.path.join(self.directory, 'corrupted' + Spool.SUFFIX)
+        with open(path, 'wb') as f:
+            f.write(b'not json\npayload')
+
+        self.assertIsNone(spool.read(path))
+        self.assertEqual(spool.paths(), [])
+
+    def test_ignore_other_files(self):
+        spool = Spool(self.directory)
+        with open(os.path.join(self.directory, 'README'), 'w') as f:
+            f.write('hello')
+        self.assertEqual(spool.paths(), [])
+
+    def test_claim_release(self):
+        spool = Spool(self.directory)
+        for payload in (b'first', b'second', b'third'):
+            spool.put('/v0.4/traces', payload, {})
+
+        claimed = spool.claim(2)
+        self.assertEqual([spool.read(path)[1] for path in claimed], [b'first', b'second'])
+        # claimed payloads cannot be claimed again, by this process or another one
+        self.assertEqual([spool.read(path)[1] for path in spool.paths()], [b'third'])
+        self.assertEqual([spool.read(path)[1] for path in spool.claim(2)], [b'third'])
+
+        spool.remove(claimed[0])
+        spool.release(claimed[1])
+        self.assertEqual([spool.read(path)[1] for path in spool.paths()], [b'second'])
+
+    def test_running_size(self):
+        spool = Spool(self.directory, max_size=200)
+        spool.put('/v0.4/traces', b'x' * 50, {})
+
+        # the directory is only scanned again when the spool may be full
+        with mock.patch.object(spool, '_sizes', wraps=spool._sizes) as sizes:
+            spool.put('/v0.4/traces', b'y' * 50, {})
+            self.assertEqual(sizes.call_count, 0)
+
+            spool.put('/v0.4/traces', b'z' * 50, {})
+            self.assertEqual(sizes.call_count, 1)
+
+        self.assertLessEqual(spool._size, 200)
+        self.assertEqual(spool._size, spool.size())
+
+        spool.remove(spool.paths()[0])
+        self.assertEqual(spool._size, spool.size())
+
+    def test_claimed_size(self):
+        spool = Spool(self.directory, max_size=200)
+        spool.put('/v0.4/traces', b'x' * 50, {})
+        claimed = spool.claim(1)
+
+        # claimed payloads are accounted for and evicted like the other ones
+        self.assertEqual(spool.size(), os.path.getsize(claimed[0]))
+        for _ in range(3):
+            spool.put('/v0.4/traces', b'y' * 50, {})
+        self.assertLessEqual(spool.size(), 200)
+        self.assertFalse(os.path.exists(claimed[0]))
+        self.assertEqual(spool._size, spool.size())
+
+    def test_release_claims_of_dead_processes(self):
+        spool = Spool(self.directory)
+        for payload in (b'first', b'second', b'third'):
+            spool.put('/v0.4/traces', payload, {})
+        paths = spool.paths()
+        dead, alive = 2 ** 22 + 1, os.getppid()
+        os.rename(paths[0], '{0}.{1}{2}'.format(paths[0], dead, Spool.CLAIMED_SUFFIX))
+        os.rename(paths[1], '{0}.{1}{2}'.format(paths[1], alive, Spool.CLAIMED_SUFFIX))
+
+        def kill(pid, sig):
+            if pid == dead:
+                raise OSError(errno.ESRCH, 'No such process')
+
+        # the payloads claimed by a process that is gone are claimed again
+        with mock.patch('ddtrace.internal.spool.os.kill', side_effect=kill):
+            claimed = spool.claim(10)
+        self.assertEqual([spool.read(path)[1] for path in claimed], [b'first', b'third'])
+        self.assertEqual(spool.paths(), [])
@@ -0,0 +1,73 @@
+import sys
+import traceback
+
+import mock
+
+from ddtrace.internal import stacks
+from ddtrace.internal.stacks import StackFormatter, capture_exception, capture_stack
+
+from ..base import BaseTestCase
+
+
+def _raise(message):
+    raise ValueError(message)
+
+
+class StacksTestCase(BaseTestCase):
+    def test_capture_exception(self):
+        try:
+            _raise('boom')
+        except ValueError:
+            exc_info = sys.exc_info()
+        self.assertEqual(capture_exception(*exc_info)(), ''.join(traceback.format_exception(*exc_info)))
+
+    def test_capture_exception_chained(self):
+        try:
+            try:
+                _raise('boom')
+            except ValueError:
+                _raise('again')
+        except ValueError:
+            exc_info = sys.exc_info()
+        self.assertEqual(capture_exception(*exc_info)(), ''.join(traceback.format_exception(*exc_info)))
+
+    def test_capture_exception_limit(self):
+        try:
+            _raise('boom')
+        except ValueError:
+            exc_info = sys.exc_info()
+        expected = ''.join(traceback.format_exception(*exc_info, limit=1))
+        self.assertEqual(capture_exception(*exc_info, limit=1)(), expected)
+
+    def test_capture_stack(self):
+        expected, stack = ''.join(traceback.format_stack(limit=3)), capture_stack(sys._getframe(), limit=3)
+        self.assertEqual(stack(), expected)
+
+    def test_formatter_cache(self):
+        formatter = StackFormatter(cache_size=2)
+        stack = capture_stack(sys._getframe())
+        other_stack = capture_stack(sys._getframe(), limit=1)
+        with mock.patch.object(stacks, 'stack_formatter', formatter):
+            with mock.patch.object(traceback, 'format_list', wraps=traceback.format_list) as format_list:
+                self.assertEqual(stack(), stack())
+                self.assertEqual(format_list.call_count, 1)
+                other_stack()
+                capture_stack(sys._getframe(), limit=2)()
+                self.assertEqual(format_list.call_count, 3)
+        # the least recently used stack was evicted
+        self.assertEqual(len(formatter._cache), 2)
+        self.assertNotIn(stack._parts[0][1], formatter._cache)
+
+    def test_formatter_rate_limit(self):
+        formatter = StackFormatter(max_per_second=1)
+        try:
+            _raise('boom')
+        except ValueError:
+            exc_info = sys.exc_info()
+        with mock.patch.object(stacks, 'stack_formatter', formatter):
+            with mock.patch.object(stacks, 'monotonic_ns', return_value=10 ** 9):
+                capture_stack(sys._getframe())()
+                # the frames are omitted, the exception message is kept
+                self.assertEqual(capture_exception(*exc_info)(), 'ValueError: boom\n')
+            with mock.patch.object(stacks, 'monotonic_ns', return_value=2 * 10 ** 9):
+                self.assertIn('in _raise', capture_exception(*exc_info)())
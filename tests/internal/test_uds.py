@@ -0,0 +1,122 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+from ddtrace.api import API
+from ddtrace.compat import httplib
+from ddtrace.internal.uds import UDSHTTPConnection
+from ddtrace.span import Span
+
+from ..base import BaseTestCase
+
+
+class UDSAgentStub(object):
+    """Minimal HTTP/1.1 server listening on a Unix Domain Socket, standing in for the trace agent"""
+    def __init__(self, path):
+        self.path = path
+        self.requests = []
+        self.connections = 0
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen(1)
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            rfile = conn.makefile('rb')
+            try:
+                while self._handle(rfile, conn):
+                    pass
+            finally:
+                rfile.close()
+                conn.close()
+
+    def _handle(self, rfile, conn):
+        request_line = rfile.readline()
+        if not request_line:
+            return False
+        headers = {}
+        while True:
+            line = rfile.readline().strip()
+            if not line:
+                break
+            key, _, value = line.decode('ascii').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        body = rfile.read(int(headers.get('content-length', 0)))
+        self.requests.append((request_line.decode('ascii').split()[:2], headers, body))
+
+        response = b'{"rate_by_service":{"service:,env:":1}}'
+        conn.sendall(
+            b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: ' +
+            str(len(response)).encode('ascii') + b'\r\n\r\n' + response
+        )
+        return True
+
+    def close(self):
+        self._sock.close()
+
+
+class UDSHTTPConnectionTestCase(BaseTestCase):
+    def setUp(self):
+        super(UDSHTTPConnectionTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'apm.socket')
+        self.agent = UDSAgentStub(self.path)
+
+    def tearDown(self):
+        self.agent.close()
+        shutil.rmtree(self.tmpdir)
+        super(UDSHTTPConnectionTestCase, self).tearDown()
+
+    def test_request(self):
+        conn = UDSHTTPConnection(self.path, 'localhost', 8126)
+        try:
+            conn.request('PUT', '/v0.4/traces', b'[]', {'Content-Type': 'application/msgpack'})
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, 200)
+            self.assertEqual(resp.read(), b'{"rate_by_service":{"service:,env:":1}}')
+        finally:
+            conn.close()
+
+        (method, path), headers, body = self.agent.requests[0]
+        self.assertEqual(method, 'PUT')
+        self.assertEqual(path, '/v0.4/traces')
+        self.assertEqual(headers['host'], 'localhost:8126')
+        self.assertEqual(body, b'[]')
+
+    def test_connect_error(self):
+        conn = UDSHTTPConnection(os.path.join(self.tmpdir, 'missing.socket'), 'localhost', 8126)
+        with self.assertRaises(socket.error):
+            conn.request('PUT', '/v0.4/traces', b'[]')
+
+    def test_api_send_traces(self):
+        api = API('localhost', 8126, uds_path=self.path, priority_sampling=True)
+        self.assertEqual(str(api), 'unix://{}'.format(self.path))
+        self.assertIsInstance(api._new_connection(), UDSHTTPConnection)
+        self.assertNotIsInstance(API('localhost', 8126)._new_connection(), UDSHTTPConnection)
+        self.assertIsInstance(API('localhost', 8126)._new_connection(), httplib.HTTPConnection)
+
+        for _ in range(2):
+            response = api.send_traces([[Span(tracer=None, name='client.testing')]])
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.get_json(), dict(rate_by_service={'service:,env:': 1}))
+        api.close()
+
+        self.assertEqual(len(self.agent.requests), 2)
+        (method, path), headers, body = self.agent.requests[0]
+        self.assertEqual(path, '/v0.4/traces')
+        self.assertEqual(headers['x-datadog-trace-count'], '1')
+        # the buffers of the payload are sent one after the other
+        traces = api.encoder.decode(body)
+        self.assertEqual([[span[b'name'] for span in trace] for trace in traces], [[b'client.testing']])
+        # the kept-alive connection is re-used
+        self.assertEqual(self.agent.connections, 1)
@@ -1,13 +1,23 @@
 import mock
+import msgpack
 import re
+import shutil
+import socket
+import tempfile
+import threading
 import warnings
+import zlib
 
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 from nose.tools import eq_, ok_
 
 from tests.test_tracer import get_dummy_tracer
-from ddtrace.api import API, Response
+from ddtrace.api import API, Response, _sendall
 from ddtrace.compat import iteritems, httplib
+from ddtrace.encoding import JSONEncoder, MsgpackEncoder
+from ddtrace.internal.retry import RetryPolicy
+from ddtrace.internal.spool import Spool
+from ddtrace.span import Span
 
 
 class ResponseMock:
@@ -24,11 +34,13 @@ class APITests(TestCase):
     def setUp(self):
         # DEV: Mock here instead of in tests, before we have patched `httplib.HTTPConnection`
         self.conn = mock.MagicMock(spec=httplib.HTTPConnection)
+        self.other_conn = mock.MagicMock(spec=httplib.HTTPConnection)
         self.api = API('localhost', 8126)
 
     def tearDown(self):
         del self.api
         del self.conn
+        del self.other_conn
 
     @mock.patch('logging.Logger.debug')
     def test_parse_response_json(self, log):
@@ -80,13 +92,37 @@ class APITests(TestCase):
                 msg = log.call_args[0][0] % log.call_args[0][1:]
                 ok_(re.match(v['log'], msg), msg)
 
+    @mock.patch('ddtrace.compat.httplib.HTTPConnection')
+    def test_put_connection_keep_alive(self, HTTPConnection):
+        """
+        When calling API._put
+            we keep the HTTPConnection we create open and re-use it
+        """
+        HTTPConnection.return_value = self.conn
+        self.conn.getresponse.return_value.will_close = False
+
+        with warnings.catch_warnings(record=True) as w:
+            self.api._put('/test', '<test data>', 1)
+            self.api._put('/test', '<test data>', 1)
+
+            self.assertEqual(len(w), 0, 'Test raised unexpected warnings: {0!r}'.format(w))
+
+        HTTPConnection.assert_called_once()
+        self.assertEqual(self.conn.request.call_count, 2)
+        self.conn.close.assert_not_called()
+
+        self.api.close()
+        self.conn.close.assert_called_once()
+
     @mock.patch('ddtrace.compat.httplib.HTTPConnection')
     def test_put_connection_close(self, HTTPConnection):
         """
         When calling API._put
-            we close the HTTPConnection we create
+            and the agent asks to close the connection
+                we close the HTTPConnection we create
         """
         HTTPConnection.return_value = self.conn
+        self.conn.getresponse.return_value.will_close = True
 
         with warnings.catch_warnings(record=True) as w:
             self.api._put('/test', '<test data>', 1)
@@ -96,6 +132,66 @@ class APITests(TestCase):
         self.conn.request.assert_called_once()
         self.conn.close.assert_called_once()
 
+    @mock.patch('ddtrace.compat.httplib.HTTPConnection')
+    def test_put_connection_idle_timeout(self, HTTPConnection):
+        """
+        When calling API._put
+            after the connection has been idle for too long
+                we close it and open a new one
+        """
+        HTTPConnection.return_value = self.conn
+        self.conn.getresponse.return_value.will_close = False
+        self.api.connection_idle_timeout = 0
+
+        self.api._put('/test', '<test data>', 1)
+        self.api._conn_last_used -= 1
+        self.api._put('/test', '<test data>', 1)
+
+        self.assertEqual(HTTPConnection.call_count, 2)
+        self.conn.close.assert_called_once()
+
+    @mock.patch('ddtrace.compat.httplib.HTTPConnection')
+    def test_put_connection_reconnect(self, HTTPConnection):
+        """
+        When calling API._put
+            and the kept-alive connection was closed by the agent
+                we retry once with a new connection
+        """
+        stale_conn = self.other_conn
+        stale_conn.getresponse.return_value.will_close = False
+        self.conn.getresponse.return_value.will_close = False
+        HTTPConnection.side_effect = [stale_conn, self.conn]
+
+        self.api._put('/test', '<test data>', 1)
+        stale_conn.request.side_effect = httplib.BadStatusLine('')
+        self.api._put('/test', '<test data>', 1)
+
+        self.assertEqual(HTTPConnection.call_count, 2)
+        self.assertEqual(stale_conn.request.call_count, 2)
+        stale_conn.close.assert_called_once()
+        self.conn.request.assert_called_once()
+        self.conn.close.assert_not_called()
+
+    @mock.patch('ddtrace.compat.httplib.HTTPConnection')
+    def test_put_connection_new_pid(self, HTTPConnection):
+        """
+        When calling API._put
+            from a forked process
+                we don't re-use the connection of the parent process
+        """
+        parent_conn = self.other_conn
+        parent_conn.getresponse.return_value.will_close = False
+        self.conn.getresponse.return_value.will_close = False
+        HTTPConnection.side_effect = [parent_conn, self.conn]
+
+        self.api._put('/test', '<test data>', 1)
+        self.api._conn_pid = -1
+        self.api._put('/test', '<test data>', 1)
+
+        parent_conn.request.assert_called_once()
+        parent_conn.close.assert_not_called()
+        self.conn.request.assert_called_once()
+
     @mock.patch('ddtrace.compat.httplib.HTTPConnection')
     def test_put_connection_close_exception(self, HTTPConnection):
         """
@@ -114,3 +210,395 @@ class APITests(TestCase):
 
         self.conn.request.assert_called_once()
         self.conn.close.assert_called_once()
+
+    def _traces(self, count, spans=10):
+        return [
+            [Span(tracer=None, name='name', resource='resource', trace_id=i, span_id=j) for j in range(1, spans + 1)]
+            for i in range(1, count + 1)
+        ]
+
+    def test_send_traces_split_payloads(self):
+        """
+        When calling API.send_traces
+            with more traces than fit in a payload
+                we send several payloads
+        """
+        encoder = MsgpackEncoder()
+        traces = self._traces(10)
+        trace_size = len(encoder.encode_trace(traces[0]))
+        api = API('localhost', 8126, encoder=encoder, max_payload_size=trace_size * 3)
+
+        with mock.patch.object(api, '_put', return_value=Response(status=200)) as put:
+            responses = api._send_payloads(traces)
+
+        # payloads are flushed as soon as they are full, the last one holds the remaining trace
+        self.assertEqual([call[0][2] for call in put.call_args_list], [3, 3, 3, 1])
+        self.assertEqual(len(responses), 4)
+        self.assertTrue(all(r.status == 200 for r in responses))
+
+        decoded = []
+        for call in put.call_args_list:
+            decoded.extend(encoder.decode(b''.join(call[0][1])))
+        self.assertEqual([t[0][b'trace_id'] for t in decoded], list(range(1, 11)))
+
+    def test_send_traces_empty(self):
+        with mock.patch.object(self.api, '_put') as put:
+            self.assertIsNone(self.api.send_traces([]))
+            self.assertIsNone(self.api.send_traces([[], []]))
+            self.assertEqual(self.api._send_payloads([[], []]), [])
+        put.assert_not_called()
+
+    def test_send_traces_response(self):
+        """
+        When calling API.send_traces
+            we return the response of the last payload, or raise the first error
+        """
+        encoder = MsgpackEncoder()
+        traces = self._traces(4)
+        trace_size = len(encoder.encode_trace(traces[0]))
+        api = API(
+            'localhost', 8126, encoder=encoder, max_payload_size=trace_size * 2,
+            retry_policy=RetryPolicy(max_attempts=1),
+        )
+
+        with mock.patch.object(api, '_put', side_effect=[Response(status=200), Response(status=202)]):
+            self.assertEqual(api.send_traces(traces).status, 202)
+
+        error = socket.error('connection refused')
+        with mock.patch.object(api, '_put', side_effect=[error, Response(status=200)]) as put:
+            with self.assertRaises(socket.error):
+                api.send_traces(traces)
+        # the other payloads are sent anyway
+        self.assertEqual(put.call_count, 2)
+
+    def test_send_traces_errors(self):
+        """
+        When calling API.send_traces
+            and sending a payload fails
+                we still send the other payloads and return the error
+        """
+        encoder = MsgpackEncoder()
+        traces = self._traces(4)
+        trace_size = len(encoder.encode_trace(traces[0]))
+        api = API(
+            'localhost', 8126, encoder=encoder, max_payload_size=trace_size * 2,
+            retry_policy=RetryPolicy(max_attempts=1),
+        )
+
+        error = socket.error('connection refused')
+        with mock.patch.object(api, '_put', side_effect=[error, Response(status=200)]) as put:
+            responses = api._send_payloads(traces)
+
+        self.assertEqual(put.call_count, 2)
+        self.assertEqual(responses[0], error)
+        self.assertEqual(responses[1].status, 200)
+
+        stats = api.metrics.snapshot()
+        self.assertEqual(stats['traces.failed'], 2)
+        self.assertEqual(stats['traces.sent'], 2)
+        self.assertEqual(stats['bytes.sent'], len(b''.join(put.call_args_list[1][0][1])))
+        self.assertEqual(stats['encode.time.count'], 4)
+        self.assertEqual(stats['send.time.count'], 2)
+
+    def test_send_traces_downgrade(self):
+        """
+        When calling API.send_traces
+            and the agent doesn't support the endpoint
+                we downgrade the API and encode the traces again
+        """
+        traces = self._traces(4)
+        api = API('localhost', 8126, encoder=MsgpackEncoder(), priority_sampling=True)
+        trace_size = len(api._encoder.encode_trace(traces[0]))
+        api.max_payload_size = trace_size * 2
+
+        responses = [Response(status=200), Response(status=404), Response(status=415), Response(status=200)]
+        with mock.patch.object(api, '_put', side_effect=responses) as put:
+            responses = api._send_payloads(traces)
+
+        endpoints = [call[0][0] for call in put.call_args_list]
+        self.assertEqual(endpoints, ['/v0.4/traces', '/v0.4/traces', '/v0.3/traces', '/v0.2/traces'])
+        self.assertEqual([r.status for r in responses], [200, 200])
+        # the v0.2 API uses the JSON encoder
+        self.assertEqual(len(JSONEncoder().decode(b''.join(put.call_args_list[-1][0][1]))), 2)
+        # the traces sent again are only counted once
+        stats = api.metrics.snapshot()
+        self.assertEqual(stats['traces.sent'], 4)
+        self.assertNotIn('traces.failed', stats)
+        self.assertEqual(stats['send.time.count'], 2)
+
+    def test_send_traces_v05(self):
+        """
+        When calling API.send_traces
+            with the v0.5 API
+                we send the strings of each payload once in a string table
+        """
+        traces = self._traces(4)
+        api = API('localhost', 8126, version='v0.5', max_payload_size=1)
+
+        with mock.patch.object(api, '_put', return_value=Response(status=200)) as put:
+            api.send_traces(traces[:2])
+
+        self.assertEqual(put.call_count, 2)
+        for call in put.call_args_list:
+            endpoint, data, count = call[0]
+            self.assertEqual(endpoint, '/v0.5/traces')
+            self.assertEqual(count, 1)
+            strings, encoded_traces = msgpack.unpackb(b''.join(data))
+            # each payload has its own string table
+            self.assertEqual(strings, [b'', b'name', b'resource'])
+            self.assertEqual(encoded_traces[0][0][:3], [0, 1, 2])
+
+    def test_send_traces_v05_downgrade(self):
+        """
+        When calling API.send_traces
+            with the v0.5 API
+                and the agent doesn't support it
+                    we downgrade to the v0.4 API
+        """
+        api = API('localhost', 8126, version='v0.5')
+        responses = [Response(status=404), Response(status=200)]
+        with mock.patch.object(api, '_put', side_effect=responses) as put:
+            responses = api._send_payloads(self._traces(2))
+
+        endpoints = [call[0][0] for call in put.call_args_list]
+        self.assertEqual(endpoints, ['/v0.5/traces', '/v0.4/traces'])
+        self.assertEqual([r.status for r in responses], [200])
+        self.assertIsInstance(api.encoder, MsgpackEncoder)
+        self.assertEqual(len(api.encoder.decode(b''.join(put.call_args_list[-1][0][1]))), 2)
+
+    def test_send_encoded_traces(self):
+        """
+        When calling API.send_encoded_traces
+            we send the encoded traces as is, split in several payloads
+        """
+        encoder = MsgpackEncoder()
+        encoded = [encoder.encode_trace(trace) for trace in self._traces(5)]
+        api = API('localhost', 8126, encoder=encoder, max_payload_size=len(encoded[0]) * 2)
+
+        with mock.patch.object(api, '_put', return_value=Response(status=200)) as put:
+            responses = api._send_payloads(encoded, encoded=True)
+
+        self.assertEqual(len(responses), 3)
+        self.assertEqual([call[0][2] for call in put.call_args_list], [2, 2, 1])
+        # the encoded traces are sent as they are
+        self.assertEqual(put.call_args_list[0][0][1], encoder.join_encoded_chunks(encoded[:2]))
+
+        with mock.patch.object(api, '_put', return_value=Response(status=200)) as put:
+            self.assertEqual(api.send_traces(encoded, encoded=True).status, 200)
+            self.assertEqual(api.send_encoded_traces(encoded).status, 200)
+        self.assertEqual([call[0][2] for call in put.call_args_list], [2, 2, 1] * 2)
+
+    def test_send_encoded_traces_downgrade(self):
+        """
+        When calling API.send_encoded_traces
+            and the API is downgraded to a different encoding
+                we drop the traces that can't be sent anymore
+        """
+        encoded = [MsgpackEncoder().encode_trace(trace) for trace in self._traces(2)]
+        api = API('localhost', 8126, encoder=MsgpackEncoder())
+        self.assertEqual(api._version, 'v0.3')
+
+        with mock.patch.object(api, '_put', return_value=Response(status=404)) as put:
+            responses = api._send_payloads(encoded, encoded=True)
+
+        put.assert_called_once()
+        self.assertEqual([r.status for r in responses], [404])
+        self.assertEqual(api._version, 'v0.2')
+        self.assertIsInstance(api.encoder, JSONEncoder)
+        self.assertEqual(api.metrics.snapshot()['traces.failed'], 2)
+
+    def test_send_traces_compressed(self):
+        """
+        When calling API.send_traces
+            with a compression level
+                we send gzip compressed payloads
+        """
+        encoder = MsgpackEncoder()
+        traces = self._traces(3)
+        api = API('localhost', 8126, encoder=encoder, compression_level=1)
+
+        with mock.patch.object(api, '_put', return_value=Response(status=200)) as put:
+            api.send_traces(traces)
+
+        put.assert_called_once()
+        (endpoint, data, count), kwargs = put.call_args
+        self.assertEqual(count, 3)
+        self.assertEqual(kwargs['headers'], {'Content-Encoding': 'gzip'})
+        self.assertEqual(zlib.decompress(data, 31), encoder.join_encoded([encoder.encode_trace(t) for t in traces]))
+
+    @mock.patch('ddtrace.compat.httplib.HTTPConnection')
+    def test_put_extra_headers(self, HTTPConnection):
+        """
+        When calling API._put with extra headers
+            we send them along the default ones
+        """
+        HTTPConnection.return_value = self.conn
+        self.api._put('/test', b'<test data>', 1, headers={'Content-Encoding': 'gzip'})
+
+        headers = self.conn.request.call_args[0][3]
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['X-Datadog-Trace-Count'], '1')
+        self.assertEqual(headers['Datadog-Meta-Lang'], 'python')
+        self.assertNotIn('Content-Encoding', self.api._headers)
+
+    @mock.patch('ddtrace.compat.httplib.HTTPConnection')
+    def test_put_chunks(self, HTTPConnection):
+        """
+        When calling API._put with a list of buffers
+            we send them one after the other, without joining them
+        """
+        HTTPConnection.return_value = self.conn
+        self.conn.sock = mock.Mock(spec=['sendall'])
+        self.api._put('/test', [b'<test', b'', b' data>'], 1)
+
+        self.conn.request.assert_not_called()
+        self.conn.putrequest.assert_called_once_with('PUT', '/test')
+        headers = dict(call[0] for call in self.conn.putheader.call_args_list)
+        self.assertEqual(headers['Content-Length'], '11')
+        self.assertEqual(headers['X-Datadog-Trace-Count'], '1')
+        self.conn.endheaders.assert_called_once_with()
+        self.assertEqual(
+            [call[0][0] for call in self.conn.sock.sendall.call_args_list],
+            [b'<test', b'', b' data>'],
+        )
+
+    @skipUnless(hasattr(socket.socket, 'sendmsg'), 'vectored writes are not supported')
+    def test_sendall_vectored(self):
+        """
+        When sending buffers on a socket supporting vectored writes
+            we send them all, even when they are partially written
+        """
+        chunks = [b'a' * 100000, b'', b'b' * 10, b'c' * 300000]
+        left, right = socket.socketpair()
+        left.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        received = []
+
+        def read():
+            while True:
+                data = right.recv(65536)
+                if not data:
+                    return
+                received.append(data)
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        try:
+            with mock.patch('ddtrace.api._IOV_MAX', 2):
+                _sendall(left, chunks)
+        finally:
+            left.close()
+            reader.join(5)
+            right.close()
+        self.assertEqual(b''.join(received), b''.join(chunks))
+
+    def test_send_traces_retry(self):
+        """
+        When calling API.send_traces
+            and the agent is unavailable
+                we retry with an exponential backoff
+        """
+        api = API('localhost', 8126, retry_policy=RetryPolicy(max_attempts=3, initial_wait=0.01, jitter=0))
+        side_effect = [socket.error('connection refused'), Response(status=503), Response(status=200)]
+
+        with mock.patch.object(api, '_put', side_effect=side_effect) as put:
+            with mock.patch('ddtrace.api.time.sleep') as sleep:
+                responses = api._send_payloads(self._traces(1))
+
+        self.assertEqual(put.call_count, 3)
+        self.assertEqual([call[0][0] for call in sleep.call_args_list], [0.01, 0.02])
+        self.assertEqual([r.status for r in responses], [200])
+
+    def test_send_traces_retry_budget(self):
+        """
+        When calling API.send_traces
+            and the agent is unavailable for longer than the retry budget
+                we return the last error
+        """
+        api = API('localhost', 8126, retry_policy=RetryPolicy(max_attempts=2, initial_wait=0))
+
+        with mock.patch.object(api, '_put', return_value=Response(status=500)) as put:
+            responses = api._send_payloads(self._traces(1))
+        self.assertEqual(put.call_count, 2)
+        self.assertEqual([r.status for r in responses], [500])
+
+        # client errors are not retried
+        with mock.patch.object(api, '_put', return_value=Response(status=400)) as put:
+            responses = api._send_payloads(self._traces(1))
+        self.assertEqual(put.call_count, 1)
+        self.assertEqual([r.status for r in responses], [400])
+
+    def test_send_traces_spool(self):
+        """
+        When calling API.send_traces
+            and all the attempts failed
+                we spool the payload and send it again once the agent is back
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        encoder = MsgpackEncoder()
+        api = API(
+            'localhost', 8126, encoder=encoder, compression_level=1,
+            retry_policy=RetryPolicy(max_attempts=1), spool=Spool(directory),
+        )
+        traces = self._traces(2)
+
+        with mock.patch.object(api, '_put', side_effect=socket.error('connection refused')):
+            api._send_payloads(traces[:1])
+        self.assertEqual(len(api.spool.paths()), 1)
+
+        with mock.patch.object(api, '_put', return_value=Response(status=200)) as put:
+            responses = api._send_payloads(traces[1:])
+
+        self.assertEqual([r.status for r in responses], [200])
+        self.assertEqual(put.call_count, 2)
+        self.assertEqual(api.spool.paths(), [])
+
+        # the spooled payload is sent as it was
+        (endpoint, data), kwargs = put.call_args_list[1][0][:2], put.call_args_list[1][1]
+        self.assertEqual(endpoint, '/v0.3/traces')
+        self.assertEqual(zlib.decompress(data, 31), encoder.join_encoded([encoder.encode_trace(traces[0])]))
+        self.assertEqual(kwargs['headers'], {
+            'Content-Encoding': 'gzip',
+            'Content-Type': 'application/msgpack',
+            'X-Datadog-Trace-Count': '1',
+        })
+
+    def test_send_traces_spool_replay_failure(self):
+        """
+        When replaying spooled payloads
+            and the agent fails again
+                we keep the payloads in the spool
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        api = API('localhost', 8126, retry_policy=RetryPolicy(max_attempts=1), spool=Spool(directory))
+        api.spool.put('/v0.3/traces', b'first', {})
+        api.spool.put('/v0.3/traces', b'second', {})
+
+        side_effect = [Response(status=200), Response(status=200), Response(status=503)]
+        with mock.patch.object(api, '_put', side_effect=side_effect) as put:
+            api.send_traces(self._traces(1))
+
+        self.assertEqual([call[0][1] for call in put.call_args_list[1:]], [b'first', b'second'])
+        self.assertEqual([api.spool.read(p)[1] for p in api.spool.paths()], [b'second'])
+
+    def test_send_traces_spool_replay_limit(self):
+        """
+        When replaying spooled payloads
+            we only send a few of them after each successful request
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        api = API('localhost', 8126, retry_policy=RetryPolicy(max_attempts=1), spool=Spool(directory))
+        for i in range(3):
+            api.spool.put('/v0.3/traces', str(i).encode('ascii'), {})
+
+        with mock.patch('ddtrace.api._SPOOL_REPLAY_LIMIT', 2), \
+                mock.patch.object(api, '_put', return_value=Response(status=200)) as put:
+            api.send_traces(self._traces(1))
+            self.assertEqual([call[0][1] for call in put.call_args_list[1:]], [b'0', b'1'])
+            self.assertEqual(len(api.spool.paths()), 1)
+
+            api.send_traces(self._traces(1))
+            self.assertEqual(put.call_args_list[4][0][1], b'2')
+            self.assertEqual(api.spool.paths(), [])
@@ -1,13 +1,17 @@
 import contextlib
 import mock
 import threading
+import unittest
 
 from unittest import TestCase
 from nose.tools import eq_, ok_
 from tests.test_tracer import get_dummy_tracer
 
+from ddtrace.compat import contextvars
+from ddtrace.provider import ContextVarsContextProvider
 from ddtrace.span import Span
-from ddtrace.context import Context, ThreadLocalContext
+from ddtrace.context import Context, LocalContext, ThreadLocalContext
+from ddtrace.constants import DROPPED_SPANS_KEY
 from ddtrace.ext.priority import USER_REJECT, AUTO_REJECT, AUTO_KEEP, USER_KEEP
 
 
@@ -126,15 +130,16 @@ class TestTracingContext(TestCase):
         tracer = get_dummy_tracer()
         ctx = Context()
 
-        # Create a root span with 5 children, all of the children are finished, the root is not
-        root = Span(tracer=tracer, name='root')
-        ctx.add_span(root)
-        for i in range(5):
-            child = Span(tracer=tracer, name='child_{}'.format(i), trace_id=root.trace_id, parent_id=root.span_id)
-            child._parent = root
-            child._finished = True
-            ctx.add_span(child)
-            ctx.close_span(child)
+        with self.override_partial_flush(ctx, enabled=True, min_spans=5):
+            # Create a root span with 5 children, all of the children are finished, the root is not
+            root = Span(tracer=tracer, name='root')
+            ctx.add_span(root)
+            for i in range(5):
+                child = Span(tracer=tracer, name='child_{}'.format(i), trace_id=root.trace_id, parent_id=root.span_id)
+                child._parent = root
+                child._finished = True
+                ctx.add_span(child)
+                ctx.close_span(child)
 
         with self.override_partial_flush(ctx, enabled=True, min_spans=5):
             trace, sampled = ctx.get()
@@ -166,15 +171,16 @@ class TestTracingContext(TestCase):
         tracer = get_dummy_tracer()
         ctx = Context()
 
-        # Create a root span with 5 children, all of the children are finished, the root is not
-        root = Span(tracer=tracer, name='root')
-        ctx.add_span(root)
-        for i in range(5):
-            child = Span(tracer=tracer, name='child_{}'.format(i), trace_id=root.trace_id, parent_id=root.span_id)
-            child._parent = root
-            child._finished = True
-            ctx.add_span(child)
-            ctx.close_span(child)
+        with self.override_partial_flush(ctx, enabled=True, min_spans=1):
+            # Create a root span with 5 children, all of the children are finished, the root is not
+            root = Span(tracer=tracer, name='root')
+            ctx.add_span(root)
+            for i in range(5):
+                child = Span(tracer=tracer, name='child_{}'.format(i), trace_id=root.trace_id, parent_id=root.span_id)
+                child._parent = root
+                child._finished = True
+                ctx.add_span(child)
+                ctx.close_span(child)
 
         with self.override_partial_flush(ctx, enabled=True, min_spans=1):
             trace, sampled = ctx.get()
@@ -206,15 +212,16 @@ class TestTracingContext(TestCase):
         tracer = get_dummy_tracer()
         ctx = Context()
 
-        # Create a root span with 5 children, all of the children are finished, the root is not
-        root = Span(tracer=tracer, name='root')
-        ctx.add_span(root)
-        for i in range(5):
-            child = Span(tracer=tracer, name='child_{}'.format(i), trace_id=root.trace_id, parent_id=root.span_id)
-            child._parent = root
-            child._finished = True
-            ctx.add_span(child)
-            ctx.close_span(child)
+        with self.override_partial_flush(ctx, enabled=True, min_spans=6):
+            # Create a root span with 5 children, all of the children are finished, the root is not
+            root = Span(tracer=tracer, name='root')
+            ctx.add_span(root)
+            for i in range(5):
+                child = Span(tracer=tracer, name='child_{}'.format(i), trace_id=root.trace_id, parent_id=root.span_id)
+                child._parent = root
+                child._finished = True
+                ctx.add_span(child)
+                ctx.close_span(child)
 
         # Test with having 1 too few spans for partial flush
         with self.override_partial_flush(ctx, enabled=True, min_spans=6):
@@ -223,11 +230,12 @@ class TestTracingContext(TestCase):
         self.assertIsNone(trace)
         self.assertIsNone(sampled)
 
-        self.assertEqual(len(ctx._trace), 6)
+        # the finished spans wait in the flush buffer
+        self.assertEqual(ctx._trace, [root])
         self.assertEqual(ctx._finished_spans, 5)
         self.assertEqual(
-            set(['root', 'child_0', 'child_1', 'child_2', 'child_3', 'child_4']),
-            set([span.name for span in ctx._trace])
+            set(['child_0', 'child_1', 'child_2', 'child_3', 'child_4']),
+            set([span.name for span in ctx._flush_buffer])
         )
 
     def test_partial_flush_remaining(self):
@@ -240,18 +248,19 @@ class TestTracingContext(TestCase):
         tracer = get_dummy_tracer()
         ctx = Context()
 
-        # Create a root span with 5 children, all of the children are finished, the root is not
-        root = Span(tracer=tracer, name='root')
-        ctx.add_span(root)
-        for i in range(10):
-            child = Span(tracer=tracer, name='child_{}'.format(i), trace_id=root.trace_id, parent_id=root.span_id)
-            child._parent = root
-            ctx.add_span(child)
-
-            # CLose the first 5 only
-            if i < 5:
-                child._finished = True
-                ctx.close_span(child)
+        with self.override_partial_flush(ctx, enabled=True, min_spans=5):
+            # Create a root span with 5 children, all of the children are finished, the root is not
+            root = Span(tracer=tracer, name='root')
+            ctx.add_span(root)
+            for i in range(10):
+                child = Span(tracer=tracer, name='child_{}'.format(i), trace_id=root.trace_id, parent_id=root.span_id)
+                child._parent = root
+                ctx.add_span(child)
+
+                # CLose the first 5 only
+                if i < 5:
+                    child._finished = True
+                    ctx.close_span(child)
 
         with self.override_partial_flush(ctx, enabled=True, min_spans=5):
             trace, sampled = ctx.get()
@@ -272,6 +281,63 @@ class TestTracingContext(TestCase):
             set([span.name for span in ctx._trace]),
         )
 
+    def test_partial_flush_buffer(self):
+        # finished spans are moved to the flush buffer, the root span is flushed first
+        tracer = get_dummy_tracer()
+        ctx = Context()
+
+        with self.override_partial_flush(ctx, enabled=True, min_spans=2):
+            root = tracer.start_span('root', child_of=ctx)
+            children = [tracer.start_span('child_{}'.format(i), child_of=root) for i in range(3)]
+            children[1].finish()
+            self.assertEqual(ctx._trace, [root, children[0], children[2]])
+            self.assertEqual(ctx._flush_buffer, [children[1]])
+
+            children[2].finish()
+            self.assertEqual(tracer.writer.pop(), [children[1], children[2]])
+            self.assertEqual(ctx._flush_buffer, [])
+
+            children[0].finish()
+            root.finish()
+            self.assertEqual(tracer.writer.pop(), [root, children[0]])
+            self.assertEqual(ctx._trace, [])
+
+    def test_max_spans(self):
+        # the spans started once the limit is reached are dropped and counted on the root span
+        tracer = get_dummy_tracer()
+
+        with mock.patch.object(Context, '_max_spans', 3):
+            with tracer.trace('root') as root:
+                for i in range(4):
+                    with tracer.trace('child_{}'.format(i)) as child:
+                        tracer.start_span('grandchild', child_of=child).finish()
+
+            spans = tracer.writer.pop()
+            self.assertEqual([span.name for span in spans], ['root', 'child_0', 'grandchild'])
+            self.assertEqual(root.get_metric(DROPPED_SPANS_KEY), 6)
+
+            # the limit applies to each trace
+            with tracer.trace('root'):
+                pass
+            spans = tracer.writer.pop()
+            self.assertEqual(len(spans), 1)
+            self.assertIsNone(spans[0].get_metric(DROPPED_SPANS_KEY))
+
+    def test_max_trace_bytes(self):
+        tracer = get_dummy_tracer()
+
+        with mock.patch.object(Context, '_max_trace_bytes', 1000):
+            with tracer.trace('root') as root:
+                for i in range(10):
+                    with tracer.trace('child') as child:
+                        child.set_tag('key', 'x' * 100)
+
+            spans = tracer.writer.pop()
+            # the estimated size of a child span is 128 + 5 + 5 + 3 + 100 bytes,
+            # the limit is reached once the fifth child is finished
+            self.assertEqual(len(spans), 6)
+            self.assertEqual(root.get_metric(DROPPED_SPANS_KEY), 5)
+
     def test_finished(self):
         # a Context is finished if all spans inside are finished
         ctx = Context()
@@ -394,6 +460,110 @@ class TestTracingContext(TestCase):
         eq_(cloned_ctx._finished_spans, 0)
 
 
+class TestLocalContext(TestCase):
+    """
+    Ensures that a ``LocalContext`` skips the lock in its owner thread and
+    becomes thread-safe when it is used from another thread.
+    """
+    def test_owner_thread_skips_lock(self):
+        ctx = LocalContext()
+        ctx._lock = mock.MagicMock()
+        span = Span(tracer=None, name='fake_span')
+        ctx.add_span(span)
+        eq_(span, ctx.get_current_span())
+        eq_(span.trace_id, ctx.trace_id)
+        ctx.sampling_priority = AUTO_KEEP
+        eq_(AUTO_KEEP, ctx.sampling_priority)
+        ctx.close_span(span)
+        ok_(ctx.is_finished())
+        eq_(([span], True), ctx.get())
+
+        ok_(type(ctx) is LocalContext)
+        eq_(ctx._lock.__enter__.call_count, 0)
+
+    def test_other_thread_upgrades(self):
+        ctx = LocalContext()
+        span = Span(tracer=None, name='fake_span')
+        ctx.add_span(span)
+
+        thread = threading.Thread(target=ctx.close_span, args=(span, ))
+        thread.start()
+        thread.join()
+
+        ok_(type(ctx) is Context)
+        ok_(ctx.is_finished())
+        eq_(([span], True), ctx.get())
+
+    def test_other_thread_waits_for_owner(self):
+        ctx = LocalContext()
+        span = Span(tracer=None, name='fake_span')
+        ctx.add_span(span)
+
+        # the owner thread is updating the context without the lock
+        ctx._owner_busy = True
+        thread = threading.Thread(target=ctx.close_span, args=(span, ))
+        thread.start()
+        thread.join(0.05)
+        ok_(thread.is_alive())
+        ok_(type(ctx) is LocalContext)
+        eq_(0, ctx._finished_spans)
+
+        ctx._owner_busy = False
+        thread.join()
+        ok_(type(ctx) is Context)
+        eq_(1, ctx._finished_spans)
+
+    def test_owner_and_other_threads(self):
+        ctx = LocalContext()
+        root = Span(tracer=None, name='root')
+        ctx.add_span(root)
+        spans = [Span(tracer=None, name='child') for _ in range(1000)]
+
+        def _close_spans():
+            for span in spans[::2]:
+                ctx.close_span(span)
+
+        for span in spans:
+            ctx.add_span(span)
+        thread = threading.Thread(target=_close_spans)
+        thread.start()
+        # the owner keeps updating the context while it is upgraded
+        for span in spans[1::2]:
+            ctx.close_span(span)
+        thread.join()
+
+        eq_(1000, ctx._finished_spans)
+        ctx.close_span(root)
+        trace, _ = ctx.get()
+        eq_(1001, len(trace))
+
+    def test_thread_safe(self):
+        ctx = LocalContext()
+
+        def _fill_ctx():
+            span = Span(tracer=None, name='fake_span')
+            ctx.add_span(span)
+
+        threads = [threading.Thread(target=_fill_ctx) for _ in range(100)]
+
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        eq_(100, len(ctx._trace))
+
+    def test_clone_is_thread_safe(self):
+        ctx = LocalContext()
+        ctx.add_span(Span(tracer=None, name='fake_span'))
+        ok_(type(ctx.clone()) is Context)
+
+    def test_thread_local_context(self):
+        ok_(type(ThreadLocalContext().get()) is LocalContext)
+
+
 class TestThreadContext(TestCase):
     """
     Ensures that a ``ThreadLocalContext`` makes the Context
@@ -437,3 +607,45 @@ class TestThreadContext(TestCase):
         # because it has not been used in this thread
         ctx = l_ctx.get()
         eq_(0, len(ctx._trace))
+
+
+@unittest.skipIf(contextvars is None, 'contextvars requires Python 3.7+')
+class TestContextVarsContextProvider(TestCase):
+    def test_active(self):
+        provider = ContextVarsContextProvider()
+        ok_(not provider._has_active_context())
+        ctx = provider.active()
+        ok_(type(ctx) is LocalContext)
+        ok_(provider._has_active_context())
+        ctx.add_span(Span(tracer=None, name='fake_span'))
+        ok_(provider.active() is ctx)
+
+    def test_activate(self):
+        provider = ContextVarsContextProvider()
+        ctx = Context(trace_id=100, span_id=101)
+        provider.activate(ctx)
+        ok_(provider.active() is ctx)
+
+    def test_idle_context_kept(self):
+        provider = ContextVarsContextProvider()
+        ctx = provider.active()
+        ok_(provider.active() is ctx)
+
+    def test_multiple_threads_multiple_context(self):
+        provider = ContextVarsContextProvider()
+        ctx = provider.active()
+        ctx.add_span(Span(tracer=None, name='fake_span'))
+        contexts = []
+
+        def _get_ctx():
+            contexts.append(provider.active())
+
+        thread = threading.Thread(target=_get_ctx)
+        thread.start()
+        thread.join()
+
+        ok_(contexts[0] is not ctx)
+        ok_(provider.active() is ctx)
+
+    def test_default_provider(self):
+        ok_(isinstance(get_dummy_tracer().context_provider, ContextVarsContextProvider))
@@ -1,4 +1,6 @@
 import json
+import sys
+import mock
 import msgpack
 
 from unittest import TestCase
@@ -6,7 +8,9 @@ from nose.tools import eq_, ok_
 
 from ddtrace.span import Span
 from ddtrace.compat import msgpack_type, string_type
-from ddtrace.encoding import JSONEncoder, MsgpackEncoder
+from ddtrace.encoding import (
+    JSONEncoder, MsgpackEncoder, MsgpackStringTableEncoder, PythonMsgpackEncoder, get_encoder,
+)
 
 
 class TestEncoders(TestCase):
@@ -135,3 +139,109 @@ class TestEncoders(TestCase):
         for i in range(2):
             for j in range(2):
                 eq_(b'client.testing', items[i][j][b'name'])
+
+    def _spans(self):
+        spans = [
+            Span(name='client.testing', tracer=None),
+            Span(name='web.request', tracer=None, service='web', resource=u'GET /caf\xe9', span_type='http',
+                 trace_id=1, span_id=2, parent_id=None, start=1560000000.123456),
+            Span(name='db.query', tracer=None, trace_id=1, span_id=3, parent_id=2, start=1560000000.5),
+        ]
+        spans[1].set_tag('http.status_code', 200)
+        spans[1].set_metric('rows', 2.5)
+        spans[1].duration = 0.0123
+        spans[2].error = True
+        spans[2].set_tag(u'unicode.key', u'\u2603')
+        return spans
+
+    def _assert_same_encoding(self, data, expected):
+        if sys.version_info >= (3, 6):
+            # DEV: dicts are ordered, so the maps are packed in the same order
+            eq_(data, expected)
+        else:
+            eq_(msgpack.unpackb(data), msgpack.unpackb(expected))
+
+    def test_encode_trace_msgpack_compatibility(self):
+        # spans are packed as their ``to_dict()`` representation
+        encoder = MsgpackEncoder()
+        trace = self._spans()
+        expected = msgpack.packb([span.to_dict() for span in trace])
+        self._assert_same_encoding(encoder.encode_trace(trace), expected)
+        # the packer is reused
+        self._assert_same_encoding(encoder.encode_trace(trace), expected)
+
+    def test_encode_traces_msgpack_compatibility(self):
+        encoder = MsgpackEncoder()
+        traces = [self._spans(), [], self._spans()[:1]]
+        expected = msgpack.packb([[span.to_dict() for span in trace] for trace in traces])
+        self._assert_same_encoding(encoder.encode_traces(traces), expected)
+
+    def test_encode_trace_msgpack_error(self):
+        # the packer can be reused after a span failed to be encoded
+        encoder = MsgpackEncoder()
+        span = Span(name='client.testing', tracer=None)
+        span.meta['key'] = object()
+        with self.assertRaises(TypeError):
+            encoder.encode_trace([span])
+        trace = self._spans()
+        self._assert_same_encoding(encoder.encode_trace(trace), msgpack.packb([s.to_dict() for s in trace]))
+
+    def test_encode_trace_python_msgpack(self):
+        # the pure Python packer writes the spans like the msgpack C extension packs their dict
+        encoder = PythonMsgpackEncoder()
+        trace = self._spans()
+        self._assert_same_encoding(encoder.encode_trace(trace), msgpack.packb([span.to_dict() for span in trace]))
+        traces = [self._spans(), [], self._spans()[:1]]
+        self._assert_same_encoding(
+            encoder.encode_traces(traces),
+            msgpack.packb([[span.to_dict() for span in trace] for trace in traces]),
+        )
+
+        data = encoder.join_encoded([encoder.encode_trace(trace) for trace in traces])
+        eq_(encoder.decode(data), msgpack.unpackb(data))
+        eq_(encoder.encode({'a': [1]}), msgpack.packb({'a': [1]}))
+
+    def test_encode_trace_python_msgpack_unhashable(self):
+        # spans with values that can't be cached are packed from their dict
+        encoder = PythonMsgpackEncoder()
+        trace = self._spans()
+        trace[1].meta['list'] = ['a', 1]
+        self._assert_same_encoding(encoder.encode_trace(trace), msgpack.packb([span.to_dict() for span in trace]))
+        trace[1].meta['list'] = object()
+        with self.assertRaises(TypeError):
+            encoder.encode_trace(trace)
+
+    def test_get_encoder(self):
+        with mock.patch('ddtrace.encoding.MSGPACK_CPP', False):
+            ok_(isinstance(get_encoder(), PythonMsgpackEncoder))
+
+    def test_encode_trace_string_table(self):
+        encoder = MsgpackStringTableEncoder()
+        traces = [self._spans(), self._spans()[:2]]
+        data = encoder.join_encoded([encoder.encode_trace(trace) for trace in traces])
+
+        strings, encoded_traces = msgpack.unpackb(data)
+        # strings are stored once, the empty string first
+        eq_(strings[0], b'')
+        eq_(len(strings), len(set(strings)))
+        eq_(encoder.shared_size, sum(len(msgpack.packb(string)) for string in strings))
+
+        decoded = encoder.decode(data)
+        eq_(len(decoded), 2)
+        for trace, decoded_trace in zip(traces, decoded):
+            for span, decoded_span in zip(trace, decoded_trace):
+                d = msgpack.unpackb(msgpack.packb(span.to_dict()))
+                eq_(decoded_span, [
+                    d.get(b'service') or b'', d[b'name'], d[b'resource'], d[b'trace_id'], d[b'span_id'],
+                    d[b'parent_id'] or 0, d.get(b'start', 0), d.get(b'duration', 0), d[b'error'],
+                    d.get(b'meta', {}), d.get(b'metrics', {}), d.get(b'type') or b'',
+                ])
+
+    def test_string_table_payload_encoder(self):
+        # the json and msgpack encoders are shared by payloads, the string table is built for each payload
+        encoder = MsgpackEncoder()
+        ok_(encoder.payload_encoder() is encoder)
+        encoder = MsgpackStringTableEncoder()
+        payload_encoder = encoder.payload_encoder()
+        ok_(isinstance(payload_encoder, MsgpackStringTableEncoder))
+        ok_(payload_encoder is not encoder)
@@ -14,7 +14,7 @@ from ddtrace.ext import http
 from ddtrace.filters import FilterRequestsOnUrl
 from ddtrace.constants import FILTERS_KEY
 from ddtrace.tracer import Tracer
-from ddtrace.encoding import JSONEncoder, MsgpackEncoder, get_encoder
+from ddtrace.encoding import JSONEncoder, MsgpackEncoder, PythonMsgpackEncoder, get_encoder
 from ddtrace.compat import httplib, PYTHON_INTERPRETER, PYTHON_VERSION
 from tests.test_tracer import get_dummy_tracer
 
@@ -402,12 +402,12 @@ class TestAPIDowngrade(TestCase):
         encoder = get_encoder()
         ok_(isinstance(encoder, MsgpackEncoder))
 
-    @mock.patch('ddtrace.encoding.MSGPACK_ENCODING', False)
+    @mock.patch('ddtrace.encoding.MSGPACK_CPP', False)
     def test_get_encoder_fallback(self):
-        # get_encoder should return JSONEncoder instance if
-        # msgpack or the CPP implementaiton, are not available
+        # get_encoder should return PythonMsgpackEncoder instance if
+        # the CPP implementation is not available
         encoder = get_encoder()
-        ok_(isinstance(encoder, JSONEncoder))
+        ok_(isinstance(encoder, PythonMsgpackEncoder))
 
     @skip('msgpack package split breaks this test; it works for newer version of msgpack')
     def test_downgrade_api(self):
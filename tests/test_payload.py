@@ -1,4 +1,5 @@
 import math
+import zlib
 
 from ddtrace.encoding import get_encoder, JSONEncoder
 from ddtrace.payload import Payload
@@ -50,6 +51,30 @@ class PayloadTestCase(BaseTracerTestCase):
         self.assertFalse(payload.full)
         self.assertFalse(payload.empty)
 
+    def test_add_encoded_trace(self):
+        """
+        When calling `Payload.add_encoded_trace`
+            With a falsey value
+                Nothing is added to the payload
+            With an encoded trace
+                We add the trace to the payload as is
+                We increment the payload size by the trace size
+        """
+        payload = Payload()
+
+        for val in (None, b'', ''):
+            payload.add_encoded_trace(val)
+        self.assertTrue(payload.empty)
+
+        trace = [Span(self.tracer, name='root.span'), Span(self.tracer, name='child.span')]
+        encoded = payload.encoder.encode_trace(trace)
+        payload.add_encoded_trace(encoded)
+        payload.add_trace(trace)
+
+        self.assertEqual(payload.length, 2)
+        self.assertEqual(payload.size, 2 * len(encoded))
+        self.assertEqual(payload.traces, [encoded, encoded])
+
     def test_get_payload(self):
         """
         When calling `Payload.get_payload`
@@ -84,6 +109,45 @@ class PayloadTestCase(BaseTracerTestCase):
             self.assertEqual(trace[0][b'name'], b'root.span')
             self.assertEqual(trace[1][b'name'], b'child.span')
 
+    def test_get_payload_chunks(self):
+        """
+        When calling `Payload.get_payload_chunks`
+            We return the buffers of the payload, the encoded traces not being copied
+        """
+        for encoder in (get_encoder(), JSONEncoder()):
+            payload = Payload(encoder=encoder)
+            for _ in range(3):
+                payload.add_trace([Span(self.tracer, name='root.span'), Span(self.tracer, name='child.span')])
+
+            chunks = payload.get_payload_chunks()
+            self.assertTrue(all(isinstance(chunk, bytes) for chunk in chunks))
+            data = payload.get_payload()
+            self.assertEqual(b''.join(chunks), data if isinstance(data, bytes) else data.encode('utf-8'))
+
+        payload = Payload(encoder=get_encoder())
+        payload.add_trace([Span(self.tracer, name='root.span')])
+        chunks = payload.get_payload_chunks()
+        self.assertEqual(len(chunks), 2)
+        self.assertIs(chunks[1], payload.traces[0])
+
+    def test_get_compressed_payload(self):
+        """
+        When calling `Payload.get_compressed_payload`
+            We return the gzip compressed payload
+        """
+        for encoder in (get_encoder(), JSONEncoder()):
+            payload = Payload(encoder=encoder)
+            for _ in range(10):
+                trace = [Span(self.tracer, name='root.span', service='web'), Span(self.tracer, name='child.span')]
+                payload.add_trace(trace)
+
+            data = payload.get_payload()
+            compressed = payload.get_compressed_payload(6)
+            self.assertEqual(compressed[:2], b'\x1f\x8b')
+            decompressed = zlib.decompress(compressed, 31)
+            self.assertEqual(decompressed, data if isinstance(data, bytes) else data.encode('utf-8'))
+            self.assertLess(len(compressed), len(decompressed))
+
     def test_full(self):
         """
         When accessing `Payload.full`
@@ -1,8 +1,8 @@
 from __future__ import division
 
 import unittest
-import random
 
+from ddtrace.internal.idgen import id_generator
 from ddtrace.span import Span
 from ddtrace.sampler import RateSampler, AllSampler, _key, _default_key
 from ddtrace.compat import iteritems
@@ -19,7 +19,7 @@ class RateSamplerTest(unittest.TestCase):
 
             tracer.sampler = RateSampler(sample_rate)
 
-            random.seed(1234)
+            id_generator.seed(1234)
 
             iterations = int(1e4 / sample_rate)
 
@@ -43,7 +43,7 @@ class RateSamplerTest(unittest.TestCase):
 
         tracer.sampler = RateSampler(0.5)
 
-        random.seed(1234)
+        id_generator.seed(1234)
 
         for i in range(10):
             span = tracer.trace(i)
@@ -83,7 +83,7 @@ class RateByServiceSamplerTest(unittest.TestCase):
             tracer.writer = writer
             tracer.priority_sampler.set_sample_rate(sample_rate)
 
-            random.seed(1234)
+            id_generator.seed(1234)
 
             iterations = int(1e4 / sample_rate)
 
@@ -1,12 +1,15 @@
+import mock
 import time
+import traceback
 
 from nose.tools import eq_, ok_
 from unittest.case import SkipTest
 
 from ddtrace.context import Context
 from ddtrace.constants import ANALYTICS_SAMPLE_RATE_KEY
-from ddtrace.span import Span
+from ddtrace.span import LazyTag, Span, SpanFreeList
 from ddtrace.ext import errors
+from ddtrace.vendor import six
 
 
 def test_ids():
@@ -136,6 +139,147 @@ def test_finish_set_span_duration():
     assert s.duration == 1337.0
 
 
+def test_finish_time():
+    # the duration is computed from the start and the given finish time
+    s = Span(tracer=None, name='test.span', start=10.5)
+    s.finish(12.25)
+    eq_(s.start_ns, 10500000000)
+    eq_(s.duration_ns, 1750000000)
+    eq_(s.duration, 1.75)
+
+
+def test_start_duration_ns():
+    # the start and duration are stored as int nanoseconds, and exposed as float seconds
+    before = time.time()
+    s = Span(tracer=None, name='test.span')
+    ok_(isinstance(s.start_ns, six.integer_types))
+    ok_(before - 1 <= s.start <= time.time() + 1)
+    s.finish()
+    ok_(s.duration_ns >= 0)
+    eq_(s.duration, s.duration_ns / 1e9)
+
+    d = s.to_dict()
+    eq_(d['start'], s.start_ns)
+    eq_(d['duration'], s.duration_ns)
+
+
+def test_duration_monotonic():
+    # the duration isn't affected when the wall clock goes backward
+    with mock.patch('ddtrace.span.time_ns', return_value=2000000000):
+        with mock.patch('ddtrace.span.monotonic_ns', return_value=10):
+            s = Span(tracer=None, name='test.span')
+    with mock.patch('ddtrace.span.time_ns', return_value=1000000000):
+        with mock.patch('ddtrace.span.monotonic_ns', return_value=510):
+            s.finish()
+    eq_(s.start_ns, 2000000000)
+    eq_(s.duration_ns, 500)
+
+
+def test_set_start():
+    # the duration is measured with the wall clock when the start time is changed
+    s = Span(tracer=None, name='test.span')
+    s.start = 10.5
+    eq_(s.start_ns, 10500000000)
+    with mock.patch('ddtrace.span.time_ns', return_value=11000000000):
+        s.finish()
+    eq_(s.duration_ns, 500000000)
+
+
+def test_lazy_tags():
+    # the tags dicts are only allocated when a tag is set
+    s = Span(tracer=None, name='test.span')
+    assert s._meta is None
+    assert s._metrics is None
+    assert s.get_tag('a') is None
+    assert s.get_metric('a') is None
+    s._remove_tag('a')
+    s.finish()
+    d = s.to_dict()
+    assert 'meta' not in d
+    assert 'metrics' not in d
+    assert s._meta is None
+    assert s._metrics is None
+
+    s.set_tag('a', 'b')
+    s.set_metric('m', 1)
+    eq_(s._meta, {'a': 'b'})
+    eq_(s._metrics, {'m': 1})
+
+    # the dicts can still be used directly
+    s = Span(tracer=None, name='test.span')
+    s.meta['a'] = 'b'
+    s.metrics['m'] = 1
+    eq_(s.get_tag('a'), 'b')
+    eq_(s.get_metric('m'), 1)
+    s.meta = {'c': 'd'}
+    eq_(s.to_dict()['meta'], {'c': 'd'})
+
+
+def test_span_free_list():
+    free_list = SpanFreeList(max_size=2)
+    s = free_list.acquire(None, 'test.span')
+    ok_(isinstance(s, Span))
+    eq_(len(free_list), 0)
+
+    ctx = Context()
+    spans = [Span(None, 'span{}'.format(i), context=ctx) for i in range(3)]
+    spans[0].set_tag('a', 'b')
+    spans[0].set_metric('m', 1)
+    spans[0].finish()
+    free_list.release(spans)
+    # only ``max_size`` spans are kept, without their references to other objects
+    eq_(len(free_list), 2)
+    assert spans[0]._context is None
+    assert spans[0]._meta is None
+    assert spans[2]._context is ctx
+
+    s = free_list.acquire(None, 'test.span', service='s', trace_id=1, span_id=2)
+    assert s is spans[1]
+    s = free_list.acquire(None, 'test.span', service='s', trace_id=1, span_id=2)
+    assert s is spans[0]
+    # the span is initialized again
+    eq_(s.name, 'test.span')
+    eq_(s.service, 's')
+    eq_(s.trace_id, 1)
+    eq_(s.span_id, 2)
+    assert s.duration is None
+    assert not s._finished
+    assert s.get_tag('a') is None
+    assert s.get_metric('m') is None
+    eq_(len(free_list), 0)
+
+
+def test_span_free_list_held_span():
+    free_list = SpanFreeList()
+    ctx = Context()
+    root = Span(None, 'root', context=ctx)
+    root.set_tag('a', 'b')
+    held = Span(None, 'held', context=ctx)
+    held._parent = root
+    other = Span(None, 'other', context=ctx)
+    other._parent = root
+    spans = [root, held, other]
+    del root, other
+    free_list.release(spans)
+    # the span still referenced and its parent are left untouched
+    eq_(len(free_list), 1)
+    assert free_list._spans[0] is spans[2]
+    assert held._context is ctx
+    eq_(held._parent.name, 'root')
+    eq_(held._parent.get_tag('a'), 'b')
+    assert held._parent._context is ctx
+
+    # and are never reused
+    del spans
+    s = free_list.acquire(None, 'test.span')
+    eq_(s.name, 'test.span')
+    assert s is not held and s is not held._parent
+    s = free_list.acquire(None, 'test.span')
+    assert s is not held and s is not held._parent
+    eq_(held.name, 'held')
+    eq_(held._parent.name, 'root')
+
+
 def test_traceback_with_error():
     s = Span(None, 'test.span')
     try:
@@ -159,6 +303,49 @@ def test_traceback_without_error():
     assert 'in test_traceback_without_error' in s.get_tag(errors.ERROR_STACK)
 
 
+def test_traceback_deferred():
+    s = Span(None, 'test.span')
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        s.set_traceback()
+        expected = traceback.format_exc()
+
+    # the stack is only formatted when the span is encoded
+    assert errors.ERROR_STACK not in s._meta
+    eq_(s.to_dict()['meta'][errors.ERROR_STACK], expected)
+    assert not s._lazy_meta
+
+    # setting the tag overrides the deferred stack
+    s.set_traceback()
+    s.set_tag(errors.ERROR_STACK, 'stack')
+    eq_(s.get_tag(errors.ERROR_STACK), 'stack')
+    s.set_traceback()
+    s._remove_exc_info()
+    assert s.get_tag(errors.ERROR_STACK) is None
+
+
+def test_lazy_tag():
+    s = Span(None, 'test.span')
+    func = mock.Mock(return_value={'a': 1})
+    s.set_tag('lazy', LazyTag(func, 'arg'))
+    s.set_tag(ANALYTICS_SAMPLE_RATE_KEY, LazyTag(lambda: '0.5'))
+    s.set_tag('error', LazyTag(lambda: 1 / 0))
+    eq_(s.get_metric(ANALYTICS_SAMPLE_RATE_KEY), 0.5)
+
+    # the value is computed once, when the span is encoded
+    func.assert_not_called()
+    d = s.to_dict()
+    func.assert_called_once_with('arg')
+    eq_(d['meta'], {'lazy': str({'a': 1})})
+    eq_(s.get_tag('lazy'), str({'a': 1}))
+    eq_(func.call_count, 1)
+
+    # the last value set wins
+    s.set_tag('lazy', LazyTag(lambda: 'lazy'))
+    eq_(s.get_tag('lazy'), 'lazy')
+
+
 def test_ctx_mgr():
     dt = DummyTracer()
     s = Span(dt, 'bar')
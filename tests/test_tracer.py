@@ -3,16 +3,29 @@ tests for Tracer and utilities.
 """
 
 from os import getpid
+import sys
+import weakref
 
 from unittest.case import SkipTest
 
+import mock
+
+from ddtrace.constants import ANALYTICS_SAMPLE_RATE_KEY
 from ddtrace.ext import system
+from ddtrace.internal import forksafe
 from ddtrace.context import Context
+from ddtrace.encoding import MsgpackEncoder
+from ddtrace.span import NoopSpan
+from ddtrace.tracer import Tracer
+from ddtrace.writer import AgentWriter
 
 from .base import BaseTracerTestCase
 from .utils.tracer import DummyTracer
 from .utils.tracer import DummyWriter  # noqa
 
+# DEV: `ddtrace.tracer` is the global tracer
+tracer_module = sys.modules[Tracer.__module__]
+
 
 def get_dummy_tracer():
     return DummyTracer()
@@ -317,6 +330,67 @@ class TracerTestCase(BaseTracerTestCase):
         self.assertEqual(s3.get_tag('env'), 'staging')
         self.assertEqual(s3.get_tag('other'), 'tag')
 
+    def test_tracer_global_tags_template(self):
+        self.tracer.set_tags({'env': 'prod', 'version': 2, ANALYTICS_SAMPLE_RATE_KEY: '0.5'})
+        with self.trace('root') as root:
+            root.set_tag('env', 'staging')
+            with self.trace('child') as child:
+                pass
+
+        # the tags are copied to each span
+        self.assertEqual(root.get_tag('env'), 'staging')
+        self.assertEqual(child.get_tag('env'), 'prod')
+        self.assertEqual(child.get_tag('version'), '2')
+        self.assertEqual(child.get_metric(ANALYTICS_SAMPLE_RATE_KEY), 0.5)
+        self.assertEqual(self.tracer.tags['version'], 2)
+
+        self.tracer.tags = {'env': 'dev'}
+        with self.trace('other') as span:
+            pass
+        span.assert_meta({'env': 'dev', system.PID: str(getpid())}, exact=True)
+
+    def test_tracer_global_tags_in_place(self):
+        self.tracer.set_tags({'a': '1'})
+        self.tracer.tags['b'] = 2
+        with self.trace('root') as root:
+            pass
+        # the tags updated in place are only applied by set_tags()
+        root.assert_meta({'a': '1', system.PID: str(getpid())}, exact=True)
+
+        self.tracer.set_tags({})
+        with self.trace('root') as root:
+            with self.trace('child') as child:
+                pass
+
+        # only root spans get the pid
+        root.assert_meta({'a': '1', 'b': '2', system.PID: str(getpid())}, exact=True)
+        self.assertEqual(child.get_tag('b'), '2')
+        self.assertIsNone(child.get_tag(system.PID))
+
+    def test_tracer_global_tags_no_id(self):
+        # building the tags templates doesn't consume span ids
+        with mock.patch('ddtrace.span._new_id') as new_id:
+            self.tracer.set_tags({'env': 'prod'})
+        new_id.assert_not_called()
+
+    def test_tracer_pid_fork(self):
+        # the cached pid is updated after a fork
+        with mock.patch.object(forksafe, 'SUPPORTED', True), mock.patch.object(forksafe, '_after_in_child', []):
+            tracer = Tracer()
+            tracer.writer = DummyWriter()
+            with mock.patch.object(tracer_module, 'getpid', return_value=12345):
+                forksafe._run_after_in_child()
+            with tracer.trace('root') as root:
+                pass
+        self.assertEqual(root.get_tag(system.PID), '12345')
+
+        # without fork hooks, the pid is compared for each root span
+        with mock.patch.object(forksafe, 'SUPPORTED', False):
+            with mock.patch.object(tracer_module, 'getpid', return_value=12346):
+                with tracer.trace('root') as root:
+                    pass
+        self.assertEqual(root.get_tag(system.PID), '12346')
+
     def test_global_context(self):
         # the tracer uses a global thread-local Context
         span = self.trace('fake_span')
@@ -417,3 +491,137 @@ class TracerTestCase(BaseTracerTestCase):
             _tracer=self.tracer,
         )
         self.assertEqual(child._context._current_span, child)
+
+    def test_configure_uds_path(self):
+        tracer = Tracer()
+        tracer.configure(uds_path='/tmp/apm.socket')
+        self.assertEqual(tracer.writer.api.uds_path, '/tmp/apm.socket')
+
+        # the socket path is kept when overriding other settings
+        tracer.configure(priority_sampling=False)
+        self.assertEqual(tracer.writer.api.uds_path, '/tmp/apm.socket')
+
+        # an explicit TCP address replaces the socket path
+        tracer.configure(hostname='127.0.0.1', port=8127)
+        self.assertIsNone(tracer.writer.api.uds_path)
+        self.assertEqual(tracer.writer.api.hostname, '127.0.0.1')
+        self.assertEqual(tracer.writer.api.port, 8127)
+
+    def test_configure_writer(self):
+        tracer = Tracer()
+        writer = AgentWriter(hostname='agent', port=9126)
+        tracer.configure(writer=writer, hostname='ignored')
+        self.assertIs(tracer.writer, writer)
+
+    def test_configure_writer_recycle_spans(self):
+        tracer = Tracer()
+        writer = AgentWriter(encode_on_enqueue=True, recycle_spans=True)
+        writer.api = mock.Mock(encoder=MsgpackEncoder())
+        tracer.configure(writer=writer)
+        with tracer.trace('a') as root:
+            child = weakref.ref(tracer.trace('b'))
+            child().finish()
+        # the child is encoded and initialized again for the next trace
+        span = tracer.trace('c')
+        self.assertIs(span, child())
+        self.assertEqual(span.name, 'c')
+        self.assertIsNone(span.duration)
+        # the root span is still referenced, it is never reused
+        self.assertIsNot(tracer.trace('d'), root)
+        self.assertEqual(root.name, 'a')
+        self.assertIsNotNone(root.duration)
+        writer._worker.stop()
+
+        # spans are allocated again when the writer doesn't recycle them
+        tracer.writer = DummyWriter()
+        self.assertIsNone(tracer._span_free_list)
+
+    def test_configure_id_generator(self):
+        tracer = Tracer()
+        tracer.writer = DummyWriter()
+        ids = iter(range(1, 10))
+        tracer.configure(id_generator=mock.Mock(new_id=lambda: next(ids)))
+        with tracer.trace('root') as root:
+            with tracer.trace('child') as child:
+                pass
+        self.assertEqual((root.trace_id, root.span_id), (1, 2))
+        self.assertEqual((child.trace_id, child.span_id, child.parent_id), (1, 3, 2))
+
+    def test_noop_unsampled_spans(self):
+        tracer = Tracer()
+        tracer.writer = DummyWriter()
+        tracer.configure(noop_unsampled_spans=True)
+        tracer.sampler = mock.Mock(sample=lambda span: span.name != 'dropped')
+        tracer.priority_sampler = None
+
+        with tracer.trace('dropped', service='s') as root:
+            with tracer.trace('child') as child:
+                child.set_tag('a', 'b')
+                child.set_metric('m', 1)
+                # the ids are kept for the propagation and the logs correlation
+                self.assertEqual(tracer.current_span(), child)
+                self.assertEqual(tracer.current_root_span(), root)
+                self.assertEqual(tracer.get_call_context().span_id, child.span_id)
+            self.assertEqual(tracer.current_span(), root)
+
+        for span in (root, child):
+            self.assertIsInstance(span, NoopSpan)
+            self.assertFalse(span.sampled)
+            self.assertIsNone(span.get_tag('a'))
+            self.assertIsNone(span.get_metric('m'))
+        self.assertEqual(child.trace_id, root.trace_id)
+        self.assertEqual(child.parent_id, root.span_id)
+        self.assertEqual(child.service, 's')
+        self.assertEqual(tracer.writer.pop(), [])
+
+        # the context is reset for the next traces
+        context = tracer.get_call_context()
+        self.assertIsNone(context.get_current_span())
+        self.assertIsNone(context.trace_id)
+        with tracer.trace('kept') as root:
+            with tracer.trace('child') as child:
+                pass
+        self.assertNotIsInstance(child, NoopSpan)
+        self.assertEqual(tracer.writer.pop(), [root, child])
+
+    def test_noop_unsampled_spans_exception(self):
+        tracer = Tracer()
+        tracer.writer = DummyWriter()
+        tracer.configure(noop_unsampled_spans=True)
+        tracer.sampler = mock.Mock(sample=lambda span: False)
+        with self.assertRaises(ValueError):
+            with tracer.trace('dropped') as root:
+                raise ValueError()
+        self.assertEqual(root.error, 0)
+        self.assertIsNone(tracer.get_call_context().trace_id)
+
+    def test_noop_unsampled_spans_env(self):
+        self.assertFalse(Tracer()._noop_unsampled_spans)
+        with self.override_env(dict(DD_TRACER_NOOP_UNSAMPLED_SPANS='true')):
+            tracer = Tracer()
+        self.assertTrue(tracer._noop_unsampled_spans)
+
+        # the option can be reconfigured, and is kept when configuring other options
+        tracer.writer = DummyWriter()
+        tracer.sampler = mock.Mock(sample=lambda span: False)
+        tracer.configure(enabled=True)
+        with tracer.trace('dropped') as span:
+            pass
+        self.assertIsInstance(span, NoopSpan)
+
+        tracer.configure(noop_unsampled_spans=False)
+        with tracer.trace('dropped') as span:
+            pass
+        self.assertNotIsInstance(span, NoopSpan)
+        self.assertFalse(span.sampled)
+
+    def test_default_agent_url(self):
+        with mock.patch.object(Tracer, 'DEFAULT_AGENT_URL', 'unix:///var/run/datadog/apm.socket'):
+            tracer = Tracer()
+        self.assertEqual(tracer.writer.api.uds_path, '/var/run/datadog/apm.socket')
+
+        with mock.patch.object(Tracer, 'DEFAULT_AGENT_URL', 'http://agent:9126'):
+            tracer = Tracer()
+        self.assertIsNone(tracer.writer.api.uds_path)
+        self.assertEqual(tracer.writer.api.hostname, 'agent')
+        self.assertEqual(tracer.writer.api.port, 9126)
@@ -1,7 +1,19 @@
+import json
+import os
+import socket
+import threading
+import time
+import weakref
 from unittest import TestCase
 
+import mock
+
+from ddtrace.api import Response
+from ddtrace.constants import SAMPLING_PRIORITY_KEY
+from ddtrace.encoding import MsgpackEncoder
+from ddtrace.ext.priority import AUTO_KEEP, AUTO_REJECT, USER_KEEP, USER_REJECT
 from ddtrace.span import Span
-from ddtrace.writer import AsyncWorker, Q
+from ddtrace.writer import AgentWriter, AsyncWorker, Q
 
 
 class RemoveAllFilter():
@@ -37,10 +49,15 @@ class AddTagFilter():
 class DummmyAPI():
     def __init__(self):
         self.traces = []
+        self.encoded_traces = []
+        self.encoder = MsgpackEncoder()
 
-    def send_traces(self, traces):
+    def send_traces(self, traces, encoded=False):
         for trace in traces:
-            self.traces.append(trace)
+            if encoded:
+                self.encoded_traces.append(trace)
+            else:
+                self.traces.append(trace)
 
 
 N_TRACES = 11
@@ -96,3 +113,481 @@ class AsyncWorkerTests(TestCase):
         worker.join()
         self.assertEqual(len(self.api.traces), 0)
         self.assertEqual(filtr.filtered_traces, 0)
+
+    def test_send_traces_response(self):
+        # the priority sampling rates of the response are applied
+        rates = {'service:,env:': 0.5}
+        self.api.send_traces = mock.Mock(
+            return_value=Response(status=200, body='{"rate_by_service": %s}' % json.dumps(rates)),
+        )
+        sampler = mock.Mock()
+        worker = AsyncWorker(self.api, self.traces, priority_sampler=sampler)
+        worker.stop()
+        worker.join()
+
+        self.api.send_traces.assert_called_once()
+        sampler.set_sample_rate_by_service.assert_called_once_with(rates)
+
+    def test_send_traces_error(self):
+        # the traces of the payloads that can't be sent are recorded as failed by the API
+        self.api.send_traces = mock.Mock(side_effect=socket.error('connection refused'))
+        worker = AsyncWorker(self.api, self.traces)
+        with mock.patch('ddtrace.writer.log') as log:
+            worker.stop()
+            worker.join()
+
+        log.error.assert_called_once()
+        self.assertIn('connection refused', log.error.call_args[0][0])
+        self.assertNotIn('traces.failed', worker._metrics.snapshot())
+
+        self.traces = Q()
+        self.traces.add([Span(tracer=None, name='name')])
+        self.api.send_traces = mock.Mock(side_effect=ValueError('cannot encode'))
+        worker = AsyncWorker(self.api, self.traces)
+        with mock.patch('ddtrace.writer.log'):
+            worker.stop()
+            worker.join()
+        self.assertEqual(worker._metrics.snapshot()['traces.failed'], 1)
+
+    def test_flush_on_min_traces(self):
+        # the worker is woken up as soon as enough traces are queued
+        traces = Q(flush_min_size=N_TRACES)
+        worker = AsyncWorker(self.api, traces, flush_interval=60)
+        for trace in self.traces.pop():
+            traces.add(trace)
+
+        deadline = time.time() + 5
+        while len(self.api.traces) < N_TRACES and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.api.traces), N_TRACES)
+        self.assertTrue(worker.is_alive())
+        worker.stop()
+        worker.join()
+        self.assertFalse(worker.is_alive())
+
+
+class AgentWriterTests(TestCase):
+    def _writer(self, **kwargs):
+        writer = AgentWriter(**kwargs)
+        writer.api = DummmyAPI()
+        return writer
+
+    def _trace(self, trace_id):
+        return [
+            Span(tracer=None, name='name', trace_id=trace_id, span_id=j, parent_id=j - 1 or None)
+            for j in range(1, 8)
+        ]
+
+    def test_encode_on_enqueue(self):
+        filtr = AddTagFilter('Tag')
+        writer = self._writer(filters=[filtr], encode_on_enqueue=True)
+
+        trace = self._trace(1)
+        span = weakref.ref(trace[0])
+        writer.write(trace)
+        writer.write([])
+        writer.write(self._trace(2))
+        del trace
+
+        # the trace was filtered and encoded right away: spans are not referenced anymore
+        self.assertEqual(filtr.filtered_traces, 2)
+        self.assertIsNone(span())
+        self.assertEqual(writer._traces.size(), 2)
+        self.assertGreater(writer._traces.bytes(), 0)
+
+        writer._worker.stop()
+        writer._worker.join()
+        self.assertEqual(writer.api.traces, [])
+        self.assertEqual(len(writer.api.encoded_traces), 2)
+        decoded = writer.api.encoder.decode(writer.api.encoded_traces[0])
+        self.assertEqual(len(decoded), 7)
+        self.assertEqual(decoded[0][b'trace_id'], 1)
+        self.assertEqual(decoded[0][b'meta'], {b'Tag': b'A value'})
+
+    def test_recycle_spans(self):
+        writer = self._writer(encode_on_enqueue=True, recycle_spans=True)
+        trace = self._trace(1)
+        writer.write(trace)
+        # the spans are kept once encoded, to be initialized again
+        self.assertEqual(len(writer.span_free_list), 7)
+        self.assertIs(writer.span_free_list.acquire(None, 'name'), trace[-1])
+        self.assertEqual(writer._traces.size(), 1)
+        writer._worker.stop()
+
+    def test_recycle_spans_disabled(self):
+        # spans are referenced by the queue until they are sent
+        writer = self._writer(recycle_spans=True)
+        self.assertIsNone(writer.span_free_list)
+        self.assertIsNone(self._writer(encode_on_enqueue=True).span_free_list)
+        with mock.patch('ddtrace.context.Context._partial_flush_enabled', True):
+            self.assertIsNone(self._writer(encode_on_enqueue=True, recycle_spans=True).span_free_list)
+
+    def test_encode_on_enqueue_filtered(self):
+        writer = self._writer(filters=[RemoveAllFilter()], encode_on_enqueue=True)
+        writer.write(self._trace(1))
+        self.assertEqual(writer._traces.size(), 0)
+        writer._worker.stop()
+
+    def test_encode_on_enqueue_max_buffer_size(self):
+        encoded_size = len(MsgpackEncoder().encode_trace(self._trace(1)))
+        writer = self._writer(encode_on_enqueue=True, max_buffer_size=encoded_size * 3)
+        for i in range(1, 6):
+            writer.write(self._trace(i))
+        # traces that don't fit in the buffer are dropped
+        self.assertEqual(writer._traces.size(), 3)
+        self.assertEqual(writer._traces.bytes(), encoded_size * 3)
+        writer._worker.stop()
+
+    def test_write_no_getpid(self):
+        writer = self._writer()
+        writer.write(self._trace(1))
+        with mock.patch('ddtrace.writer.os.getpid') as getpid:
+            writer.write(self._trace(2))
+        getpid.assert_not_called()
+        self.assertEqual(writer._traces.size(), 2)
+        writer._worker.stop()
+
+    def test_write_no_worker_check(self):
+        writer = self._writer()
+        writer.write(self._trace(1))
+        worker = writer._worker
+        with mock.patch('ddtrace.writer.forksafe.SUPPORTED', True):
+            with mock.patch.object(worker, 'is_alive') as is_alive:
+                writer.write(self._trace(2))
+            # the worker is only reset by the fork hooks
+            is_alive.assert_not_called()
+
+        with mock.patch('ddtrace.writer.forksafe.SUPPORTED', False):
+            # without fork hooks, a dead worker is how a fork is detected
+            with mock.patch.object(worker, 'is_alive', return_value=False):
+                writer.write(self._trace(3))
+        self.assertIsNot(writer._worker, worker)
+        worker.stop()
+        writer._worker.stop()
+
+    def test_before_fork(self):
+        writer = self._writer(flush_interval=60)
+        writer.write(self._trace(1))
+
+        # the fork doesn't wait for the pending traces, the worker is woken up to send them
+        pop = writer._traces.pops + 1
+        with mock.patch.object(writer._worker, 'flush') as flush:
+            writer._before_fork()
+        flush.assert_not_called()
+        self.assertTrue(writer._worker._wait_flushed(pop, 1))
+        self.assertEqual([t[0].trace_id for t in writer.api.traces], [1])
+        writer._worker.stop()
+
+    def test_before_fork_flush_timeout(self):
+        writer = self._writer(flush_interval=60, fork_flush_timeout=1)
+        writer.write(self._trace(1))
+
+        # the parent process sends its pending traces before forking
+        writer._before_fork()
+        self.assertEqual([t[0].trace_id for t in writer.api.traces], [1])
+        writer._worker.stop()
+
+    def test_worker_flush_timeout(self):
+        writer = self._writer()
+        sending = threading.Event()
+        send = threading.Event()
+
+        def send_traces(traces, encoded=False):
+            sending.set()
+            send.wait()
+
+        writer.api.send_traces = send_traces
+        writer.write(self._trace(1))
+        writer._traces.wake()
+        sending.wait()
+
+        # the traces queued while the worker is sending are sent by its next flush
+        writer.write(self._trace(2))
+        self.assertFalse(writer._worker.flush(0.05))
+        send.set()
+        self.assertTrue(writer._worker.flush(1))
+        self.assertEqual(writer._traces.size(), 0)
+        writer._worker.stop()
+
+    def test_after_fork_in_child(self):
+        writer = self._writer()
+        writer.write(self._trace(1))
+        traces, worker = writer._traces, writer._worker
+
+        writer._after_fork_in_child()
+        writer.write(self._trace(2))
+
+        # the child process starts with a new queue and worker
+        self.assertIsNot(writer._traces, traces)
+        self.assertIsNot(writer._worker, worker)
+        self.assertEqual(writer._traces.size(), 1)
+        worker.stop()
+        writer._worker.stop()
+
+    def test_fork(self):
+        writer = self._writer()
+        writer.write(self._trace(1))
+
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # the pending traces of the parent are discarded in the child
+            try:
+                writer.write(self._trace(2))
+                traces = writer._traces.pop()
+                ok = len(traces) == 1 and traces[0][0].trace_id == 2 and writer._worker.is_alive()
+                os.write(w, b'ok' if ok else b'ko')
+            finally:
+                os._exit(0)
+
+        os.waitpid(pid, 0)
+        os.close(w)
+        self.assertEqual(os.read(r, 2), b'ok')
+        os.close(r)
+
+        writer._worker.stop()
+        writer._worker.join()
+        self.assertEqual([t[0].trace_id for t in writer.api.traces], [1])
+
+    def test_stats(self):
+        writer = self._writer(encode_on_enqueue=True, max_buffer_size=1)
+        writer.write(self._trace(1))
+        writer._traces._max_bytes = 0
+        writer.write(self._trace(2))
+
+        stats = writer.stats()
+        self.assertEqual(stats['traces.enqueued'], 1)
+        self.assertEqual(stats['traces.dropped'], 1)
+        self.assertEqual(stats['encode.time.count'], 2)
+        self.assertEqual(stats['queue.depth'], 1)
+        self.assertEqual(stats['queue.bytes'], writer._traces.bytes())
+        writer._worker.stop()
+
+    def test_stats_empty(self):
+        writer = self._writer()
+        self.assertEqual(writer.stats(), {'queue.depth': 0, 'queue.bytes': 0})
+
+    def test_health_metrics_reporter(self):
+        writer = self._writer(health_metrics_enabled=True, dogstatsd_hostname='statsd', dogstatsd_port=1234)
+        self.assertEqual(writer._reporter.hostname, 'statsd')
+        self.assertEqual(writer._reporter.port, 1234)
+        self.assertIs(writer._reporter.metrics, writer._metrics)
+
+        with mock.patch.object(writer._reporter, 'report') as report:
+            writer.write(self._trace(1))
+            writer._worker.stop()
+            writer._worker.join()
+        # the metrics are reported one last time when the worker exits
+        report.assert_called_once_with()
+
+    def test_write_priority(self):
+        writer = self._writer(prioritize_errors=True)
+        writer._reset_worker()
+        trace = self._trace(1)
+        trace[0].set_metric(SAMPLING_PRIORITY_KEY, USER_KEEP)
+        trace[3].error = 1
+        with mock.patch.object(writer._traces, 'add') as add:
+            writer.write(trace)
+        add.assert_called_once_with(trace, priority=USER_KEEP, error=True)
+        writer._worker.stop()
+
+    def test_encode_on_enqueue_disabled(self):
+        writer = self._writer(encode_on_enqueue=False)
+        trace = self._trace(1)
+        writer.write(trace)
+        self.assertEqual(writer._traces.pop(), [trace])
+        writer._worker.stop()
+
+
+class QTests(TestCase):
+    def test_add_metrics(self):
+        q = Q(max_size=1)
+        self.assertTrue(q.add(1))
+        self.assertTrue(q.add(2))
+        q.close()
+        self.assertFalse(q.add(3))
+        stats = q._metrics.snapshot()
+        self.assertEqual(stats['traces.enqueued'], 2)
+        self.assertEqual(stats['traces.dropped'], 2)
+
+    def test_add_priority(self):
+        q = Q(max_size=2)
+        self.assertTrue(q.add('keep', priority=AUTO_KEEP))
+        self.assertTrue(q.add('reject', priority=AUTO_REJECT))
+        # the lowest priority trace is replaced
+        self.assertTrue(q.add('user_keep', priority=USER_KEEP))
+        # traces ranking lower than all the queued ones are dropped
+        self.assertFalse(q.add('user_reject', priority=USER_REJECT))
+        # traces without priority rank like the ones kept by the sampler
+        self.assertTrue(q.add('none'))
+        self.assertFalse(q.add('reject2', priority=AUTO_REJECT))
+        self.assertTrue(q.add('keep2', priority=AUTO_KEEP))
+        self.assertEqual(sorted(q.pop()), ['keep2', 'user_keep'])
+
+        stats = q._metrics.snapshot()
+        self.assertEqual(stats['traces.dropped'], 5)
+        self.assertEqual(stats['traces.dropped.auto_reject'], 2)
+        self.assertEqual(stats['traces.dropped.user_reject'], 1)
+        self.assertEqual(stats['traces.dropped.auto_keep'], 1)
+        self.assertEqual(stats['traces.dropped.no_priority'], 1)
+
+    def test_add_priority_error(self):
+        q = Q(max_size=2)
+        q.add('error', priority=AUTO_KEEP, error=True)
+        q.add('ok', priority=AUTO_KEEP)
+        self.assertTrue(q.add('error2', priority=AUTO_KEEP, error=True))
+        self.assertFalse(q.add('ok2', priority=AUTO_KEEP))
+        self.assertEqual(sorted(q.pop()), ['error', 'error2'])
+
+    def test_add_priority_random(self):
+        q = Q(max_size=10)
+        for i in range(10):
+            q.add(i, priority=AUTO_REJECT if i % 2 else AUTO_KEEP)
+        for i in range(10, 15):
+            q.add(i, priority=AUTO_KEEP)
+        # only the rejected traces were replaced
+        self.assertEqual(sorted(q.pop()), [0, 2, 4, 6, 8, 10, 11, 12, 13, 14])
+
+    def test_pop_non_blocking(self):
+        q = Q()
+        self.assertIsNone(q.pop())
+        q.add(1)
+        q.add(2)
+        self.assertEqual(q.pop(), [1, 2])
+        self.assertIsNone(q.pop())
+
+    def test_pop_timeout(self):
+        q = Q(flush_min_size=10)
+        q.add(1)
+        start = time.time()
+        self.assertEqual(q.pop(timeout=0.05), [1])
+        self.assertGreaterEqual(time.time() - start, 0.04)
+
+        start = time.time()
+        self.assertIsNone(q.pop(timeout=0.05))
+        self.assertGreaterEqual(time.time() - start, 0.04)
+
+    def test_pop_wakes_on_min_size(self):
+        q = Q(flush_min_size=2)
+        result = []
+        t = threading.Thread(target=lambda: result.append(q.pop(timeout=10)))
+        t.start()
+        q.add(1)
+        q.add(2)
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(result, [[1, 2]])
+
+    def test_pop_wakes_on_min_bytes(self):
+        q = Q(flush_min_bytes=100)
+        result = []
+        t = threading.Thread(target=lambda: result.append(q.pop(timeout=10)))
+        t.start()
+        q.add(b'a', size=60)
+        q.add(b'b', size=60)
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(result, [[b'a', b'b']])
+
+    def test_pop_wakes_on_close(self):
+        q = Q(flush_min_size=10)
+        result = []
+        t = threading.Thread(target=lambda: result.append(q.pop(timeout=10)))
+        t.start()
+        q.add(1)
+        q.close()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(result, [[1]])
+        self.assertFalse(q.add(2))
+
+    def test_wake(self):
+        q = Q(flush_min_size=10)
+        result = []
+        t = threading.Thread(target=lambda: result.append(q.pop(timeout=10)))
+        t.start()
+        q.add(1)
+        q.wake()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(result, [[1]])
+
+        # the consumer waits again on the next pop
+        q.add(2)
+        start = time.time()
+        self.assertEqual(q.pop(timeout=0.05), [2])
+        self.assertGreaterEqual(time.time() - start, 0.04)
+
+    def test_on_ready(self):
+        q = Q(flush_min_size=2)
+        q.on_ready = mock.Mock()
+        q.add(1)
+        q.on_ready.assert_not_called()
+        # called once per pop when the queue becomes ready
+        q.add(2)
+        q.add(3)
+        self.assertEqual(q.on_ready.call_count, 1)
+        q.pop()
+        q.wake()
+        self.assertEqual(q.on_ready.call_count, 2)
+
+    def test_overflow(self):
+        q = Q(max_size=3)
+        for i in range(10):
+            q.add(i)
+        self.assertEqual(q.size(), 3)
+
+    def test_max_bytes(self):
+        q = Q(max_size=0, max_bytes=100)
+        self.assertTrue(q.add(b'a', size=60))
+        self.assertTrue(q.add(b'b', size=40))
+        self.assertEqual(q.bytes(), 100)
+        # elements larger than the queue are dropped
+        self.assertFalse(q.add(b'c', size=101))
+        self.assertEqual(q.pop(), [b'a', b'b'])
+        self.assertEqual(q.bytes(), 0)
+
+    def test_max_bytes_priority(self):
+        q = Q(max_size=0, max_bytes=100)
+        self.assertTrue(q.add('keep', size=40, priority=AUTO_KEEP))
+        self.assertTrue(q.add('reject', size=30, priority=AUTO_REJECT))
+        self.assertTrue(q.add('reject2', size=30, priority=AUTO_REJECT))
+        # the lowest priority traces are overwritten until the new one fits
+        self.assertTrue(q.add('user_keep', size=50, priority=USER_KEEP))
+        self.assertEqual(q.bytes(), 90)
+        # traces ranking lower than the ones they would overwrite are dropped
+        self.assertFalse(q.add('reject3', size=20, priority=AUTO_REJECT))
+        self.assertFalse(q.add('keep2', size=70, priority=AUTO_KEEP))
+        self.assertTrue(q.add('keep3', size=40, priority=AUTO_KEEP))
+        self.assertEqual(sorted(q.pop()), ['keep3', 'user_keep'])
+
+        stats = q._metrics.snapshot()
+        self.assertEqual(stats['traces.enqueued'], 5)
+        self.assertEqual(stats['traces.dropped'], 5)
+        self.assertEqual(stats['traces.dropped.auto_reject'], 3)
+        self.assertEqual(stats['traces.dropped.auto_keep'], 2)
+
+    def test_max_bytes_random_victims(self):
+        # the overwritten elements are picked independently, not as a contiguous run
+        contiguous = 0
+        for _ in range(200):
+            q = Q(max_size=0, max_bytes=100)
+            for i in range(10):
+                q.add(i, size=10)
+            q.add('new', size=30)
+            kept = q.pop()
+            self.assertIn('new', kept)
+            removed = set(range(10)) - set(kept)
+            self.assertEqual(len(removed), 3)
+            if any(all((start + i) % 10 in removed for i in range(3)) for start in range(10)):
+                contiguous += 1
+        # about 1 in 12 picks of 3 elements among 10 are contiguous
+        self.assertLess(contiguous, 100)
+
+    def test_max_bytes_overflow(self):
+        q = Q(max_size=2, max_bytes=100)
+        q.add(b'a', size=10)
+        q.add(b'b', size=10)
+        q.add(b'c', size=20)
+        self.assertEqual(q.size(), 2)
+        self.assertEqual(q.bytes(), 30)
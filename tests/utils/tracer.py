@@ -67,6 +67,7 @@ class DummyTracer(Tracer):
         self.writer = DummyWriter(
                 hostname=self.writer.api.hostname,
                 port=self.writer.api.port,
+                uds_path=self.writer.api.uds_path,
                 filters=self.writer._filters,
                 priority_sampler=self.writer._priority_sampler,
         )